@@ -1,6 +1,7 @@
 /**
  * CSV Data Loader
- * ウェブルートのCSVファイルを読み込み、データを提供するモジュール
+ * レコーダーが書き出した睡眠サマリー（小さな静的JSON、変わっていなければ304）を読み込む
+ * 使えないときは睡眠記録API（SQLite）、さらに使えないときはCSVファイル全体を読み込む
  * 毎日7時/8時/9時の更新時にも問題なく動作するよう設計
  */
 
@@ -10,6 +11,11 @@ const CSVLoader = (function() {
         // ラズパイ上の睡眠レコーダーCSVファイルへのパス
         // シンボリックリンクまたはコピーで /var/www/html/data/ に配置
         sleepDataPath: './data/sleep_records.csv',
+        // 睡眠サマリー（直近31日分の日ごとの集計、ETagで再検証）
+        sleepSummaryPath: './data/summary/daily.json',
+        // 睡眠記録API（日ごとの集計を直近displayDays日分だけ返す）
+        sleepApiPath: './api/sleep_records.php',
+        displayDays: 7,                          // チャートとサマリーに表示する日数
         retryCount: 3,                           // リトライ回数
         retryDelay: 2000,                        // リトライ間隔（ミリ秒）
         cacheTimeout: 5 * 60 * 1000,             // キャッシュ有効期限（5分）
@@ -79,6 +85,37 @@ const CSVLoader = (function() {
         }
     }
     
+    /**
+     * 睡眠サマリーから日ごとの集計を取得（ブラウザのキャッシュをETagで再検証）
+     */
+    async function fetchDailyFromSummary() {
+        const response = await fetch(CONFIG.sleepSummaryPath, { cache: 'no-cache' });
+        if (!response.ok) {
+            throw new Error(`HTTP ${response.status}`);
+        }
+        const data = await response.json();
+        if (!Array.isArray(data)) {
+            throw new Error('INVALID_SUMMARY');
+        }
+        return data.slice(-CONFIG.displayDays);
+    }
+    
+    /**
+     * 睡眠記録APIから日ごとの集計を取得（CSVLoaderの集計と同じ形）
+     */
+    async function fetchDailyFromApi() {
+        const url = `${CONFIG.sleepApiPath}?action=daily&days=${CONFIG.displayDays}&t=${Date.now()}`;
+        const response = await fetch(url, { cache: 'no-store' });
+        if (!response.ok) {
+            throw new Error(`HTTP ${response.status}`);
+        }
+        const data = await response.json();
+        if (!Array.isArray(data)) {
+            throw new Error(data.error || 'INVALID_RESPONSE');
+        }
+        return data;
+    }
+    
     /**
      * CSVテキストをパースして配列に変換
      */
@@ -118,11 +155,26 @@ const CSVLoader = (function() {
         }
         
         try {
-            const csvText = await fetchCSV(CONFIG.sleepDataPath);
-            const rawData = parseCSV(csvText);
-            
-            // 日付ごとにデータを集計
-            const aggregated = aggregateSleepDataByDate(rawData);
+            let aggregated = null;
+            try {
+                // 書き出し済みのサマリーを取得（変わっていなければ304で本文なし）
+                aggregated = await fetchDailyFromSummary();
+            } catch (summaryError) {
+                console.warn('[CSVLoader] Sleep summary unavailable, using API:', summaryError.message);
+            }
+            if (aggregated === null) {
+                try {
+                    // データベースから表示する日数分だけ取得
+                    aggregated = await fetchDailyFromApi();
+                } catch (apiError) {
+                    console.warn('[CSVLoader] Sleep API unavailable, falling back to CSV:', apiError.message);
+                    const csvText = await fetchCSV(CONFIG.sleepDataPath);
+                    const rawData = parseCSV(csvText);
+                    
+                    // 日付ごとにデータを集計
+                    aggregated = aggregateSleepDataByDate(rawData);
+                }
+            }
             
             // キャッシュを更新
             cache.sleepData = aggregated;
@@ -205,7 +257,7 @@ const CSVLoader = (function() {
         }
         
         // 直近7日分のデータを取得
-        const last7Days = data.slice(-7);
+        const last7Days = data.slice(-CONFIG.displayDays);
         const barItems = chartContainer.querySelectorAll('.sleep-bar-item');
         
         const days = ['日', '月', '火', '水', '木', '金', '土'];
@@ -339,7 +391,9 @@ const CSVLoader = (function() {
         init: init,
         getSleepData: getSleepData,
         updateSleepChart: updateSleepChart,
-        setPath: (path) => { CONFIG.sleepDataPath = path; }
+        setPath: (path) => { CONFIG.sleepDataPath = path; },
+        setApiPath: (path) => { CONFIG.sleepApiPath = path; },
+        setSummaryPath: (path) => { CONFIG.sleepSummaryPath = path; }
     };
 })();
 
@@ -1,106 +1,195 @@
 <?php
 /**
  * 睡眠レコーダー制御API
- * systemdサービス経由で制御
+ * 実行中のレコーダーにはUnixドメインソケット（制御サーバー）経由で問い合わせる
+ * 開始と、制御サーバーに接続できないときの停止だけsystemdサービス経由で行う
  */
 
 header('Content-Type: application/json; charset=utf-8');
 
 // 設定
 $SERVICE_NAME = 'sleep_recorder';
-$STATUS_FILE = '/home/admin/Desktop/pi/sleep/sleep_status.json';
+$SOCKET = '/dev/shm/sleep_recorder.sock';
+$STATUS_FILE = '/dev/shm/sleep_recorder_status.json';  // 制御サーバーに接続できないときの予備
+$STATUS_STALE_SECONDS = 10;  // これより古いステータスファイルは停止中とみなす
+$LONG_POLL_MAX = 25;  // ロングポーリングの最大待ち時間（秒）
 
 // アクションを取得
 $action = isset($_GET['action']) ? $_GET['action'] : '';
 
 /**
- * サービスが実行中かどうか確認
+ * 制御サーバーにリクエストを送り、JSONをデコードして返す（接続できなければnull）
+ * php-curlがあればcurlを使い、なければソケットに直接HTTPを書く
  */
-function is_running($service_name)
+function control_request($socket, $method, $path, $timeout = 2)
 {
-    exec("sudo systemctl is-active {$service_name} 2>&1", $output, $return_var);
-    return $return_var === 0;
+    if (!file_exists($socket)) {
+        return null;
+    }
+
+    if (function_exists('curl_init')) {
+        $ch = curl_init("http://localhost{$path}");
+        curl_setopt($ch, CURLOPT_UNIX_SOCKET_PATH, $socket);
+        curl_setopt($ch, CURLOPT_CUSTOMREQUEST, $method);
+        curl_setopt($ch, CURLOPT_RETURNTRANSFER, true);
+        curl_setopt($ch, CURLOPT_CONNECTTIMEOUT, 1);
+        curl_setopt($ch, CURLOPT_TIMEOUT, $timeout);
+        $body = curl_exec($ch);
+        $code = curl_getinfo($ch, CURLINFO_HTTP_CODE);
+        curl_close($ch);
+    } else {
+        list($code, $body) = socket_request($socket, $method, $path, $timeout);
+    }
+
+    if ($body === false || $code !== 200) {
+        return null;
+    }
+    return json_decode($body, true);
 }
 
 /**
- * サービスを停止
+ * php-curlがないとき用: Unixドメインソケットに直接HTTP/1.1で送り、[ステータスコード, 本文]を返す
+ * 制御サーバーは応答後に接続を閉じるので、閉じられるまで読めば応答全体になる
  */
-function stop_service($service_name)
+function socket_request($socket, $method, $path, $timeout)
 {
-    exec("sudo systemctl stop {$service_name} 2>&1", $output, $return_var);
-    return ['success' => $return_var === 0, 'message' => $return_var === 0 ? '停止しました' : '停止に失敗しました'];
+    $fp = @stream_socket_client("unix://{$socket}", $errno, $errstr, 1);
+    if ($fp === false) {
+        return [0, false];
+    }
+    stream_set_timeout($fp, $timeout);
+    fwrite($fp, "{$method} {$path} HTTP/1.1\r\nHost: localhost\r\nConnection: close\r\n\r\n");
+    $response = stream_get_contents($fp);
+    $meta = stream_get_meta_data($fp);
+    fclose($fp);
+
+    if ($response === false || $meta['timed_out']) {
+        return [0, false];
+    }
+    $parts = explode("\r\n\r\n", $response, 2);
+    if (count($parts) < 2 || !preg_match('#^HTTP/\S+ (\d{3})#', $parts[0], $matches)) {
+        return [0, false];
+    }
+    return [intval($matches[1]), $parts[1]];
 }
 
 /**
- * サービスを開始
+ * 予備のステータスファイルを読み込む（更新が止まっていれば停止中とみなす）
  */
-function start_service($service_name)
+function read_status_file($status_file, $stale_seconds)
 {
-    // 既に実行中かチェック
-    if (is_running($service_name)) {
-        return ['success' => false, 'message' => '既に実行中です'];
+    if (!file_exists($status_file)) {
+        return null;
     }
-
-    exec("sudo systemctl start {$service_name} 2>&1", $output, $return_var);
-
-    // 起動を待機
-    sleep(2);
-
-    if (is_running($service_name)) {
-        return ['success' => true, 'message' => '開始しました'];
-    } else {
-        return ['success' => false, 'message' => '起動に失敗しました'];
+    $status = json_decode(file_get_contents($status_file), true);
+    if (!$status) {
+        return null;
+    }
+    $updated = isset($status['last_update']) ? strtotime($status['last_update']) : false;
+    if ($updated === false || time() - $updated > $stale_seconds) {
+        $status['running'] = false;
     }
+    return $status;
 }
 
 /**
  * ステータスを取得
  */
-function get_status($service_name, $status_file)
+function get_status($socket, $status_file, $stale_seconds, $since = null, $wait = 0)
 {
-    $running = is_running($service_name);
-
     $status = [
-        'running' => $running,
+        'running' => false,
         'is_sleeping' => false,
         'start_time' => null,
         'total_sleep_seconds' => 0
     ];
 
-    // ステータスファイルがあれば読み込む
-    if (file_exists($status_file)) {
-        $json = file_get_contents($status_file);
-        $file_status = json_decode($json, true);
-        if ($file_status) {
-            $status = array_merge($status, $file_status);
-            $status['running'] = $running;  // 実際の実行状態で上書き
-        }
+    if ($since !== null) {
+        $path = '/status?since=' . intval($since) . '&wait=' . intval($wait);
+        $server_status = control_request($socket, 'GET', $path, $wait + 5);
+    } else {
+        $server_status = control_request($socket, 'GET', '/status');
+    }
+    if ($server_status) {
+        return array_merge($status, $server_status);
     }
 
+    // 制御サーバーに接続できない（起動直後・終了直後など）
+    $file_status = read_status_file($status_file, $stale_seconds);
+    if ($file_status) {
+        $status = array_merge($status, $file_status);
+    }
     return $status;
 }
 
+/**
+ * サービスを停止（制御サーバーに停止要求を送り、接続できなければsystemdで停止）
+ */
+function stop_service($service_name, $socket)
+{
+    $result = control_request($socket, 'POST', '/control/stop');
+    if ($result && !empty($result['success'])) {
+        return ['success' => true, 'message' => '停止しました'];
+    }
+
+    exec("sudo systemctl stop {$service_name} 2>&1", $output, $return_var);
+    return ['success' => $return_var === 0, 'message' => $return_var === 0 ? '停止しました' : '停止に失敗しました'];
+}
+
+/**
+ * サービスを開始
+ */
+function start_service($service_name, $socket)
+{
+    // 既に実行中かチェック
+    if (control_request($socket, 'GET', '/status')) {
+        return ['success' => false, 'message' => '既に実行中です'];
+    }
+
+    exec("sudo systemctl start {$service_name} 2>&1", $output, $return_var);
+    if ($return_var !== 0) {
+        return ['success' => false, 'message' => '起動に失敗しました'];
+    }
+
+    // 制御サーバーが応答するまで待機（最大5秒）
+    for ($i = 0; $i < 25; $i++) {
+        usleep(200000);
+        if (control_request($socket, 'GET', '/status')) {
+            return ['success' => true, 'message' => '開始しました'];
+        }
+    }
+    return ['success' => false, 'message' => '起動に失敗しました'];
+}
+
 // アクションに応じて処理
 switch ($action) {
     case 'start':
-        $result = start_service($SERVICE_NAME);
+        $result = start_service($SERVICE_NAME, $SOCKET);
         echo json_encode($result, JSON_UNESCAPED_UNICODE);
         break;
 
     case 'stop':
-        $result = stop_service($SERVICE_NAME);
+        $result = stop_service($SERVICE_NAME, $SOCKET);
         echo json_encode($result, JSON_UNESCAPED_UNICODE);
         break;
 
     case 'status':
-        $status = get_status($SERVICE_NAME, $STATUS_FILE);
+        $status = get_status($SOCKET, $STATUS_FILE, $STATUS_STALE_SECONDS);
+        echo json_encode($status, JSON_UNESCAPED_UNICODE);
+        break;
+
+    case 'wait':
+        // 状態が変わるまで待ってから返す（ロングポーリング）
+        $since = isset($_GET['since']) ? intval($_GET['since']) : 0;
+        $wait = isset($_GET['wait']) ? max(0, min(intval($_GET['wait']), $LONG_POLL_MAX)) : $LONG_POLL_MAX;
+        $status = get_status($SOCKET, $STATUS_FILE, $STATUS_STALE_SECONDS, $since, $wait);
         echo json_encode($status, JSON_UNESCAPED_UNICODE);
         break;
 
     default:
         echo json_encode([
             'error' => 'Invalid action',
-            'available_actions' => ['start', 'stop', 'status']
+            'available_actions' => ['start', 'stop', 'status', 'wait']
         ], JSON_UNESCAPED_UNICODE);
         break;
 }
@@ -0,0 +1,165 @@
+<?php
+/**
+ * 睡眠記録API
+ * 睡眠レコーダーのSQLiteデータベース（WALモード）から必要な期間の行だけを返す
+ */
+
+// 設定
+$DB_FILE = '/home/admin/Desktop/pi/sleep/sleep_records.db';
+$MAX_DAYS = 366;  // 1回に返す最大日数
+
+// アクションを取得
+$action = isset($_GET['action']) ? $_GET['action'] : '';
+
+/**
+ * YYYY-MM-DD形式の日付パラメータを取得（不正な値はnull）
+ */
+function date_param($name)
+{
+    if (!isset($_GET[$name]) || !preg_match('/^\d{4}-\d{2}-\d{2}$/', $_GET[$name])) {
+        return null;
+    }
+    return $_GET[$name];
+}
+
+/**
+ * 期間指定のWHERE句とパラメータ
+ */
+function range_condition($from, $to)
+{
+    $conditions = [];
+    $params = [];
+    if ($from !== null) {
+        $conditions[] = 'date >= :from';
+        $params[':from'] = $from;
+    }
+    if ($to !== null) {
+        $conditions[] = 'date <= :to';
+        $params[':to'] = $to;
+    }
+    return [$conditions ? ' WHERE ' . implode(' AND ', $conditions) : '', $params];
+}
+
+/**
+ * 日ごとの集計（期間指定がなければ直近$days日分）
+ * 集計はレコーダーが睡眠区間の記録ごとに更新したdaily_summaryテーブルから読む
+ */
+function get_daily($db, $from, $to, $days)
+{
+    list($where, $params) = range_condition($from, $to);
+    $sql = "SELECT * FROM daily_summary{$where} ORDER BY date DESC LIMIT :days";
+    $stmt = $db->prepare($sql);
+    foreach ($params as $key => $value) {
+        $stmt->bindValue($key, $value);
+    }
+    $stmt->bindValue(':days', $days, PDO::PARAM_INT);
+    $stmt->execute();
+
+    // csvLoader.jsの日ごとの集計と同じ形で古い順に返す
+    $result = [];
+    foreach (array_reverse($stmt->fetchAll(PDO::FETCH_ASSOC)) as $row) {
+        $result[] = [
+            'date' => $row['date'],
+            'totalHours' => $row['total_seconds'] / 3600,
+            'sessions' => (int)$row['sessions'],
+            'snoreDetected' => (bool)$row['snore_detected'],
+            'sleepStart' => substr($row['sleep_start'], 11),
+            'sleepEnd' => substr($row['sleep_end'], 11)
+        ];
+    }
+    return $result;
+}
+
+/**
+ * 期間内の睡眠区間（開始時刻順）
+ */
+function get_sessions($db, $from, $to)
+{
+    list($where, $params) = range_condition($from, $to);
+    $stmt = $db->prepare("SELECT * FROM sleep_sessions{$where} ORDER BY sleep_start");
+    $stmt->execute($params);
+    return $stmt->fetchAll(PDO::FETCH_ASSOC);
+}
+
+/**
+ * 一晩の状態のタイムライン（30秒エポックを連長圧縮した区間、時刻順）
+ */
+function get_timeline($db, $night)
+{
+    $stmt = $db->prepare('SELECT state, start, end FROM timeline_segments WHERE night = :night ORDER BY start');
+    $stmt->execute([':night' => $night]);
+    return $stmt->fetchAll(PDO::FETCH_ASSOC);
+}
+
+/**
+ * 従来のsleep_records.csvと同じ形式で出力
+ */
+function output_csv($sessions)
+{
+    $out = fopen('php://output', 'w');
+    fputcsv($out, ['date', 'sleep_start', 'sleep_end', 'duration_hours', 'duration_minutes', 'snore_detected']);
+    foreach ($sessions as $session) {
+        $seconds = (float)$session['duration_seconds'];
+        fputcsv($out, [
+            $session['date'],
+            substr($session['sleep_start'], 11),
+            substr($session['sleep_end'], 11),
+            (int)floor($seconds / 3600),
+            (int)floor(fmod($seconds, 3600) / 60),
+            $session['snore_detected'] ? 'True' : 'False'
+        ]);
+    }
+    fclose($out);
+}
+
+$from = date_param('from');
+$to = date_param('to');
+$days = isset($_GET['days']) ? max(1, min((int)$_GET['days'], $MAX_DAYS)) : $MAX_DAYS;
+
+try {
+    $db = new PDO('sqlite:' . $DB_FILE, null, null, [PDO::ATTR_ERRMODE => PDO::ERRMODE_EXCEPTION]);
+    $db->exec('PRAGMA busy_timeout = 2000');
+} catch (PDOException $e) {
+    header('Content-Type: application/json; charset=utf-8');
+    http_response_code(503);
+    echo json_encode(['error' => 'データベースを開けません'], JSON_UNESCAPED_UNICODE);
+    exit;
+}
+
+// アクションに応じて処理
+switch ($action) {
+    case 'daily':
+        header('Content-Type: application/json; charset=utf-8');
+        echo json_encode(get_daily($db, $from, $to, $days), JSON_UNESCAPED_UNICODE);
+        break;
+
+    case 'sessions':
+        header('Content-Type: application/json; charset=utf-8');
+        echo json_encode(get_sessions($db, $from, $to), JSON_UNESCAPED_UNICODE);
+        break;
+
+    case 'timeline':
+        header('Content-Type: application/json; charset=utf-8');
+        $night = date_param('night');
+        if ($night === null) {
+            http_response_code(400);
+            echo json_encode(['error' => 'night（YYYY-MM-DD）を指定してください'], JSON_UNESCAPED_UNICODE);
+            break;
+        }
+        echo json_encode(['night' => $night, 'segments' => get_timeline($db, $night)], JSON_UNESCAPED_UNICODE);
+        break;
+
+    case 'csv':
+        header('Content-Type: text/csv; charset=utf-8');
+        header('Content-Disposition: inline; filename="sleep_records.csv"');
+        output_csv(get_sessions($db, $from, $to));
+        break;
+
+    default:
+        header('Content-Type: application/json; charset=utf-8');
+        echo json_encode([
+            'error' => 'Invalid action',
+            'available_actions' => ['daily', 'sessions', 'timeline', 'csv']
+        ], JSON_UNESCAPED_UNICODE);
+        break;
+}
@@ -0,0 +1,406 @@
+"""
+睡眠記録システム - ベンチマーク
+カメラ・マイク・ディスプレイなしで sleep_recorder.py の主要処理の速度を測定する
+（合成した赤外線風フレームと音声チャンクを使用）
+
+測定項目:
+  demux     MJPEGストリームからのJPEG切り出し（MjpegDemuxer）
+  camera    CameraMonitor.update（デコード・動き検知・顔検出）
+  audio     AudioMonitor._detect_snore_and_breathing（FFT解析）
+  decision  SleepRecorder._process_step（睡眠判定）
+
+使用方法:
+  python benchmark.py                                  # 全項目を測定
+  python benchmark.py --only camera --decode-scale 2   # 設定を変えて一部だけ測定
+  python benchmark.py --output new.json --compare old.json
+"""
+
+import argparse
+import contextlib
+import io
+import json
+import os
+import platform
+import resource
+import subprocess
+import time
+
+import cv2
+import numpy as np
+
+from sleep_recorder import (
+    AUDIO_FRONTEND,
+    FACE_DETECTOR_BACKEND,
+    JPEG_DECODE_SCALE,
+    MJPEG_READ_SIZE,
+    MOTION_SCALE,
+    AudioMonitor,
+    CameraMonitor,
+    MjpegDemuxer,
+    PipelineMetrics,
+    SleepRecorder,
+)
+from replay import VirtualClock
+
+BENCHMARKS = ['demux', 'camera', 'audio', 'decision']
+
+# 合成データ設定
+SYNTHETIC_FRAME_COUNT = 30  # 使い回す合成フレームの種類
+FRAME_INTERVAL = 1 / 30  # 合成フレームの時間間隔（30fps想定）
+WARMUP_ITERATIONS = 10  # 計測前の空回し回数
+
+
+def make_ir_frames(count=SYNTHETIC_FRAME_COUNT, width=640, height=480, seed=0):
+    """赤外線カメラ風のグレースケールフレームを合成（暗い背景・ノイズ・ゆっくり動く明るい領域）"""
+    rng = np.random.default_rng(seed)
+    yy, xx = np.mgrid[0:height, 0:width]
+    
+    # 中央が明るく周辺が暗い照明ムラ
+    vignette = 1.0 - 0.6 * (((xx - width / 2) / width) ** 2 + ((yy - height / 2) / height) ** 2) * 4
+    
+    frames = []
+    for i in range(count):
+        cx = width / 2 + 20 * np.sin(2 * np.pi * i / count)
+        cy = height / 2
+        blob = 120 * np.exp(-(((xx - cx) / 60) ** 2 + ((yy - cy) / 80) ** 2))
+        noise = rng.normal(0, 6, (height, width))
+        frame = 40 * vignette + blob + noise
+        frames.append(np.clip(frame, 0, 255).astype(np.uint8))
+    return frames
+
+
+def encode_jpeg_frames(frames, quality=80):
+    """合成フレームをJPEGに変換（libcamera-vidのMJPEG出力の代わり）"""
+    jpegs = []
+    for frame in frames:
+        ok, jpeg = cv2.imencode('.jpg', frame, [cv2.IMWRITE_JPEG_QUALITY, quality])
+        if not ok:
+            raise RuntimeError("JPEGエンコードに失敗しました")
+        jpegs.append(jpeg.tobytes())
+    return jpegs
+
+
+def make_audio_chunks(count, chunk=4096, rate=44100, seed=0):
+    """音声チャンクを合成（背景ノイズ・呼吸風の低周波・ときどきいびき風の200Hz成分）"""
+    rng = np.random.default_rng(seed)
+    t = np.arange(chunk) / rate
+    chunks = np.empty((count, chunk), dtype=np.int16)
+    for i in range(count):
+        signal = rng.normal(0, 150, chunk)
+        signal += 400 * np.sin(2 * np.pi * 30 * t + i)
+        if i % 20 < 5:
+            signal += 3000 * np.sin(2 * np.pi * 200 * t)
+        chunks[i] = np.clip(signal, -32768, 32767).astype(np.int16)
+    return chunks
+
+
+def latency_stats(samples_ns):
+    """1回あたりの処理時間の統計（ミリ秒）"""
+    samples = np.asarray(samples_ns, dtype=np.float64) / 1e6
+    if len(samples) == 0:
+        return {'mean_ms': 0.0, 'p50_ms': 0.0, 'p99_ms': 0.0, 'max_ms': 0.0}
+    return {
+        'mean_ms': float(samples.mean()),
+        'p50_ms': float(np.percentile(samples, 50)),
+        'p99_ms': float(np.percentile(samples, 99)),
+        'max_ms': float(samples.max())
+    }
+
+
+def peak_rss_mb():
+    """これまでの最大常駐メモリ（MB、Linuxのru_maxrssはKB単位）"""
+    return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024
+
+
+def bench_demux(jpegs, iterations):
+    """MJPEGストリームの切り出し速度を測定"""
+    stream = b''.join(jpegs[i % len(jpegs)] for i in range(iterations))
+    demuxer = MjpegDemuxer()
+    
+    samples = []
+    frames = 0
+    start = time.perf_counter()
+    for offset in range(0, len(stream), MJPEG_READ_SIZE):
+        t0 = time.perf_counter_ns()
+        demuxer.feed(stream[offset:offset + MJPEG_READ_SIZE])
+        for _ in demuxer.frames():
+            frames += 1
+        samples.append(time.perf_counter_ns() - t0)
+    elapsed = time.perf_counter() - start
+    
+    return {
+        'frames': frames,
+        'reads': len(samples),
+        'frames_per_second': frames / elapsed,
+        'megabytes_per_second': len(stream) / elapsed / 1e6,
+        'latency_per_read': latency_stats(samples),
+        'stats': demuxer.get_stats()
+    }
+
+
+def bench_camera(jpegs, iterations, camera_options, metrics=False):
+    """CameraMonitor.updateの速度を測定（JPEG投入からデコード・解析まで）"""
+    clock = VirtualClock(0.0)
+    camera = CameraMonitor(open_device=False, clock=clock, **camera_options)
+    pipeline_metrics = PipelineMetrics() if metrics else None
+    if pipeline_metrics is not None:
+        camera.attach_metrics(pipeline_metrics)
+    
+    try:
+        for i in range(WARMUP_ITERATIONS):
+            camera.feed_mjpeg(jpegs[i % len(jpegs)])
+            camera.update()
+        
+        samples = []
+        start = time.perf_counter()
+        for i in range(iterations):
+            clock.now += FRAME_INTERVAL
+            camera.feed_mjpeg(jpegs[i % len(jpegs)])
+            t0 = time.perf_counter_ns()
+            camera.update()
+            samples.append(time.perf_counter_ns() - t0)
+        elapsed = time.perf_counter() - start
+        
+        result = {
+            'frames': iterations,
+            'frames_per_second': iterations / elapsed,
+            'latency_per_update': latency_stats(samples),
+            'detection': camera.detector.get_stats(),
+            'decode': camera.get_decode_stats()
+        }
+        if pipeline_metrics is not None:
+            result['stages'] = pipeline_metrics.snapshot()['stages']
+        return result
+    finally:
+        camera.release()
+
+
+def bench_audio(chunks, rate, frontend=AUDIO_FRONTEND, channels=1):
+    """いびき・呼吸検出（FFT解析）の速度を測定（複数チャンネルは全チャンネルを一括で解析）"""
+    audio = AudioMonitor(open_device=False, frontend=frontend, channels=channels)
+    audio.rate = rate
+    audio.chunk = chunks.shape[1]
+    if channels > 1:
+        # チャンネルごとにずらしたチャンクを(チャンク数, チャンネル数, サンプル数)に並べる
+        chunks = np.stack([np.roll(chunks, c, axis=0) for c in range(channels)], axis=1)
+    
+    for i in range(WARMUP_ITERATIONS):
+        audio._detect_snore_and_breathing(chunks[i % len(chunks)])
+    
+    samples = []
+    start = time.perf_counter()
+    for audio_data in chunks:
+        t0 = time.perf_counter_ns()
+        audio._detect_snore_and_breathing(audio_data)
+        samples.append(time.perf_counter_ns() - t0)
+    elapsed = time.perf_counter() - start
+    
+    return {
+        'chunks': len(chunks),
+        'channels': channels,
+        'chunks_per_second': len(chunks) / elapsed,
+        'realtime_factor': len(chunks) * audio.chunk / rate / elapsed,
+        'latency_per_chunk': latency_stats(samples)
+    }
+
+
+def bench_decision(iterations):
+    """睡眠判定1ステップの速度を測定（入眠・いびき・起床を繰り返す合成状態列）"""
+    clock = VirtualClock(0.0)
+    camera = CameraMonitor(open_device=False, clock=clock)
+    audio = AudioMonitor(open_device=False, clock=clock)
+    recorder = SleepRecorder(headless=True, camera=camera, audio=audio,
+                             csv_file=os.devnull, db_file=None, clock=clock)
+    
+    # 1周期: 静止して入眠 → いびき → 起床（フレーム単位の状態を事前に作成）
+    period = int((300 + 120 + 60) / FRAME_INTERVAL)
+    asleep = int(420 / FRAME_INTERVAL)
+    camera_states = []
+    audio_states = []
+    for i in range(period):
+        awake = i >= asleep
+        snore = not awake and (i // 30) % 10 == 0
+        camera_states.append({'face_detected': True, 'motion': awake, 'eyes_open': awake})
+        audio_states.append({'silent': not awake, 'snore': snore, 'breathing': False})
+    
+    samples = []
+    try:
+        # 入眠・起床のログ表示は測定対象外
+        with contextlib.redirect_stdout(io.StringIO()):
+            start = time.perf_counter()
+            for i in range(iterations):
+                clock.now += FRAME_INTERVAL
+                t0 = time.perf_counter_ns()
+                recorder._process_step(camera_states[i % period], audio_states[i % period], clock.now)
+                samples.append(time.perf_counter_ns() - t0)
+            elapsed = time.perf_counter() - start
+    finally:
+        camera.release()
+    
+    return {
+        'steps': iterations,
+        'steps_per_second': iterations / elapsed,
+        'latency_per_step': latency_stats(samples),
+        'sleep_sessions': len(recorder.sessions)
+    }
+
+
+def _git_revision():
+    """現在のコミット（取得できなければNone）"""
+    try:
+        result = subprocess.run(
+            ['git', 'rev-parse', '--short', 'HEAD'],
+            cwd=os.path.dirname(os.path.abspath(__file__)),
+            capture_output=True, text=True, timeout=5
+        )
+        return result.stdout.strip() or None
+    except Exception:
+        return None
+
+
+def run_benchmarks(selected, frames, chunks, steps, width, height, camera_options, metrics=False,
+                   audio_frontend=AUDIO_FRONTEND, audio_channels=1):
+    """指定した項目を測定して結果を返す"""
+    results = {
+        'revision': _git_revision(),
+        'timestamp': time.strftime('%Y-%m-%d %H:%M:%S'),
+        'platform': {
+            'machine': platform.machine(),
+            'python': platform.python_version(),
+            'numpy': np.__version__,
+            'opencv': cv2.__version__
+        },
+        'config': {
+            'frames': frames,
+            'chunks': chunks,
+            'steps': steps,
+            'width': width,
+            'height': height,
+            'camera_options': camera_options,
+            'audio_frontend': audio_frontend,
+            'audio_channels': audio_channels,
+            'metrics': metrics
+        },
+        'benchmarks': {}
+    }
+    
+    jpegs = None
+    if 'demux' in selected or 'camera' in selected:
+        jpegs = encode_jpeg_frames(make_ir_frames(width=width, height=height))
+    
+    for name in BENCHMARKS:
+        if name not in selected:
+            continue
+        print(f"測定中: {name} ... ", end="", flush=True)
+        if name == 'demux':
+            result = bench_demux(jpegs, frames)
+        elif name == 'camera':
+            result = bench_camera(jpegs, frames, camera_options, metrics)
+        elif name == 'audio':
+            result = bench_audio(make_audio_chunks(chunks), 44100, audio_frontend, audio_channels)
+        else:
+            result = bench_decision(steps)
+        # 最大常駐メモリはプロセス全体の累積値（項目の実行順に単調増加）
+        result['peak_rss_mb'] = peak_rss_mb()
+        results['benchmarks'][name] = result
+        print("OK")
+    
+    return results
+
+
+def _throughput(result):
+    """結果から代表的なスループット（項目名, 値）を取り出す"""
+    for key in ('frames_per_second', 'chunks_per_second', 'steps_per_second'):
+        if key in result:
+            return key, result[key]
+    return None, 0.0
+
+
+def _latency(result):
+    """結果から1回あたりの処理時間の統計を取り出す"""
+    for key, value in result.items():
+        if key.startswith('latency_per_'):
+            return value
+    return latency_stats([])
+
+
+def print_results(results):
+    """測定結果を表形式で表示"""
+    print("\n" + "=" * 70)
+    print(f"{'項目':<10} {'スループット':>18} {'p50(ms)':>10} {'p99(ms)':>10} {'RSS(MB)':>10}")
+    print("-" * 70)
+    for name, result in results['benchmarks'].items():
+        key, value = _throughput(result)
+        unit = key.split('_')[0] + '/s'
+        latency = _latency(result)
+        print(f"{name:<10} {value:>11.1f} {unit:<9} {latency['p50_ms']:>8.3f} "
+              f"{latency['p99_ms']:>10.3f} {result['peak_rss_mb']:>10.1f}")
+    print("=" * 70)
+
+
+def print_comparison(previous, current):
+    """2つのベンチマーク結果のスループットとp99を比較して表示"""
+    print("\n" + "=" * 70)
+    print(f"比較（{previous.get('revision') or '前回'} → {current.get('revision') or '今回'}）")
+    print("=" * 70)
+    for name, result in current['benchmarks'].items():
+        old = previous.get('benchmarks', {}).get(name)
+        if old is None:
+            print(f"{name:<10} (前回の結果なし)")
+            continue
+        _, new_value = _throughput(result)
+        _, old_value = _throughput(old)
+        change = (new_value / old_value - 1) * 100 if old_value > 0 else 0.0
+        print(f"{name:<10} スループット {old_value:>10.1f} → {new_value:>10.1f} ({change:+.1f}%)  "
+              f"p99 {_latency(old)['p99_ms']:.3f} → {_latency(result)['p99_ms']:.3f} ms")
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description='睡眠記録システムのベンチマーク（ハードウェア不要）')
+    parser.add_argument('--only', action='append', choices=BENCHMARKS,
+                        help='測定する項目（複数指定可、省略時は全項目）')
+    parser.add_argument('--frames', type=int, default=300, help='カメラ・MJPEG解析の測定フレーム数')
+    parser.add_argument('--chunks', type=int, default=500, help='音声解析の測定チャンク数')
+    parser.add_argument('--steps', type=int, default=100000, help='睡眠判定の測定ステップ数')
+    parser.add_argument('--width', type=int, default=640, help='合成フレームの幅')
+    parser.add_argument('--height', type=int, default=480, help='合成フレームの高さ')
+    parser.add_argument('--eager-decode', action='store_true',
+                        help='全フレームを読み取り時にデコード（遅延デコードを無効化）')
+    parser.add_argument('--decode-scale', type=int, choices=[1, 2, 4], default=JPEG_DECODE_SCALE,
+                        help='JPEGデコード時の縮小率')
+    parser.add_argument('--face-backend', choices=['haar', 'lbp'], default=FACE_DETECTOR_BACKEND,
+                        help='顔検出バックエンド')
+    parser.add_argument('--motion-scale', type=float, default=MOTION_SCALE,
+                        help='動き検知に使うフレームの縮小率')
+    parser.add_argument('--motion-background', action='store_true',
+                        help='背景モデルとの差分で動きを検知')
+    parser.add_argument('--audio-frontend', choices=['fft', 'stft'], default=AUDIO_FRONTEND,
+                        help='音声解析方式')
+    parser.add_argument('--audio-channels', type=int, default=1,
+                        help='音声解析のチャンネル数（複数チャンネルの一括解析の測定）')
+    parser.add_argument('--metrics', action='store_true',
+                        help='カメラ処理の段階ごとの計測を有効にして内訳を出力')
+    parser.add_argument('--output', help='結果をJSONで保存')
+    parser.add_argument('--compare', metavar='JSON', help='以前のベンチマーク結果と比較')
+    args = parser.parse_args()
+    
+    camera_options = {
+        'lazy_decode': not args.eager_decode,
+        'decode_scale': args.decode_scale,
+        'face_backend': args.face_backend,
+        'motion_scale': args.motion_scale,
+        'motion_background': args.motion_background,
+    }
+    results = run_benchmarks(args.only or BENCHMARKS, args.frames, args.chunks, args.steps,
+                             args.width, args.height, camera_options, args.metrics,
+                             args.audio_frontend, args.audio_channels)
+    print_results(results)
+    
+    if args.output:
+        with open(args.output, 'w', encoding='utf-8') as f:
+            json.dump(results, f, ensure_ascii=False, indent=2)
+        print(f"結果を保存しました: {args.output}")
+    
+    if args.compare:
+        with open(args.compare, encoding='utf-8') as f:
+            print_comparison(json.load(f), results)
@@ -6,8 +6,9 @@ echo "=== 睡眠レコーダー権限設定 ==="
 
 # sleepディレクトリの権限設定
 echo "[1/7] sleepディレクトリの権限設定..."
+# setgidで新しいファイル（sleep_records.dbのWAL/共有メモリファイルなど）もwww-dataグループにする
 chown admin:www-data /home/admin/Desktop/pi/sleep
-chmod 775 /home/admin/Desktop/pi/sleep
+chmod 2775 /home/admin/Desktop/pi/sleep
 
 # ファイルの権限設定
 echo "[2/7] ファイルの権限設定..."
@@ -17,13 +18,10 @@ chown admin:www-data /home/admin/Desktop/pi/sleep/* 2>/dev/null
 echo "[3/7] 必要なファイルを作成..."
 touch /home/admin/Desktop/pi/sleep/error.log
 touch /home/admin/Desktop/pi/sleep/sleep_recorder.pid
-touch /home/admin/Desktop/pi/sleep/sleep_status.json
 chown www-data:www-data /home/admin/Desktop/pi/sleep/error.log
 chown www-data:www-data /home/admin/Desktop/pi/sleep/sleep_recorder.pid
-chown www-data:www-data /home/admin/Desktop/pi/sleep/sleep_status.json
 chmod 664 /home/admin/Desktop/pi/sleep/error.log
 chmod 664 /home/admin/Desktop/pi/sleep/sleep_recorder.pid
-chmod 664 /home/admin/Desktop/pi/sleep/sleep_status.json
 
 # dataディレクトリの権限設定
 echo "[4/7] /var/www/html/data/の権限設定..."
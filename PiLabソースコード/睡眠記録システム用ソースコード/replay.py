@@ -0,0 +1,230 @@
+"""
+睡眠記録システム - セッションリプレイ
+sleep_recorder.py --record で保存したカメラ・音声をハードウェアなしで再生し、
+CameraMonitor / AudioMonitor / SleepRecorder の判定ロジックを通して
+検出された睡眠区間を出力する
+
+使用方法:
+  python replay.py SESSION_DIR                         # できるだけ高速に再生
+  python replay.py SESSION_DIR --realtime              # 実時間で再生
+  python replay.py SESSION_DIR --output new.json --compare old.json
+"""
+
+import argparse
+import json
+import os
+import time
+
+import numpy as np
+
+from sleep_recorder import (
+    AUDIO_FRONTEND,
+    AUDIO_INDEX_DTYPE,
+    CAMERA_INDEX_DTYPE,
+    AudioMonitor,
+    CameraMonitor,
+    SleepRecorder,
+)
+
+
+class VirtualClock:
+    """リプレイ用の仮想時計（記録時刻を返す）"""
+    
+    def __init__(self, now=0.0):
+        self.now = now
+    
+    def __call__(self):
+        return self.now
+
+
+class SessionReader:
+    """記録したセッションを読み込み、カメラと音声を時刻順に返す"""
+    
+    def __init__(self, directory):
+        self.directory = directory
+        
+        with open(os.path.join(directory, 'session.json'), encoding='utf-8') as f:
+            self.metadata = json.load(f)
+        
+        self.camera_index = self._load_index('camera_index.bin', CAMERA_INDEX_DTYPE)
+        self.audio_index = self._load_index('audio_index.bin', AUDIO_INDEX_DTYPE)
+        self.mjpeg = self._map('camera.mjpeg', np.uint8)
+        self.pcm = self._map('audio.pcm', np.dtype('<i2'))
+        
+        # 複数チャンネルの記録は(フレーム数, チャンネル数)として扱う（インデックスはフレーム単位）
+        self.audio_channels = self.metadata.get('audio_channels', 1)
+        if self.audio_channels > 1:
+            self.pcm = self.pcm.reshape(-1, self.audio_channels)
+    
+    def _load_index(self, filename, dtype):
+        path = os.path.join(self.directory, filename)
+        if not os.path.exists(path):
+            return np.zeros(0, dtype=dtype)
+        return np.fromfile(path, dtype=dtype)
+    
+    def _map(self, filename, dtype):
+        """データファイルをメモリマップで開く（空ファイルは空配列）"""
+        path = os.path.join(self.directory, filename)
+        if not os.path.exists(path) or os.path.getsize(path) == 0:
+            return np.zeros(0, dtype=dtype)
+        return np.memmap(path, dtype=dtype, mode='r')
+    
+    def time_range(self):
+        """記録の開始・終了時刻"""
+        times = np.concatenate([self.camera_index['t'], self.audio_index['t']])
+        if len(times) == 0:
+            return 0.0, 0.0
+        return float(times.min()), float(times.max())
+    
+    def events(self):
+        """('camera', 時刻, JPEG) / ('audio', 時刻, PCM) を時刻順に返す"""
+        times = np.concatenate([self.camera_index['t'], self.audio_index['t']])
+        n_camera = len(self.camera_index)
+        
+        for i in np.argsort(times, kind='stable'):
+            if i < n_camera:
+                entry = self.camera_index[i]
+                start = int(entry['offset'])
+                yield 'camera', float(entry['t']), self.mjpeg[start:start + int(entry['length'])]
+            else:
+                entry = self.audio_index[i - n_camera]
+                start = int(entry['sample'])
+                yield 'audio', float(entry['t']), self.pcm[start:start + int(entry['count'])]
+
+
+def replay_session(directory, realtime=False, speed=1.0, csv_file=os.devnull,
+                   camera_options=None, audio_options=None, feature_dir=None, db_file=None):
+    """セッションを再生して判定結果を返す"""
+    reader = SessionReader(directory)
+    t_start, t_end = reader.time_range()
+    clock = VirtualClock(t_start)
+    
+    # 音声フロントエンドは指定がなければ記録時と同じものを使う
+    audio_options = dict(audio_options or {})
+    audio_options.setdefault('frontend', reader.metadata.get('audio_frontend', AUDIO_FRONTEND))
+    audio_options.setdefault('channels', reader.audio_channels)
+    
+    # 閾値のオンライン調整も記録時の設定に合わせる（古い記録は固定閾値）
+    adaptive = reader.metadata.get('adaptive_thresholds', False)
+    audio_options.setdefault('adaptive', adaptive)
+    camera_options = dict(camera_options or {})
+    camera_options.setdefault('adaptive', adaptive)
+    
+    camera = CameraMonitor(open_device=False, clock=clock, **camera_options)
+    audio = AudioMonitor(open_device=False, clock=clock, **audio_options)
+    
+    # 記録時のキャリブレーション結果を使う
+    metadata = reader.metadata
+    audio.rate = metadata.get('audio_rate', audio.rate)
+    audio.chunk = metadata.get('audio_chunk', audio.chunk)
+    camera.motion_threshold = metadata.get('motion_threshold', camera.motion_threshold)
+    audio.silence_threshold = metadata.get('silence_threshold', audio.silence_threshold)
+    audio.snore_threshold = metadata.get('snore_threshold', audio.snore_threshold)
+    
+    recorder = SleepRecorder(headless=True, camera=camera, audio=audio,
+                             csv_file=csv_file, db_file=db_file, clock=clock, feature_dir=feature_dir)
+    
+    frames = 0
+    chunks = 0
+    wall_start = time.perf_counter()
+    try:
+        for kind, t, payload in reader.events():
+            if recorder.shutdown_requested:
+                break
+            clock.now = t
+            
+            # 実時間再生時は記録時刻に合わせて待機
+            if realtime:
+                delay = (t - t_start) / speed - (time.perf_counter() - wall_start)
+                if delay > 0:
+                    time.sleep(delay)
+            
+            if kind == 'audio':
+                audio.process_chunk(np.asarray(payload, dtype=np.int16))
+                chunks += 1
+                continue
+            
+            camera.feed_mjpeg(payload)
+            camera_status = camera.update()
+            if camera_status is None:
+                continue
+            frames += 1
+            recorder._process_step(camera_status, audio.get_status(), t)
+    finally:
+        if recorder.is_sleeping:
+            recorder._end_sleep()
+        if recorder.feature_store is not None:
+            recorder.feature_store.close()
+        if recorder.timeline is not None:
+            recorder.timeline.close()
+            recorder.record_store.close()
+        camera.release()
+    
+    elapsed = time.perf_counter() - wall_start
+    return {
+        'session': os.path.abspath(directory),
+        'frames': frames,
+        'audio_chunks': chunks,
+        'recorded_seconds': t_end - t_start,
+        'elapsed_seconds': elapsed,
+        'speedup': (t_end - t_start) / elapsed if elapsed > 0 else 0.0,
+        'total_sleep_seconds': recorder.total_sleep_seconds,
+        'sessions': recorder.sessions
+    }
+
+
+def print_comparison(previous, current):
+    """2つのリプレイ結果の睡眠区間を比較して表示"""
+    print("\n" + "=" * 50)
+    print("睡眠区間の比較（前回 → 今回）")
+    print("=" * 50)
+    
+    old_sessions = previous.get('sessions', [])
+    new_sessions = current.get('sessions', [])
+    for i in range(max(len(old_sessions), len(new_sessions))):
+        old = old_sessions[i] if i < len(old_sessions) else None
+        new = new_sessions[i] if i < len(new_sessions) else None
+        old_text = f"{old['start']} - {old['end']}" if old else "(なし)"
+        new_text = f"{new['start']} - {new['end']}" if new else "(なし)"
+        mark = "  " if old and new and old['start'] == new['start'] and old['end'] == new['end'] else "* "
+        print(f"{mark}{old_text:<42} → {new_text}")
+    
+    diff = current['total_sleep_seconds'] - previous.get('total_sleep_seconds', 0)
+    print("-" * 50)
+    print(f"合計睡眠時間の差: {diff:+.0f}秒")
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description='睡眠記録セッションのリプレイ')
+    parser.add_argument('session', help='sleep_recorder.py --record で保存したディレクトリ')
+    parser.add_argument('--realtime', action='store_true', help='記録時と同じ速さで再生')
+    parser.add_argument('--speed', type=float, default=1.0, help='実時間再生時の倍速')
+    parser.add_argument('--csv', default=os.devnull, help='検出した睡眠記録を書き込むCSV')
+    parser.add_argument('--audio-frontend', choices=['fft', 'stft'],
+                        help='音声解析方式（省略時は記録時と同じ）')
+    parser.add_argument('--features', metavar='DIR', help='1秒ごとの特徴量の時系列をDIRに保存')
+    parser.add_argument('--db', metavar='FILE', help='睡眠区間と状態のタイムラインを保存するデータベース')
+    parser.add_argument('--output', help='結果をJSONで保存')
+    parser.add_argument('--compare', metavar='JSON', help='以前のリプレイ結果と比較')
+    args = parser.parse_args()
+    
+    audio_options = {'frontend': args.audio_frontend} if args.audio_frontend else None
+    result = replay_session(args.session, realtime=args.realtime, speed=args.speed,
+                            csv_file=args.csv, audio_options=audio_options, feature_dir=args.features,
+                            db_file=args.db)
+    
+    print("\n" + "=" * 50)
+    print(f"フレーム数: {result['frames']}  音声チャンク数: {result['audio_chunks']}")
+    print(f"記録時間: {result['recorded_seconds']:.0f}秒  処理時間: {result['elapsed_seconds']:.1f}秒"
+          f"（{result['speedup']:.1f}倍速）")
+    print(f"検出した睡眠区間: {len(result['sessions'])}件  合計 {result['total_sleep_seconds']:.0f}秒")
+    for session in result['sessions']:
+        print(f"  {session['start']} - {session['end']}  いびき: {'あり' if session['snore'] else 'なし'}")
+    
+    if args.output:
+        with open(args.output, 'w', encoding='utf-8') as f:
+            json.dump(result, f, ensure_ascii=False, indent=2)
+    
+    if args.compare:
+        with open(args.compare, encoding='utf-8') as f:
+            print_comparison(json.load(f), result)
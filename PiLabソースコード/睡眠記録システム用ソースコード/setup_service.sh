@@ -19,25 +19,23 @@ SUDOERS_FILE="/etc/sudoers.d/sleep_recorder"
 echo "# Sleep Recorder service control for www-data" > $SUDOERS_FILE
 echo "www-data ALL=(ALL) NOPASSWD: /bin/systemctl start sleep_recorder" >> $SUDOERS_FILE
 echo "www-data ALL=(ALL) NOPASSWD: /bin/systemctl stop sleep_recorder" >> $SUDOERS_FILE
-echo "www-data ALL=(ALL) NOPASSWD: /bin/systemctl is-active sleep_recorder" >> $SUDOERS_FILE
 chmod 440 $SUDOERS_FILE
 
-# ディレクトリ・ファイル権限設定（adminユーザー用）
+# ディレクトリ・ファイル権限設定（adminユーザー用、Webからはwww-dataグループで読み書き）
 echo "[4/5] ディレクトリ・ファイル権限設定..."
-chown admin:admin /home/admin/Desktop/pi/sleep
-chmod 755 /home/admin/Desktop/pi/sleep
+# setgidで新しいファイル（sleep_records.dbのWAL/共有メモリファイルなど）もwww-dataグループにする（fix_permissions.shと同じ）
+chown admin:www-data /home/admin/Desktop/pi/sleep
+chmod 2775 /home/admin/Desktop/pi/sleep
 
-# ログファイルとステータスファイルを作成（adminユーザー所有）
+# ログファイルを作成（adminユーザー所有）
+# ステータスと制御ソケットは/dev/shmにレコーダーが作成する（ソケットはadmin:www-dataの0660）
 touch /home/admin/Desktop/pi/sleep/output.log
 touch /home/admin/Desktop/pi/sleep/error.log
-touch /home/admin/Desktop/pi/sleep/sleep_status.json
 touch /home/admin/Desktop/pi/sleep/sleep_recorder.pid
 chown admin:admin /home/admin/Desktop/pi/sleep/output.log
 chown admin:admin /home/admin/Desktop/pi/sleep/error.log
-chown admin:admin /home/admin/Desktop/pi/sleep/sleep_status.json
 chown admin:admin /home/admin/Desktop/pi/sleep/sleep_recorder.pid
 chmod 644 /home/admin/Desktop/pi/sleep/*.log
-chmod 644 /home/admin/Desktop/pi/sleep/sleep_status.json
 chmod 644 /home/admin/Desktop/pi/sleep/sleep_recorder.pid
 
 # CSVファイルを作成（存在しない場合）
@@ -55,6 +53,32 @@ mkdir -p /var/www/html/data
 ln -sf /home/admin/Desktop/pi/sleep/sleep_records.csv /var/www/html/data/sleep_records.csv
 chown -h www-data:www-data /var/www/html/data/sleep_records.csv
 
+# 睡眠サマリー（静的JSON）を公開し、gzip版があれば圧縮済みのまま送る
+mkdir -p /home/admin/Desktop/pi/sleep/summary
+chown admin:admin /home/admin/Desktop/pi/sleep/summary
+ln -sfn /home/admin/Desktop/pi/sleep/summary /var/www/html/data/summary
+cat > /etc/apache2/conf-available/sleep-summary.conf <<'EOF'
+<Directory /var/www/html/data/summary>
+    Options +FollowSymLinks
+    RewriteEngine On
+    RewriteCond %{HTTP:Accept-Encoding} gzip
+    RewriteCond %{REQUEST_FILENAME}.gz -f
+    RewriteRule ^(.+)\.json$ $1.json.gz [L]
+    <FilesMatch "\.json\.gz$">
+        ForceType application/json
+        Header set Content-Encoding gzip
+    </FilesMatch>
+    Header append Vary Accept-Encoding
+    # 毎回ETagで再検証（変わっていなければ304）
+    Header set Cache-Control "no-cache"
+</Directory>
+EOF
+a2enmod rewrite headers
+a2enconf sleep-summary
+
+# sleep_control.phpが制御ソケットへ接続するためのphp-curl（なければソケットに直接書き込むので失敗しても続行）
+apt-get install -y php-curl || echo "警告: php-curlをインストールできませんでした"
+
 # Apache再起動
 echo "[7/7] Apache再起動..."
 systemctl restart apache2
@@ -0,0 +1,101 @@
+"""
+睡眠記録システム - 睡眠記録データベースの管理
+従来のsleep_records.csvの取り込み、互換CSVの書き出し、期間指定の検索・日ごとの集計
+
+使用方法:
+  python sleep_db.py import sleep_records.csv                     # CSVを取り込む（取り込み済みの行は無視）
+  python sleep_db.py export sleep_records.csv                     # 従来形式のCSVに書き出す
+  python sleep_db.py sessions --from 2025-12-01 --to 2025-12-07   # 期間内の睡眠区間
+  python sleep_db.py daily --from 2025-12-01                      # 日ごとの集計
+  python sleep_db.py summary                                      # 睡眠サマリーJSONを書き出す
+  python sleep_db.py timeline 2025-12-13                          # 一晩の状態のタイムライン
+"""
+
+import argparse
+import sys
+
+from sleep_recorder import CSV_FILE, SLEEP_DB_FILE, SUMMARY_DIR, SleepRecordStore, SleepSummaryWriter
+
+
+def print_sessions(sessions):
+    """睡眠区間を表示"""
+    print(f"{'開始':<20} {'終了':<20} {'時間':>8} {'いびき':<6}")
+    print("-" * 60)
+    for session in sessions:
+        minutes = int(session['duration_seconds'] // 60)
+        snore = "あり" if session['snore_detected'] else "なし"
+        print(f"{session['sleep_start']:<20} {session['sleep_end']:<20} "
+              f"{minutes // 60:>4}h{minutes % 60:02d}m {snore:<6}")
+    print("-" * 60)
+    print(f"{len(sessions)}件")
+
+
+def print_timeline(segments):
+    """タイムラインの区間を表示"""
+    print(f"{'開始':<20} {'終了':<20} {'状態':<10}")
+    print("-" * 60)
+    for segment in segments:
+        print(f"{segment['start']:<20} {segment['end']:<20} {segment['state']:<10}")
+    print("-" * 60)
+    print(f"{len(segments)}区間")
+
+
+def print_daily(days):
+    """日ごとの集計を表示"""
+    print(f"{'日付':<12} {'睡眠時間':>8} {'区間':>4} {'就寝':<10} {'起床':<10} {'いびき':<6}")
+    print("-" * 60)
+    for day in days:
+        snore = "あり" if day['snore_detected'] else "なし"
+        print(f"{day['date']:<12} {day['total_seconds'] / 3600:>7.1f}h {day['sessions']:>4} "
+              f"{day['sleep_start'][11:]:<10} {day['sleep_end'][11:]:<10} {snore:<6}")
+    print("-" * 60)
+    if days:
+        average = sum(day['total_seconds'] for day in days) / len(days) / 3600
+        print(f"{len(days)}日  平均 {average:.1f}時間")
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description='睡眠記録データベースの管理')
+    parser.add_argument('--db', default=SLEEP_DB_FILE, help='SQLiteデータベース')
+    commands = parser.add_subparsers(dest='command', required=True)
+
+    import_parser = commands.add_parser('import', help='従来のCSVを取り込む')
+    import_parser.add_argument('csv', nargs='?', default=CSV_FILE)
+
+    export_parser = commands.add_parser('export', help='従来形式のCSVに書き出す（-で標準出力）')
+    export_parser.add_argument('csv')
+
+    sessions_parser = commands.add_parser('sessions', help='期間内の睡眠区間を表示')
+    daily_parser = commands.add_parser('daily', help='日ごとの集計を表示')
+    summary_parser = commands.add_parser('summary', help='睡眠サマリーJSONを書き出す（変わったファイルのみ）')
+    summary_parser.add_argument('directory', nargs='?', default=SUMMARY_DIR)
+    timeline_parser = commands.add_parser('timeline', help='一晩の状態のタイムラインを表示')
+    timeline_parser.add_argument('night', metavar='YYYY-MM-DD', help='夜の日付（正午より前は前日の夜）')
+    for sub in (export_parser, sessions_parser, daily_parser):
+        sub.add_argument('--from', dest='date_from', metavar='YYYY-MM-DD', help='開始日（含む）')
+        sub.add_argument('--to', dest='date_to', metavar='YYYY-MM-DD', help='終了日（含む）')
+    args = parser.parse_args()
+
+    store = SleepRecordStore(args.db)
+    try:
+        if args.command == 'import':
+            added = store.import_csv(args.csv)
+            print(f"{added}件を取り込みました（合計 {store.count()}件）")
+        elif args.command == 'export':
+            if args.csv == '-':
+                store.export_csv(sys.stdout, args.date_from, args.date_to)
+            else:
+                with open(args.csv, 'w', newline='', encoding='utf-8') as f:
+                    store.export_csv(f, args.date_from, args.date_to)
+        elif args.command == 'summary':
+            writer = SleepSummaryWriter(args.directory)
+            writer.update(store)
+            print(f"{writer.files_written}件のサマリーを更新しました: {args.directory}")
+        elif args.command == 'timeline':
+            print_timeline(store.timeline(args.night))
+        elif args.command == 'sessions':
+            print_sessions(store.sessions(args.date_from, args.date_to))
+        else:
+            print_daily(store.daily(args.date_from, args.date_to))
+    finally:
+        store.close()
@@ -8,7 +8,6 @@ Web制御対応（ヘッドレスモード）
 
 import cv2
 import numpy as np
-import pyaudio
 import threading
 import time
 import csv
@@ -17,10 +16,27 @@ import platform
 import signal
 import sys
 import json
+import gzip
+import shutil
+import queue
+import wave
 import argparse
+import asyncio
+import sqlite3
 import subprocess
-from datetime import datetime
+import bisect
+import functools
+import multiprocessing
+from multiprocessing import shared_memory
+from datetime import datetime, timedelta
 from collections import deque
+from urllib.parse import urlsplit, parse_qs
+
+# PyAudioがない環境（リプレイ・ベンチマーク専用マシン等）でも読み込めるように
+try:
+    import pyaudio
+except ImportError:
+    pyaudio = None
 
 # Raspberry Pi判定
 IS_RASPBERRY_PI = platform.machine().startswith('arm') or platform.machine().startswith('aarch')
@@ -34,14 +50,67 @@ SNORE_WINDOW_SECONDS = 60  # いびき判定のウィンドウ（60秒以内に
 SNORE_COUNT_THRESHOLD = 3  # この回数いびきが検出されたら睡眠判定
 ROLLOVER_GRACE_PERIOD = 5  # 寝返り判定の猶予時間（5秒以内の動きは無視）
 CALIBRATION_TIME = 10  # キャリブレーション時間（秒）
+STATUS_UPDATE_INTERVAL = 1.0  # ステータスファイルの更新間隔（秒）
+FRAME_WAIT_TIMEOUT = 0.5  # 新フレーム待ちのタイムアウト（秒）
 
 # CSVファイルのパス（スクリプトと同じディレクトリに保存）
 SCRIPT_DIR = os.path.dirname(os.path.abspath(__file__))
-CSV_FILE = os.path.join(SCRIPT_DIR, "sleep_records.csv")
+CSV_FILE = os.path.join(SCRIPT_DIR, "sleep_records.csv")  # 互換用（従来のダッシュボード・ツール向け）
+
+# 睡眠記録データベース（SQLite、WALモード。api/sleep_records.phpが読み取る）
+SLEEP_DB_ENABLED = True
+SLEEP_DB_FILE = os.path.join(SCRIPT_DIR, "sleep_records.db")
+SLEEP_LOG_ROWS = 20  # 終了時に表示する直近の記録数
+
+# 睡眠状態のタイムライン（30秒エポックごとの状態を連長圧縮した区間としてデータベースに保存）
+EPOCH_SECONDS = 30
+TIMELINE_STATES = ('awake', 'candidate', 'sleeping', 'rollover', 'snore')  # 後ろほど優先（エポック内に一度でもあればその状態）
+
+# 睡眠サマリー（日・週・月ごとの集計を静的JSONとgzipに書き出す。Webは/data/summary/で配信）
+SUMMARY_ENABLED = True
+SUMMARY_DIR = os.path.join(SCRIPT_DIR, "summary")
+SUMMARY_DAYS = 31  # daily.jsonに含める日数
+SUMMARY_WEEKS = 26
+SUMMARY_MONTHS = 24
+
+# 実行時ファイルの置き場所（tmpfsがあればSDカードに書かない）
+RUNTIME_DIR = '/dev/shm' if os.path.isdir('/dev/shm') else SCRIPT_DIR
 
 # PIDファイルとステータスファイル（Web制御用）
 PID_FILE = os.path.join(SCRIPT_DIR, "sleep_recorder.pid")
-STATUS_FILE = os.path.join(SCRIPT_DIR, "sleep_recorder_status.json")
+STATUS_FILE = os.path.join(RUNTIME_DIR, "sleep_recorder_status.json")  # 制御サーバーに接続できないときの予備
+METRICS_FILE = os.path.join(RUNTIME_DIR, "sleep_recorder_metrics.prom")  # Prometheus形式の計測値（毎秒置き換え）
+
+# 制御・ステータスサーバー（Unixドメインソケット上のHTTP、api/sleep_control.phpから接続）
+CONTROL_SERVER_ENABLED = True
+CONTROL_SOCKET = os.path.join(RUNTIME_DIR, "sleep_recorder.sock")
+CONTROL_SOCKET_MODE = 0o660  # 接続できるのは所有者とグループのみ
+CONTROL_SOCKET_GROUP = 'www-data'  # Webサーバーのグループ（サービスはSupplementaryGroups=www-dataで起動）
+CONTROL_LONG_POLL_MAX = 30  # ロングポーリングの最大待ち時間（秒）
+CONTROL_SSE_KEEPALIVE = 15  # SSEの接続維持コメントの間隔（秒）
+
+# ライブプレビュー（--preview時、ブラウザでMJPEGを表示）
+PREVIEW_HOST = '127.0.0.1'  # 認証がないので既定はPi自身のみ（他の端末へ公開するには--preview-hostで明示）
+PREVIEW_PORT = 8081
+PREVIEW_FPS = 5  # クライアントごとの既定フレームレート（?fps=で変更）
+PREVIEW_MAX_FPS = 15
+PREVIEW_MAX_CLIENTS = 4
+PREVIEW_JPEG_QUALITY = 80  # オーバーレイ付きフレームをエンコードするときの品質
+
+# 夜の区切り（この時刻より前は前日の夜として扱う）
+NIGHT_BOUNDARY_HOUR = 12
+
+# いびき音声クリップ設定（--snore-clips時）
+SNORE_CLIP_DIR = os.path.join(SCRIPT_DIR, "snore_clips")
+SNORE_CLIP_PRE_SECONDS = 5  # いびき開始前に含める秒数（プリロール）
+SNORE_CLIP_POST_SECONDS = 10  # いびき開始後に含める秒数
+SNORE_CLIP_NIGHT_QUOTA_MB = 50  # 一晩あたりの容量上限（超えたら古いクリップから削除）
+SNORE_CLIP_TOTAL_QUOTA_MB = 500  # 全体の容量上限
+
+# 特徴量の時系列記録（1秒ごとの値を夜ごとのメモリマップ列ファイルに保存）
+FEATURE_STORE_ENABLED = True
+FEATURE_STORE_DIR = os.path.join(SCRIPT_DIR, "features")
+FEATURE_STORE_QUOTA_MB = 200  # 全体の容量上限（一晩約2.7MB、超えたら古い夜から削除）
 
 # いびき検出設定
 SNORE_FREQ_LOW = 100
@@ -51,28 +120,1701 @@ SNORE_FREQ_HIGH = 500
 BREATHING_FREQ_LOW = 10  # 呼吸周波数下限(Hz)
 BREATHING_FREQ_HIGH = 50  # 呼吸周波数上限(Hz)
 
+# 呼吸数推定設定（音量包絡線の自己相関）
+BREATHING_ENVELOPE_RATE = 10  # 包絡線のサンプリングレート(Hz)
+BREATHING_WINDOW_SECONDS = 45  # 自己相関を計算する窓の長さ（秒）
+BREATHING_MIN_SECONDS = 20  # 推定を出すのに必要な包絡線の長さ（秒）
+BREATHING_BASELINE_SECONDS = 10  # 包絡線から除く緩やかな変動（移動平均）の時定数（秒）
+BREATHING_MIN_BPM = 6  # 推定する呼吸数の範囲（回/分）
+BREATHING_MAX_BPM = 30
+BREATHING_CONFIDENCE_THRESHOLD = 0.4  # この信頼度以上なら規則的な呼吸とみなす
+
+# 帯域パワー解析設定
+AUDIO_EXTRA_BANDS = {}  # 追加で監視する帯域 例: {'speech': (300, 3000)}
+AUDIO_FFT_WINDOW = None  # FFT前に掛ける窓関数（None=矩形窓、numpyの'hanning'・'hamming'など。変更時は閾値の再調整が必要）
+
+# 音声取得設定（'callback'=コールバックでリングバッファへ書き込み、'blocking'=従来のstream.read）
+AUDIO_CAPTURE_MODE = 'callback'
+AUDIO_CALLBACK_FRAMES = 1024  # コールバック1回あたりのサンプル数
+AUDIO_RING_SECONDS = 10  # リングバッファの容量（秒）。解析が止まってもこの時間までは音声を失わない
+AUDIO_DRIFT_TOLERANCE = 2 * AUDIO_CALLBACK_FRAMES  # 複数デバイスの溜まり具合の差がこれを超えたらずれとみなして揃える（サンプル数）
+
+# マルチチャンネル設定（2人分の寝床やマイクアレイ用）
+AUDIO_DEVICES = []  # 使う入力デバイス名（部分一致）のリスト。空なら既定の入力デバイス 例: ['USB Audio', 'Webcam']
+AUDIO_CHANNELS = 1  # デバイスごとのチャンネル数（全デバイス共通）
+
+# 音声フロントエンド設定（'fft'=チャンクごとのFFT、'stft'=間引き後のSTFT）
+AUDIO_FRONTEND = 'fft'
+AUDIO_DECIMATION_FACTOR = 16  # 間引き率（44100Hz → 約2756Hz、解析帯域はすべて1kHz未満）
+AUDIO_DECIMATION_TAPS = 129  # 折り返し防止ローパスFIRのタップ数
+AUDIO_STFT_SIZE = 1024  # STFTのフレーム長（間引き後のサンプル数、約2.7Hz分解能）
+AUDIO_STFT_HOP = 256  # STFTのフレーム移動量（75%オーバーラップ）
+
+# スペクトログラム表示設定（--spectrogram時、GUI表示のみ）
+SPECTROGRAM_MAX_FREQ = 1000  # 表示する最大周波数（Hz）
+SPECTROGRAM_SECONDS = 10  # 表示する時間幅（秒）
+SPECTROGRAM_DB_RANGE = (0, 80)  # 色を割り当てるdBの範囲（振幅1のint16が0dB）
+
+# オンライン閾値調整設定（静かな・動きのない区間の統計で閾値を継続的に更新）
+ADAPTIVE_THRESHOLDS = True
+ADAPT_TIME_CONSTANT = 600  # 統計の時定数（秒）。これより古い区間の影響は指数的に薄れる
+ADAPT_MIN_SAMPLES = 100  # 閾値を更新し始めるのに必要なサンプル数
+SILENCE_THRESHOLD_SIGMA = 2  # 閾値 = 平均 + k×標準偏差（キャリブレーションと同じ係数）
+SNORE_THRESHOLD_SIGMA = 5
+MOTION_THRESHOLD_SIGMA = 3
+SILENCE_THRESHOLD_BOUNDS = (30, 5000)  # 閾値の下限・上限
+SNORE_THRESHOLD_BOUNDS = (1e4, 1e9)
+MOTION_THRESHOLD_BOUNDS = (100, 150000)
+SILENCE_ACCEPT_SIGMA = 3  # 静寂の統計に入れる上限 = 平均 + k×標準偏差（判定閾値で切ると平均・分散が小さく偏る）
+ADAPT_LEVEL_SHIFT_SECONDS = 300  # 上限を超える状態がこれだけ続いたら背景レベルの変化として統計に入れる（空調の作動など）
+
 # 履歴サイズ（安定化用）
 MOTION_HISTORY_SIZE = 60  # 2秒分（30fps想定）
 AUDIO_HISTORY_SIZE = 60
 
+# MJPEGストリーム解析設定
+MJPEG_READ_SIZE = 32768  # 1回の読み取りサイズ
+MJPEG_BUFFER_SIZE = 2 * 1024 * 1024  # リングバッファ容量（1フレームの最大サイズより十分大きく）
+
+# JPEGデコード設定
+LAZY_JPEG_DECODE = True  # 読み取りスレッドではデコードせず、使用時に最新フレームのみデコード
+JPEG_DECODE_SCALE = 1  # デコード時の縮小率（1/2/4）
+
+# 顔検出スケジューラ設定
+FACE_DETECTOR_BACKEND = 'haar'  # 顔検出バックエンド（'haar' / 'lbp'）
+FACE_FULL_SEARCH_INTERVAL = 15  # 全画面探索の間隔（フレーム数）
+FACE_ROI_PADDING = 0.5  # 追跡ROIの余白（顔サイズに対する比率）
+FACE_MIN_SIZE = (30, 30)  # 検出する顔の最小サイズ（元の解像度のピクセル）
+
+# 動き検知エンジン設定
+MOTION_SCALE = 0.5  # 動き検知に使うフレームの縮小率（1.0で等倍）
+MOTION_BLUR_SIZE = 21  # 等倍時のぼかしカーネルサイズ
+MOTION_DIFF_THRESHOLD = 25  # 差分の二値化閾値
+MOTION_USE_BACKGROUND = False  # 背景モデル（移動平均）との差分を使うか
+MOTION_BACKGROUND_ALPHA = 0.05  # 背景モデルの更新率
+
+# マルチプロセス設定（カメラの取得・デコードを子プロセスで実行）
+CAMERA_USE_PROCESS = False
+CAMERA_RING_SLOTS = 4  # 共有メモリリングのフレーム数
+
+# 処理時間の計測設定（--metricsで有効化、無効時は計測処理を一切行わない）
+METRICS_ENABLED = False
+METRICS_WINDOW = 300  # 統計に使う直近の計測回数
+METRICS_BUCKETS = (0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0)  # ヒストグラム境界（秒）
+
+JPEG_SOI = b'\xff\xd8'  # JPEG開始マーカー
+JPEG_EOI = b'\xff\xd9'  # JPEG終端マーカー
+
+
+class MjpegDemuxer:
+    """
+    MJPEGバイトストリームからJPEGフレームを切り出す
+    事前確保したbytearrayをリングとして使い回し、マーカー探索は前回の続きから行う
+    フレームはコピーせずmemoryviewのスライスとして返す（次の読み込みまで有効）
+    """
+
+    def __init__(self, capacity=MJPEG_BUFFER_SIZE):
+        self.capacity = capacity
+        self.buffer = bytearray(capacity)
+        self.view = memoryview(self.buffer)
+        self.head = 0  # 未処理データの先頭
+        self.tail = 0  # 書き込み位置
+        self.scan_pos = 0  # 次にマーカー探索を再開する位置
+        self.frame_start = -1  # 現在のフレームのSOI位置（未発見なら-1）
+
+        # 統計カウンター
+        self.bytes_total = 0
+        self.frames_total = 0
+        self.resyncs = 0  # SOI以外のデータを読み飛ばした回数
+        self.corrupt_frames = 0  # 途中で途切れた・大きすぎるフレーム数
+
+    def _reserve(self, size):
+        """書き込み領域を確保（必要なら未処理データを先頭へ詰める）"""
+        if self.capacity - self.tail >= size:
+            return self.capacity - self.tail
+
+        # 未処理データを先頭へ移動（移動するのは途中のフレームのみ）
+        pending = self.tail - self.head
+        if self.head > 0:
+            self.view[0:pending] = self.view[self.head:self.tail]
+            shift = self.head
+            self.head = 0
+            self.tail = pending
+            self.scan_pos = max(0, self.scan_pos - shift)
+            if self.frame_start >= 0:
+                self.frame_start -= shift
+
+        if self.capacity - self.tail == 0:
+            # 1フレームがバッファ容量を超えた → 破棄して再同期
+            self.corrupt_frames += 1
+            self.resyncs += 1
+            self.head = self.tail = self.scan_pos = 0
+            self.frame_start = -1
+
+        return self.capacity - self.tail
+
+    def feed(self, data):
+        """バイト列をバッファへ追加"""
+        data = memoryview(data)
+        while len(data) > 0:
+            free = self._reserve(len(data))
+            n = min(free, len(data))
+            self.view[self.tail:self.tail + n] = data[:n]
+            self.tail += n
+            self.bytes_total += n
+            data = data[n:]
+
+    def read_from(self, stream, size=MJPEG_READ_SIZE):
+        """ストリームからバッファへ直接読み込む（中間コピーなし）"""
+        free = self._reserve(size)
+        target = self.view[self.tail:self.tail + min(size, free)]
+        reader = getattr(stream, 'readinto1', None) or stream.readinto
+        n = reader(target) or 0
+        self.tail += n
+        self.bytes_total += n
+        return n
+
+    def frames(self):
+        """バッファ内の完成したフレームを順に返す（memoryviewスライス）"""
+        while True:
+            if self.frame_start < 0:
+                # SOIを探す
+                soi = self.buffer.find(JPEG_SOI, max(self.scan_pos, self.head), self.tail)
+                if soi < 0:
+                    # マーカーが読み込み境界をまたぐ可能性があるので最後の1バイトは残す
+                    keep = self.tail - 1 if self.tail > self.head else self.tail
+                    if keep > self.head:
+                        self.resyncs += 1
+                    self.head = max(self.head, keep)
+                    self.scan_pos = self.head
+                    return
+                if soi > self.head:
+                    self.resyncs += 1
+                self.head = soi
+                self.frame_start = soi
+                self.scan_pos = soi + 2
+
+            # EOIを探す
+            eoi = self.buffer.find(JPEG_EOI, self.scan_pos, self.tail)
+            if eoi < 0:
+                self.scan_pos = max(self.frame_start + 2, self.tail - 1)
+                return
+            end = eoi + 2
+
+            # EOIより前に新しいSOIがあれば、前のフレームは途中で途切れている
+            restart = self.buffer.rfind(JPEG_SOI, self.frame_start + 2, eoi)
+            if restart >= 0:
+                self.corrupt_frames += 1
+                self.resyncs += 1
+                self.frame_start = restart
+
+            frame = self.view[self.frame_start:end]
+            self.head = end
+            self.scan_pos = end
+            self.frame_start = -1
+            self.frames_total += 1
+            yield frame
+
+    def get_stats(self):
+        """統計カウンターを取得"""
+        return {
+            'bytes': self.bytes_total,
+            'frames': self.frames_total,
+            'resyncs': self.resyncs,
+            'corrupt_frames': self.corrupt_frames
+        }
+
+
+def _find_cascade_dir(kind):
+    """カスケードファイルのディレクトリを探す（kind: 'haarcascades' / 'lbpcascades'）"""
+    # cv2.data がない環境（apt版OpenCV等）への対応
+    if kind == 'haarcascades':
+        try:
+            return cv2.data.haarcascades
+        except AttributeError:
+            pass
+    
+    # ラズパイ等のシステムパス
+    for base in ('/usr/share/opencv4/', '/usr/share/opencv/'):
+        path = os.path.join(base, kind) + '/'
+        if os.path.exists(path):
+            return path
+    return '/usr/share/opencv4/' + kind + '/'
+
+
+class CascadeFaceBackend:
+    """CascadeClassifierによる顔検出バックエンド（処理時間を計測）"""
+    
+    def __init__(self, name, path, scale_factor=1.3, min_neighbors=5, min_size=FACE_MIN_SIZE):
+        self.name = name
+        self.classifier = cv2.CascadeClassifier(path)
+        self.scale_factor = scale_factor
+        self.min_neighbors = min_neighbors
+        self.min_size = min_size
+        
+        # 処理時間の統計
+        self.calls = 0
+        self.total_time = 0.0
+        self.last_time = 0.0
+    
+    def available(self):
+        """分類器が読み込めたか"""
+        return not self.classifier.empty()
+    
+    def detect(self, gray):
+        """画像内の対象を検出して(x, y, w, h)のリストを返す"""
+        t0 = time.perf_counter()
+        found = self.classifier.detectMultiScale(
+            gray, scaleFactor=self.scale_factor, minNeighbors=self.min_neighbors,
+            minSize=self.min_size
+        )
+        self.last_time = time.perf_counter() - t0
+        self.total_time += self.last_time
+        self.calls += 1
+        return [tuple(int(v) for v in box) for box in found]
+    
+    def get_stats(self):
+        """処理時間の統計を取得（ミリ秒）"""
+        return {
+            'calls': self.calls,
+            'avg_ms': self.total_time / self.calls * 1000 if self.calls else 0.0,
+            'last_ms': self.last_time * 1000
+        }
+
+
+def create_face_backend(name, decode_scale=1):
+    """名前から顔検出バックエンドを作成（LBPが見つからなければHaarに戻す。縮小デコード時は最小サイズも縮小）"""
+    min_size = tuple(max(1, size // decode_scale) for size in FACE_MIN_SIZE)
+    if name == 'lbp':
+        lbp_dir = _find_cascade_dir('lbpcascades')
+        for filename in ('lbpcascade_frontalface_improved.xml', 'lbpcascade_frontalface.xml'):
+            backend = CascadeFaceBackend('lbp', lbp_dir + filename, min_size=min_size)
+            if backend.available():
+                return backend
+        print("警告: LBPカスケードが見つかりません（Haarを使用します）")
+    
+    return CascadeFaceBackend(
+        'haar', _find_cascade_dir('haarcascades') + 'haarcascade_frontalface_default.xml',
+        min_size=min_size
+    )
+
+
+class FaceDetectionScheduler:
+    """
+    顔・目検出のスケジューラ
+    全画面探索はNフレームごと、または顔を見失ったときのみ行い、
+    それ以外は前回の顔の周辺（ROI）だけを探索する
+    """
+    
+    def __init__(self, face_backend, eye_backend,
+                 full_interval=FACE_FULL_SEARCH_INTERVAL, roi_padding=FACE_ROI_PADDING):
+        self.face_backend = face_backend
+        self.eye_backend = eye_backend
+        self.full_interval = full_interval
+        self.roi_padding = roi_padding
+        
+        self.last_faces = []
+        self.frames_since_full = 0
+        
+        # 探索回数の統計
+        self.full_searches = 0
+        self.roi_searches = 0
+        self.roi_hits = 0
+    
+    def _tracking_roi(self, shape):
+        """前回の顔をすべて含む余白付きの探索領域を計算"""
+        h, w = shape[:2]
+        x0 = min(x - int(fw * self.roi_padding) for x, y, fw, fh in self.last_faces)
+        y0 = min(y - int(fh * self.roi_padding) for x, y, fw, fh in self.last_faces)
+        x1 = max(x + fw + int(fw * self.roi_padding) for x, y, fw, fh in self.last_faces)
+        y1 = max(y + fh + int(fh * self.roi_padding) for x, y, fw, fh in self.last_faces)
+        return max(0, x0), max(0, y0), min(w, x1), min(h, y1)
+    
+    def _search_faces(self, gray):
+        """ROI探索または全画面探索で顔を検出"""
+        if self.last_faces and self.frames_since_full < self.full_interval:
+            self.roi_searches += 1
+            x0, y0, x1, y1 = self._tracking_roi(gray.shape)
+            faces = self.face_backend.detect(gray[y0:y1, x0:x1])
+            if faces:
+                self.roi_hits += 1
+                self.frames_since_full += 1
+                return [(x + x0, y + y0, w, h) for (x, y, w, h) in faces]
+            # ROI内で見失った → 全画面探索へ
+        
+        self.full_searches += 1
+        self.frames_since_full = 0
+        return self.face_backend.detect(gray)
+    
+    def detect(self, gray):
+        """顔と目を検出して(faces, eyes)を返す（目は絶対座標）"""
+        faces = self._search_faces(gray)
+        self.last_faces = faces
+        
+        # 顔の領域内で目を検出
+        eyes = []
+        for (x, y, w, h) in faces:
+            for (ex, ey, ew, eh) in self.eye_backend.detect(gray[y:y+h, x:x+w]):
+                eyes.append((x + ex, y + ey, ew, eh))
+        return faces, eyes
+    
+    def get_stats(self):
+        """探索回数とバックエンドごとの処理時間を取得"""
+        return {
+            'backend': self.face_backend.name,
+            'full_searches': self.full_searches,
+            'roi_searches': self.roi_searches,
+            'roi_hits': self.roi_hits,
+            'timing': {
+                self.face_backend.name: self.face_backend.get_stats(),
+                'eye': self.eye_backend.get_stats()
+            }
+        }
+
+
+class MotionEngine:
+    """
+    フレーム差分による動き量の計算（update/calibrate共通）
+    縮小したフレームで処理し、動き量は元の解像度の画素数に換算して返す
+    （decode_scaleはJPEGの縮小デコード率。入力フレーム自体が縮小されている分も換算する）
+    履歴の平均は累積和で管理するためO(1)で取得できる
+    """
+    
+    def __init__(self, scale=MOTION_SCALE, history_size=MOTION_HISTORY_SIZE,
+                 use_background=MOTION_USE_BACKGROUND, background_alpha=MOTION_BACKGROUND_ALPHA,
+                 decode_scale=1):
+        self.scale = scale
+        self.decode_scale = decode_scale
+        self.use_background = use_background
+        self.background_alpha = background_alpha
+        
+        # ぼかしカーネルは元の解像度に対する縮小率に合わせて奇数サイズに
+        blur = max(3, int(MOTION_BLUR_SIZE * scale / decode_scale)) | 1
+        self.blur_size = (blur, blur)
+        
+        self.prev_frame = None
+        self.background = None  # 背景モデル（float32）
+        self.diff_frame = None
+        self.pixel_scale = 1.0  # 縮小フレーム1画素あたりの元画素数
+        
+        # 動きの履歴と累積和
+        self.history = deque(maxlen=history_size)
+        self.history_sum = 0.0
+        self.push_count = 0
+        
+        self.metrics = None  # 処理時間の計測（--metrics時）
+    
+    def _prepare(self, gray):
+        """縮小してノイズ除去"""
+        if self.scale != 1.0:
+            small = cv2.resize(gray, None, fx=self.scale, fy=self.scale,
+                               interpolation=cv2.INTER_AREA)
+        else:
+            small = gray
+        self.pixel_scale = gray.size / small.size * self.decode_scale ** 2
+        return cv2.GaussianBlur(small, self.blur_size, 0)
+    
+    def process(self, gray, record=True):
+        """フレームを処理して動き量を返す（初回はNone）"""
+        m = self.metrics
+        t0 = time.perf_counter() if m else 0.0
+        blurred = self._prepare(gray)
+        if m:
+            t0 = m.lap('motion_blur', t0)
+        motion_level = None
+        
+        if self.use_background and self.background is not None:
+            reference = cv2.convertScaleAbs(self.background)
+        else:
+            reference = self.prev_frame
+        
+        if reference is not None:
+            self.diff_frame = cv2.absdiff(reference, blurred)
+            _, thresh = cv2.threshold(self.diff_frame, MOTION_DIFF_THRESHOLD, 255, cv2.THRESH_BINARY)
+            motion_level = cv2.countNonZero(thresh) * self.pixel_scale  # 元解像度のピクセル数
+            if record:
+                self.push(motion_level)
+        
+        # 比較対象を更新
+        self.prev_frame = blurred
+        if self.use_background:
+            if self.background is None:
+                self.background = blurred.astype(np.float32)
+            else:
+                cv2.accumulateWeighted(blurred, self.background, self.background_alpha)
+        
+        if m:
+            m.lap('motion_diff', t0)
+        return motion_level
+    
+    def push(self, motion_level):
+        """履歴に追加（累積和を更新）"""
+        if len(self.history) == self.history.maxlen:
+            self.history_sum -= self.history[0]
+        self.history.append(motion_level)
+        self.history_sum += motion_level
+        
+        # 浮動小数点誤差の蓄積を防ぐため定期的に再計算
+        self.push_count += 1
+        if self.push_count % 10000 == 0:
+            self.history_sum = float(sum(self.history))
+    
+    def mean(self):
+        """履歴の平均"""
+        return self.history_sum / len(self.history) if self.history else 0
+    
+    def reset(self):
+        """比較フレームと履歴をクリア"""
+        self.prev_frame = None
+        self.background = None
+        self.diff_frame = None
+        self.history.clear()
+        self.history_sum = 0.0
+
+
+class RunningStats:
+    """
+    平均・分散の逐次計算
+    サンプル数が少ない間はWelford法（全サンプル等重み）、その後は時定数に応じた指数移動平均になる
+    """
+    
+    def __init__(self, time_constant=ADAPT_TIME_CONSTANT):
+        self.time_constant = time_constant
+        self.reset()
+    
+    def reset(self):
+        self.count = 0
+        self.mean = 0.0
+        self.var = 0.0
+    
+    def update(self, value, dt=0.0):
+        """サンプルを追加（dtは前回からの経過秒数）"""
+        self.count += 1
+        alpha = max(1.0 / self.count, 1.0 - np.exp(-dt / self.time_constant))
+        delta = value - self.mean
+        self.mean += alpha * delta
+        self.var = (1.0 - alpha) * (self.var + alpha * delta * delta)
+    
+    @property
+    def std(self):
+        return float(np.sqrt(self.var))
+
+
+class AdaptiveThreshold:
+    """
+    静かな・動きのない区間の統計から閾値（平均 + k×標準偏差）を上下限内で更新
+    イベント中のサンプルは統計に入れない（呼び出し側が更新前の閾値で判定してからofferを呼ぶ）
+    統計が揃うまではイベント判定に関係なく全サンプルを使う（キャリブレーション省略時の立ち上がり）
+    level_shift_secondsを指定すると、イベントがその秒数以上途切れずに続いた場合は背景レベルが
+    変わったとみなして統計に入れる（指定しなければイベント中のサンプルは入れない）
+    """
+    
+    def __init__(self, sigma, bounds, time_constant=ADAPT_TIME_CONSTANT,
+                 accept_sigma=None, level_shift_seconds=None):
+        self.sigma = sigma
+        self.bounds = bounds
+        self.accept_sigma = sigma if accept_sigma is None else accept_sigma
+        self.level_shift_seconds = level_shift_seconds
+        self.stats = RunningStats(time_constant)
+        self.skipped = 0  # イベントとして統計に入れなかったサンプル数
+        self.event_run = 0.0  # イベントが途切れずに続いている秒数
+    
+    def value(self):
+        """現在の統計から求めた閾値"""
+        stats = self.stats
+        return float(np.clip(stats.mean + self.sigma * stats.std, *self.bounds))
+    
+    def ready(self):
+        return self.stats.count >= ADAPT_MIN_SAMPLES
+    
+    def limit(self):
+        """統計に入れるサンプルの上限（呼び出し側のイベント判定用）"""
+        stats = self.stats
+        return float(np.clip(stats.mean + self.accept_sigma * stats.std, *self.bounds))
+    
+    def clamp(self, value):
+        """閾値を上下限内に収める（初期値用）"""
+        return float(np.clip(value, *self.bounds))
+    
+    def offer(self, sample, event, dt):
+        """サンプルを渡す。統計が揃っていればイベント中のサンプルは数えるだけにする"""
+        if not event:
+            self.event_run = 0.0
+        elif self.ready():
+            self.event_run += dt
+            if self.level_shift_seconds is None or self.event_run < self.level_shift_seconds:
+                self.skip()
+                return
+        self.update(sample, dt)
+    
+    def update(self, sample, dt):
+        """静かな（イベントでない）サンプルを追加（dtは前回の更新またはskipからの経過秒数）"""
+        self.stats.update(sample, dt)
+    
+    def skip(self):
+        """イベント中のサンプルを統計に入れずに数える"""
+        self.skipped += 1
+    
+    def seed(self, samples):
+        """キャリブレーションのサンプルで統計を作り直して閾値を返す"""
+        self.stats.reset()
+        for sample in samples:
+            self.stats.update(sample)
+        return self.value()
+    
+    def snapshot(self, current):
+        """ステータスファイル用の値"""
+        return {
+            'value': float(current),
+            'mean': round(float(self.stats.mean), 1),
+            'std': round(self.stats.std, 1),
+            'samples': self.stats.count,
+            'skipped': self.skipped
+        }
+
+
+def _libcamera_command(width, height):
+    """libcamera-vidをMJPEGでstdoutへ出力するコマンド"""
+    return [
+        "libcamera-vid",
+        "-t", "0",  # 無限に実行
+        "--width", str(width),
+        "--height", str(height),
+        "--codec", "mjpeg",
+        "--framerate", "15",
+        "-n",  # プレビューなし
+        "-o", "-"  # stdout出力
+    ]
+
+
+class SharedFrameRing:
+    """
+    共有メモリ上のグレースケールフレームリング（シーケンス番号付き）
+    書き込みは子プロセス1つ、読み出しはメインプロセス1つを想定
+    スロットへの書き込みと読み出し側のコピーはプロセス間ロック（セマフォ）で排他する
+    （Pythonからは共有メモリへの書き込み順を保証できず、ARMなどではシーケンス番号だけだと
+    破れたフレームが確認をすり抜けうる。ロックの取得・解放がメモリバリアになる）
+    ロックなしで作ったリング（同じプロセス内のテスト用）はコピー後のシーケンス番号の確認だけで、
+    その場合は破れたフレームを読む可能性が残る。読み出し側はコピーを返すので、close後に
+    共有メモリを参照するビューは残さない
+    """
+    
+    # ヘッダー（int64）のインデックス
+    LATEST_SEQ = 0
+    STAT_PRODUCED = 1
+    STAT_DECODED = 2
+    STAT_DROPPED = 3
+    STAT_BYTES = 4
+    STAT_RESYNCS = 5
+    STAT_CORRUPT = 6
+    HEADER_FIELDS = 8
+    
+    def __init__(self, shm, shape, slots, owner, lock=None):
+        self.shm = shm
+        self.shape = tuple(shape)
+        self.slots = slots
+        self.owner = owner
+        self.lock = lock  # multiprocessingのLock（子プロセスへはProcessの引数で渡す）
+        self.torn_reads = 0  # コピー中に上書きされて捨てたフレーム数（読み出し側）
+        
+        header_size = (self.HEADER_FIELDS + slots) * 8
+        self.header = np.ndarray((self.HEADER_FIELDS,), dtype=np.int64, buffer=shm.buf)
+        self.slot_seq = np.ndarray((slots,), dtype=np.int64, buffer=shm.buf,
+                                   offset=self.HEADER_FIELDS * 8)
+        self.frames = np.ndarray((slots,) + self.shape, dtype=np.uint8, buffer=shm.buf,
+                                 offset=header_size)
+    
+    @classmethod
+    def create(cls, shape, slots=CAMERA_RING_SLOTS, lock=None):
+        """リングを新規作成（メインプロセス側）"""
+        size = (cls.HEADER_FIELDS + slots) * 8 + slots * int(np.prod(shape))
+        shm = shared_memory.SharedMemory(create=True, size=size)
+        ring = cls(shm, shape, slots, owner=True, lock=lock)
+        ring.header[:] = 0
+        ring.slot_seq[:] = 0
+        return ring
+    
+    @classmethod
+    def attach(cls, name, shape, slots=CAMERA_RING_SLOTS, lock=None):
+        """既存のリングに接続（子プロセス側、解放は作成側が行う）"""
+        try:
+            shm = shared_memory.SharedMemory(name=name, track=False)
+        except TypeError:
+            # Python 3.12以前（multiprocessingの子プロセスは親のresource_trackerを共有する）
+            shm = shared_memory.SharedMemory(name=name)
+        return cls(shm, shape, slots, owner=False, lock=lock)
+    
+    @property
+    def name(self):
+        return self.shm.name
+    
+    def write(self, frame):
+        """フレームを次のスロットへ書き込み、シーケンス番号を返す"""
+        seq = int(self.header[self.LATEST_SEQ]) + 1
+        slot = seq % self.slots
+        # 変換は共有メモリの外で済ませ、ロック中はコピーだけにする
+        if frame.shape != self.shape:
+            frame = cv2.resize(frame, (self.shape[1], self.shape[0]))
+        if self.lock is not None:
+            self.lock.acquire()
+        try:
+            self.slot_seq[slot] = -1  # 書き込み中
+            np.copyto(self.frames[slot], frame)
+            self.slot_seq[slot] = seq
+            self.header[self.LATEST_SEQ] = seq
+        finally:
+            if self.lock is not None:
+                self.lock.release()
+        return seq
+    
+    def latest_seq(self):
+        """最新フレームのシーケンス番号（まだなければ0）"""
+        return int(self.header[self.LATEST_SEQ])
+    
+    def read_latest(self):
+        """最新フレームを(シーケンス番号, コピー)で返す（コピー中に上書きされたらNone）"""
+        # 書き込み側がロックを保持したまま異常終了しても止まらないよう、待ち時間を区切る
+        if self.lock is not None and not self.lock.acquire(timeout=FRAME_WAIT_TIMEOUT):
+            return None
+        try:
+            seq = int(self.header[self.LATEST_SEQ])
+            if seq == 0:
+                return None
+            slot = seq % self.slots
+            if self.slot_seq[slot] != seq:
+                return None
+            frame = self.frames[slot].copy()
+            if not self.is_valid(seq):
+                # 子プロセスがリングを一周して同じスロットに書き込み始めた（ロックなしのときのみ）
+                self.torn_reads += 1
+                return None
+            return seq, frame
+        finally:
+            if self.lock is not None:
+                self.lock.release()
+    
+    def is_valid(self, seq):
+        """読み出したフレームがまだ上書きされていないか"""
+        return self.slot_seq[seq % self.slots] == seq
+    
+    def close(self):
+        """共有メモリを閉じる（作成側は削除も行う）"""
+        # ビューを先に解放しないとcloseできない
+        self.header = self.slot_seq = self.frames = None
+        self.shm.close()
+        if self.owner:
+            try:
+                self.shm.unlink()
+            except FileNotFoundError:
+                pass
+
+
+def _camera_process_main(ring_name, shape, slots, width, height, decode_flag,
+                         stop_event, frame_ready_event, ring_lock):
+    """子プロセス: libcameraのMJPEGを読み取り、最新フレームをデコードしてリングへ書き込む"""
+    signal.signal(signal.SIGINT, signal.SIG_IGN)  # 終了はstop_eventで親から指示
+    ring = SharedFrameRing.attach(ring_name, shape, slots, lock=ring_lock)
+    process = subprocess.Popen(
+        _libcamera_command(width, height),
+        stdout=subprocess.PIPE,
+        stderr=subprocess.DEVNULL,
+        bufsize=10**6
+    )
+    demuxer = MjpegDemuxer()
+    header = ring.header
+    try:
+        while not stop_event.is_set():
+            if demuxer.read_from(process.stdout, MJPEG_READ_SIZE) == 0:
+                if process.poll() is not None:
+                    print("カメラプロセス: libcamera-vidが終了しました")
+                    break
+                continue
+            
+            # 今回の読み込みで完成したフレームのうち最新のものだけをデコード
+            newest = None
+            for jpeg_data in demuxer.frames():
+                header[SharedFrameRing.STAT_PRODUCED] += 1
+                if newest is not None:
+                    header[SharedFrameRing.STAT_DROPPED] += 1
+                newest = jpeg_data
+            
+            if newest is not None:
+                frame = cv2.imdecode(np.frombuffer(newest, np.uint8), decode_flag)
+                if frame is not None:
+                    header[SharedFrameRing.STAT_DECODED] += 1
+                    ring.write(frame)
+                    frame_ready_event.set()
+                else:
+                    demuxer.corrupt_frames += 1
+            
+            header[SharedFrameRing.STAT_BYTES] = demuxer.bytes_total
+            header[SharedFrameRing.STAT_RESYNCS] = demuxer.resyncs
+            header[SharedFrameRing.STAT_CORRUPT] = demuxer.corrupt_frames
+    finally:
+        try:
+            process.terminate()
+            process.wait(timeout=2)
+        except Exception:
+            process.kill()
+        header = None  # 共有メモリを参照するビューを残さない
+        ring.close()
+
+
+# セッション記録のインデックス形式（リプレイ用）
+CAMERA_INDEX_DTYPE = np.dtype([('t', '<f8'), ('offset', '<u8'), ('length', '<u4')])
+AUDIO_INDEX_DTYPE = np.dtype([('t', '<f8'), ('sample', '<u8'), ('count', '<u4')])
+
+
+class SessionRecorder:
+    """
+    カメラのMJPEGバイト列とint16 PCM音声を取得時刻付きで保存（リプレイ用）
+    
+    保存先ディレクトリの構成:
+      session.json      … サンプリングレート・閾値などのメタデータ
+      camera.mjpeg      … JPEGフレームを連結したMJPEGストリーム
+      camera_index.bin  … フレームごとの(時刻, オフセット, 長さ)
+      audio.pcm         … int16 PCM（複数チャンネルはインターリーブ）
+      audio_index.bin   … チャンクごとの(時刻, 先頭サンプル番号, サンプル数)（複数チャンネルはフレーム単位）
+    """
+    
+    def __init__(self, directory):
+        self.directory = directory
+        os.makedirs(directory, exist_ok=True)
+        self.camera_lock = threading.Lock()
+        self.audio_lock = threading.Lock()
+        
+        self.camera_file = open(os.path.join(directory, 'camera.mjpeg'), 'wb')
+        self.camera_index = open(os.path.join(directory, 'camera_index.bin'), 'wb')
+        self.camera_offset = 0
+        
+        self.audio_file = open(os.path.join(directory, 'audio.pcm'), 'wb')
+        self.audio_index = open(os.path.join(directory, 'audio_index.bin'), 'wb')
+        self.audio_samples = 0
+        
+        self.metadata = {'version': 1, 'created': datetime.now().strftime('%Y-%m-%d %H:%M:%S')}
+    
+    def write_jpeg(self, jpeg_data, timestamp):
+        """JPEGフレームを1枚記録"""
+        with self.camera_lock:
+            if self.camera_file.closed:
+                return
+            length = len(jpeg_data)
+            self.camera_file.write(jpeg_data)
+            entry = np.array([(timestamp, self.camera_offset, length)], dtype=CAMERA_INDEX_DTYPE)
+            self.camera_index.write(entry.tobytes())
+            self.camera_offset += length
+    
+    def write_audio(self, audio_data, timestamp):
+        """音声チャンクを1つ記録"""
+        with self.audio_lock:
+            if self.audio_file.closed:
+                return
+            self.audio_file.write(audio_data.astype('<i2', copy=False).tobytes())
+            entry = np.array([(timestamp, self.audio_samples, len(audio_data))], dtype=AUDIO_INDEX_DTYPE)
+            self.audio_index.write(entry.tobytes())
+            self.audio_samples += len(audio_data)
+    
+    def update_metadata(self, **values):
+        """メタデータを追加（閉じるときに保存）"""
+        self.metadata.update(values)
+    
+    def close(self):
+        """ファイルを閉じてメタデータを保存"""
+        with self.camera_lock:
+            self.camera_file.close()
+            self.camera_index.close()
+        with self.audio_lock:
+            self.audio_file.close()
+            self.audio_index.close()
+        with open(os.path.join(self.directory, 'session.json'), 'w', encoding='utf-8') as f:
+            json.dump(self.metadata, f, ensure_ascii=False, indent=2)
+        print(f"セッションを記録しました: {self.directory}")
+
+
+def night_of(timestamp):
+    """時刻（UNIX秒）が属する夜の日付（NIGHT_BOUNDARY_HOURより前は前日）"""
+    moment = datetime.fromtimestamp(timestamp) - timedelta(hours=NIGHT_BOUNDARY_HOUR)
+    return moment.strftime('%Y-%m-%d')
+
+
+class SnoreClipRecorder:
+    """
+    いびき開始前後の音声をクリップとして保存
+    直近の音声を事前確保したリング（プリロール）に保持し、睡眠判定が記録したいびきの立ち上がり（取得時刻）から
+    前SNORE_CLIP_PRE_SECONDS秒・後SNORE_CLIP_POST_SECONDS秒を切り出して、別スレッドでgzip圧縮したWAVに書き込む
+    feedは音声スレッド、triggerはメインループから呼ばれる
+    夜ごと・全体の容量上限を超えたら古いクリップから削除する
+    
+    保存先の構成: DIR/夜の日付/snore_YYYYmmdd_HHMMSS_mmm.wav.gz
+    """
+    
+    def __init__(self, directory, rate, channels=1, pre_seconds=SNORE_CLIP_PRE_SECONDS,
+                 post_seconds=SNORE_CLIP_POST_SECONDS, night_quota_mb=SNORE_CLIP_NIGHT_QUOTA_MB,
+                 total_quota_mb=SNORE_CLIP_TOTAL_QUOTA_MB):
+        self.directory = directory
+        self.rate = rate
+        self.channels = channels
+        self.pre_samples = int(pre_seconds * rate)
+        self.post_samples = int(post_seconds * rate)
+        self.night_quota = int(night_quota_mb * 1024 * 1024)
+        self.total_quota = int(total_quota_mb * 1024 * 1024)
+        
+        # プリロールのリング（クリップ全体＋チャンク1つ分の余裕。チャンクはこれより短い前提）
+        self.capacity = self.pre_samples + self.post_samples + rate
+        self.buffer = np.zeros((self.capacity, channels) if channels > 1 else self.capacity, dtype=np.int16)
+        self.written = 0  # 通算サンプル数
+        self.last_chunk = None  # 最後に追加したチャンク（先頭の通算サンプル番号, 取得時刻）
+        self.pending = None  # 書き込み待ちのクリップ（開始サンプル, 終了サンプル, 立ち上がり時刻）
+        self.feed_lock = threading.Lock()  # リングと予約の更新用（feedとtriggerはスレッドが異なる）
+        
+        # 保存済みクリップの一覧（古い順）と容量
+        os.makedirs(directory, exist_ok=True)
+        self.clips = deque()  # (パス, 夜, バイト数)
+        self.night_bytes = {}
+        self.total_bytes = 0
+        self._scan()
+        
+        self.clips_written = 0
+        self.clips_evicted = 0
+        
+        # 書き込みスレッド（解析スレッドを圧縮・ディスクI/Oで止めない）
+        self.queue = queue.Queue()
+        self.lock = threading.Lock()  # 一覧・容量の更新用
+        self.thread = threading.Thread(target=self._writer_loop, daemon=True)
+        self.thread.start()
+    
+    def _scan(self):
+        """起動時に既存のクリップを読み込む（ファイル名が時刻順）"""
+        entries = []
+        for night in sorted(os.listdir(self.directory)):
+            night_dir = os.path.join(self.directory, night)
+            if not os.path.isdir(night_dir):
+                continue
+            for name in sorted(os.listdir(night_dir)):
+                if name.endswith('.wav.gz'):
+                    path = os.path.join(night_dir, name)
+                    entries.append((name, path, night, os.path.getsize(path)))
+        for _, path, night, size in sorted(entries):
+            self._add(path, night, size)
+    
+    def _add(self, path, night, size):
+        self.clips.append((path, night, size))
+        self.night_bytes[night] = self.night_bytes.get(night, 0) + size
+        self.total_bytes += size
+    
+    def feed(self, audio_data, timestamp):
+        """1チャンク分の音声を追加（timestampはチャンクの取得時刻）"""
+        n = len(audio_data)
+        with self.feed_lock:
+            start = self.written % self.capacity
+            first = min(n, self.capacity - start)
+            self.buffer[start:start + first] = audio_data[:first]
+            self.buffer[:n - first] = audio_data[first:]
+            self.last_chunk = (self.written, timestamp)
+            self.written += n
+            
+            if self.pending is not None and self.written >= self.pending[1]:
+                self._emit()
+    
+    def trigger(self, onset_time):
+        """取得時刻onset_timeのいびき開始についてクリップを予約（処理の遅れの分さかのぼる）"""
+        with self.feed_lock:
+            # クリップの途中の立ち上がりは同じクリップに含まれるので新しく予約しない
+            if self.pending is not None or self.last_chunk is None:
+                return
+            chunk_start, chunk_time = self.last_chunk
+            onset = chunk_start + int(round((onset_time - chunk_time) * self.rate))
+            onset = min(max(onset, self.written - self.capacity), self.written)
+            # 以降のチャンク（1秒以内）で上書きされない範囲から切り出す
+            begin = max(0, onset - self.pre_samples, self.written + self.rate - self.capacity)
+            self.pending = (begin, onset + self.post_samples, onset_time)
+            if self.written >= self.pending[1]:
+                self._emit()
+    
+    def _extract(self, begin, end):
+        """リングから[begin, end)のサンプルをコピー"""
+        start = begin % self.capacity
+        count = end - begin
+        first = min(count, self.capacity - start)
+        return np.concatenate((self.buffer[start:start + first], self.buffer[:count - first]))
+    
+    def _emit(self):
+        """予約したクリップを切り出して書き込みスレッドへ渡す"""
+        begin, end, timestamp = self.pending
+        self.pending = None
+        self.queue.put((self._extract(begin, min(end, self.written)), timestamp))
+    
+    def _writer_loop(self):
+        while True:
+            item = self.queue.get()
+            if item is None:
+                break
+            try:
+                self._write_clip(*item)
+            except OSError as e:
+                print(f"警告: いびきクリップの保存に失敗: {e}")
+    
+    def _write_clip(self, samples, timestamp):
+        """gzip圧縮したWAV（可逆）として保存し、容量上限を超えた分を削除"""
+        night = night_of(timestamp)
+        night_dir = os.path.join(self.directory, night)
+        os.makedirs(night_dir, exist_ok=True)
+        moment = datetime.fromtimestamp(timestamp)
+        path = os.path.join(night_dir, f"snore_{moment.strftime('%Y%m%d_%H%M%S')}_{moment.microsecond // 1000:03d}.wav.gz")
+        
+        with gzip.open(path, 'wb', compresslevel=6) as f:
+            with wave.open(f, 'wb') as wav:
+                wav.setnchannels(self.channels)
+                wav.setsampwidth(2)
+                wav.setframerate(self.rate)
+                wav.setnframes(len(samples))
+                wav.writeframes(samples.astype('<i2', copy=False).tobytes())
+        
+        with self.lock:
+            self._add(path, night, os.path.getsize(path))
+            self.clips_written += 1
+            self._evict(night)
+    
+    def _evict(self, night):
+        """夜ごと・全体の容量上限を超えていれば古いクリップから削除"""
+        while self.night_bytes.get(night, 0) > self.night_quota:
+            # その夜の最も古いクリップ（一覧は古い順）
+            entry = next(e for e in self.clips if e[1] == night)
+            self._remove(entry)
+        while self.total_bytes > self.total_quota and self.clips:
+            self._remove(self.clips[0])
+    
+    def _remove(self, entry):
+        path, night, size = entry
+        self.clips.remove(entry)
+        self.night_bytes[night] -= size
+        self.total_bytes -= size
+        self.clips_evicted += 1
+        try:
+            os.remove(path)
+            os.rmdir(os.path.dirname(path))  # 空になった夜のディレクトリも削除
+        except OSError:
+            pass
+    
+    def get_stats(self):
+        """保存状況（ステータスファイル用）"""
+        with self.lock:
+            return {
+                'clips': len(self.clips),
+                'total_mb': round(self.total_bytes / (1024 * 1024), 2),
+                'written': self.clips_written,
+                'evicted': self.clips_evicted
+            }
+    
+    def close(self):
+        """録音途中のクリップも書き出してから書き込みスレッドを終了"""
+        with self.feed_lock:
+            if self.pending is not None:
+                self._emit()
+        self.queue.put(None)
+        self.thread.join(timeout=10)
+
+
+# 特徴量の列（名前, 型, 1秒内の集約方法）
+FEATURE_COLUMNS = [
+    ('valid', '<u1', 'max'),  # この秒の値があるか（0なら未記録）
+    ('motion_level', '<f4', 'max'),
+    ('volume', '<f4', 'mean'),
+    ('snore_power', '<f4', 'max'),
+    ('breathing_power', '<f4', 'mean'),
+    ('breathing_rate', '<f4', 'last'),  # 推定できなければNaN
+    ('breathing_confidence', '<f4', 'last'),
+    ('motion', '<u1', 'max'),
+    ('face', '<u1', 'max'),
+    ('eyes_open', '<u1', 'max'),
+    ('silent', '<u1', 'min'),
+    ('snore', '<u1', 'max'),
+    ('sleeping', '<u1', 'last'),
+]
+FEATURE_ROWS = 24 * 3600  # 一晩分の行数（1行 = 1秒、NIGHT_BOUNDARY_HOURから24時間）
+
+
+def night_start(night):
+    """夜の日付の開始時刻（UNIX秒）"""
+    moment = datetime.strptime(night, '%Y-%m-%d') + timedelta(hours=NIGHT_BOUNDARY_HOUR)
+    return moment.timestamp()
+
+
+def load_features(night, directory=FEATURE_STORE_DIR):
+    """
+    一晩分の特徴量を列ごとの読み取り専用メモリマップで返す（コピーなし）
+    行番号は夜の開始からの秒数。未記録の行はvalidが0
+    """
+    night_dir = os.path.join(directory, night)
+    return {name: np.load(os.path.join(night_dir, f"{name}.npy"), mmap_mode='r')
+            for name, _, _ in FEATURE_COLUMNS
+            if os.path.exists(os.path.join(night_dir, f"{name}.npy"))}
+
+
+class FeatureStore:
+    """
+    1秒ごとに集約した特徴量の時系列を夜ごとのディレクトリに列ごとの.npyとして保存
+    各列は一晩分の行数で作成したメモリマップで、夜の開始からの秒数の行に直接書き込む（追記はO(1)で再シリアライズなし）
+    読み出し側はload_featuresで列をそのままスライスできる
+    新しい夜を開くたびに全体の容量上限を確認し、超えていれば古い夜から削除する
+    
+    保存先の構成: DIR/夜の日付/列名.npy
+    """
+    
+    def __init__(self, directory=FEATURE_STORE_DIR, quota_mb=FEATURE_STORE_QUOTA_MB):
+        self.directory = directory
+        self.quota = int(quota_mb * 1024 * 1024)
+        self.nights_evicted = 0
+        self.night = None
+        self.start = 0.0  # 夜の開始時刻
+        self.columns = {}  # 列名 → メモリマップ
+        
+        # 集約中の秒と値（列ごとの合計・件数・最大・最小・最後の値）
+        self.second = None
+        self.count = 0
+        self.values = {}
+        self.rows_written = 0
+    
+    def _open_night(self, night):
+        """夜の列ファイルを開く（なければ作成。未使用の領域はファイルシステムが0で埋める）"""
+        self._flush_columns()
+        night_dir = os.path.join(self.directory, night)
+        os.makedirs(night_dir, exist_ok=True)
+        self.columns = {}
+        for name, dtype, _ in FEATURE_COLUMNS:
+            path = os.path.join(night_dir, f"{name}.npy")
+            if os.path.exists(path):
+                self.columns[name] = np.lib.format.open_memmap(path, mode='r+')
+            else:
+                self.columns[name] = np.lib.format.open_memmap(path, mode='w+', dtype=dtype, shape=(FEATURE_ROWS,))
+        self.night = night
+        self.start = night_start(night)
+        self._evict()
+    
+    def _evict(self):
+        """全体の容量上限を超えていれば古い夜から削除（記録中の夜は残す）"""
+        nights = []
+        for night in sorted(os.listdir(self.directory)):
+            night_dir = os.path.join(self.directory, night)
+            if os.path.isdir(night_dir):
+                size = sum(os.path.getsize(os.path.join(night_dir, name)) for name in os.listdir(night_dir))
+                nights.append((night, night_dir, size))
+        
+        total = sum(size for _, _, size in nights)
+        for night, night_dir, size in nights:
+            if total <= self.quota:
+                break
+            if night == self.night:
+                continue
+            shutil.rmtree(night_dir, ignore_errors=True)
+            total -= size
+            self.nights_evicted += 1
+    
+    def record(self, timestamp, values):
+        """1サンプル分の値を追加（秒が変わったら前の秒を集約して書き込む）"""
+        second = int(timestamp)
+        if second != self.second:
+            self._write_second()
+            self.second = second
+            self.count = 0
+        
+        self.count += 1
+        for name, _, how in FEATURE_COLUMNS[1:]:
+            value = values.get(name)
+            value = np.nan if value is None else float(value)
+            if self.count == 1 or how == 'last':
+                self.values[name] = value
+            elif how == 'mean':
+                self.values[name] += value  # 書き込み時に件数で割る
+            elif how == 'max':
+                self.values[name] = max(self.values[name], value)
+            else:
+                self.values[name] = min(self.values[name], value)
+    
+    def _write_second(self):
+        """集約した1秒分を夜の開始からの秒数の行に書き込む"""
+        if self.second is None or self.count == 0:
+            return
+        night = night_of(self.second)
+        if night != self.night:
+            self._open_night(night)
+        row = self.second - int(self.start)
+        if not 0 <= row < FEATURE_ROWS:
+            return  # 夏時間の切り替えなどで範囲外
+        
+        for name, _, how in FEATURE_COLUMNS[1:]:
+            value = self.values[name]
+            if how == 'mean':
+                value /= self.count
+            self.columns[name][row] = value
+        self.columns['valid'][row] = 1  # 値を書いてから有効にする
+        self.rows_written += 1
+    
+    def _flush_columns(self):
+        for column in self.columns.values():
+            column.flush()
+    
+    def close(self):
+        """集約中の秒を書き込んでファイルに反映"""
+        self._write_second()
+        self.second = None
+        self._flush_columns()
+        self.columns = {}
+
+
+CSV_HEADER = ['date', 'sleep_start', 'sleep_end', 'duration_hours', 'duration_minutes', 'snore_detected']
+
+
+class SleepRecordStore:
+    """
+    睡眠区間のSQLiteストア（WALモード）
+    開始日時・終了日時を日付付きで保持し、日付のインデックスで期間指定の検索を行う
+    日ごとの集計（daily_summary）は区間の追加と同じトランザクションで差分更新する
+    Webからの読み取りは書き込み中でもブロックされない
+    """
+    
+    SCHEMA = """
+        CREATE TABLE IF NOT EXISTS sleep_sessions (
+            id INTEGER PRIMARY KEY,
+            date TEXT NOT NULL,             -- 開始日（CSVのdate列と同じ）
+            night TEXT NOT NULL,            -- 夜の日付（NIGHT_BOUNDARY_HOUR前は前日）
+            sleep_start TEXT NOT NULL UNIQUE,
+            sleep_end TEXT NOT NULL,
+            duration_seconds REAL NOT NULL,
+            snore_detected INTEGER NOT NULL
+        );
+        CREATE INDEX IF NOT EXISTS idx_sleep_sessions_date ON sleep_sessions(date);
+        CREATE INDEX IF NOT EXISTS idx_sleep_sessions_night ON sleep_sessions(night);
+        CREATE TABLE IF NOT EXISTS timeline_segments (
+            id INTEGER PRIMARY KEY,
+            night TEXT NOT NULL,
+            state TEXT NOT NULL,            -- TIMELINE_STATESのいずれか
+            start TEXT NOT NULL,            -- 日付付きの時刻（エポック境界）
+            end TEXT NOT NULL
+        );
+        CREATE INDEX IF NOT EXISTS idx_timeline_segments_night ON timeline_segments(night, start);
+        CREATE TABLE IF NOT EXISTS daily_summary (
+            date TEXT PRIMARY KEY,
+            total_seconds REAL NOT NULL,
+            sessions INTEGER NOT NULL,
+            snore_detected INTEGER NOT NULL,
+            sleep_start TEXT NOT NULL,      -- 最初の就寝
+            sleep_end TEXT NOT NULL         -- 最後の起床
+        );
+    """
+    
+    def __init__(self, path=SLEEP_DB_FILE):
+        self.path = path
+        self.conn = sqlite3.connect(path, timeout=5)
+        self.conn.row_factory = sqlite3.Row
+        self.conn.execute("PRAGMA journal_mode=WAL")
+        self.conn.execute("PRAGMA synchronous=NORMAL")  # WALではコミットごとのfsyncを省略しても壊れない
+        self.conn.executescript(self.SCHEMA)
+        self._build_daily_summary()
+    
+    def _build_daily_summary(self):
+        """日ごとの集計が空なら睡眠区間から作り直す（集計を持たないデータベースから移行したとき）"""
+        if self.conn.execute("SELECT 1 FROM daily_summary LIMIT 1").fetchone():
+            return
+        with self.conn:
+            self.conn.execute(
+                "INSERT INTO daily_summary SELECT date, SUM(duration_seconds), COUNT(*), "
+                "MAX(snore_detected), MIN(sleep_start), MAX(sleep_end) FROM sleep_sessions GROUP BY date"
+            )
+    
+    def add(self, start, end, snore):
+        """睡眠区間を1件追加して日ごとの集計を更新（開始時刻が同じ記録は無視）。追加したらTrue"""
+        date = start.strftime('%Y-%m-%d')
+        sleep_start = start.strftime('%Y-%m-%d %H:%M:%S')
+        sleep_end = end.strftime('%Y-%m-%d %H:%M:%S')
+        seconds = (end - start).total_seconds()
+        with self.conn:
+            cursor = self.conn.execute(
+                "INSERT OR IGNORE INTO sleep_sessions "
+                "(date, night, sleep_start, sleep_end, duration_seconds, snore_detected) "
+                "VALUES (?, ?, ?, ?, ?, ?)",
+                (date, night_of(start.timestamp()), sleep_start, sleep_end, seconds, int(bool(snore)))
+            )
+            if cursor.rowcount == 0:
+                return False
+            self.conn.execute(
+                "INSERT INTO daily_summary VALUES (?, ?, 1, ?, ?, ?) "
+                "ON CONFLICT(date) DO UPDATE SET "
+                "total_seconds = total_seconds + excluded.total_seconds, sessions = sessions + 1, "
+                "snore_detected = MAX(snore_detected, excluded.snore_detected), "
+                "sleep_start = MIN(sleep_start, excluded.sleep_start), "
+                "sleep_end = MAX(sleep_end, excluded.sleep_end)",
+                (date, seconds, int(bool(snore)), sleep_start, sleep_end)
+            )
+        return True
+    
+    @staticmethod
+    def _range(date_from, date_to):
+        """期間指定のWHERE句（日付はYYYY-MM-DD、両端を含む）"""
+        conditions, params = [], []
+        if date_from:
+            conditions.append("date >= ?")
+            params.append(date_from)
+        if date_to:
+            conditions.append("date <= ?")
+            params.append(date_to)
+        return (" WHERE " + " AND ".join(conditions)) if conditions else "", params
+    
+    def sessions(self, date_from=None, date_to=None, limit=None):
+        """期間内の睡眠区間を開始時刻順に返す（limit指定時は新しいものからlimit件）"""
+        where, params = self._range(date_from, date_to)
+        sql = f"SELECT * FROM sleep_sessions{where} ORDER BY sleep_start"
+        if limit:
+            sql = f"SELECT * FROM ({sql} DESC LIMIT ?) ORDER BY sleep_start"
+            params.append(limit)
+        return [dict(row) for row in self.conn.execute(sql, params)]
+    
+    def daily(self, date_from=None, date_to=None, limit=None):
+        """
+        日ごとの集計（合計睡眠時間・区間数・いびきの有無・最初の就寝・最後の起床）を日付順に返す
+        limit指定時は記録のある新しい日からlimit日分
+        """
+        where, params = self._range(date_from, date_to)
+        sql = f"SELECT * FROM daily_summary{where} ORDER BY date"
+        if limit:
+            sql = f"SELECT * FROM ({sql} DESC LIMIT ?) ORDER BY date"
+            params.append(limit)
+        return [dict(row) for row in self.conn.execute(sql, params)]
+    
+    def count(self):
+        return self.conn.execute("SELECT COUNT(*) FROM sleep_sessions").fetchone()[0]
+    
+    def add_segment(self, night, state, start, end):
+        """タイムラインの区間を追加してidを返す（start/endはUNIX秒）"""
+        with self.conn:
+            cursor = self.conn.execute(
+                "INSERT INTO timeline_segments (night, state, start, end) VALUES (?, ?, ?, ?)",
+                (night, state, _format_time(start), _format_time(end))
+            )
+        return cursor.lastrowid
+    
+    def extend_segment(self, segment_id, end):
+        """タイムラインの区間の終了時刻を延ばす"""
+        with self.conn:
+            self.conn.execute("UPDATE timeline_segments SET end = ? WHERE id = ?", (_format_time(end), segment_id))
+    
+    def timeline(self, night):
+        """一晩分のタイムラインの区間を時刻順に返す"""
+        return [dict(row) for row in self.conn.execute(
+            "SELECT state, start, end FROM timeline_segments WHERE night = ? ORDER BY start", (night,)
+        )]
+    
+    def import_csv(self, csv_path):
+        """従来のsleep_records.csvを取り込む（取り込み済みの行は無視）。追加した件数を返す"""
+        added = 0
+        with open(csv_path, newline='', encoding='utf-8') as f:
+            for row in csv.DictReader(f):
+                try:
+                    start = datetime.strptime(f"{row['date']} {row['sleep_start']}", '%Y-%m-%d %H:%M:%S')
+                    end = datetime.strptime(f"{row['date']} {row['sleep_end']}", '%Y-%m-%d %H:%M:%S')
+                except (KeyError, TypeError, ValueError):
+                    continue  # 壊れた行
+                if end < start:
+                    end += timedelta(days=1)  # 日付をまたいだ区間
+                added += self.add(start, end, row.get('snore_detected') == 'True')
+        return added
+    
+    def export_csv(self, f, date_from=None, date_to=None):
+        """従来のsleep_records.csvと同じ形式で書き出す（fはテキストファイル）"""
+        writer = csv.writer(f)
+        writer.writerow(CSV_HEADER)
+        for row in self.sessions(date_from, date_to):
+            writer.writerow(csv_row(row))
+    
+    def close(self):
+        self.conn.close()
+
+
+class SleepSummaryWriter:
+    """
+    日・週・月ごとの睡眠サマリーを小さな静的JSONとして書き出す（睡眠区間の記録ごとに更新）
+    
+      summary.json  … 最新の日と直近7日・30日の平均・いびきのあった日数
+      daily.json    … 直近SUMMARY_DAYS日分（各日に7日・30日の移動平均）
+      weekly.json   … 週（月曜始まり）ごと
+      monthly.json  … 月ごと
+    
+    内容が変わったファイルだけを置き換えるので、変わらないファイルは更新時刻（WebサーバーのETag）も変わらず、
+    ブラウザは304を受け取る。同じ内容のgzip版（.json.gz）も書き出し、Webサーバーは圧縮済みのまま送る
+    """
+    
+    def __init__(self, directory=SUMMARY_DIR):
+        self.directory = directory
+        os.makedirs(directory, exist_ok=True)
+        self.files_written = 0
+    
+    def update(self, store):
+        """データベースの日ごとの集計からサマリーを作り直し、変わったファイルだけを書き込む"""
+        days = [self._day(row) for row in store.daily(limit=SUMMARY_MONTHS * 31)]
+        self._add_rolling_averages(days)
+        
+        self._write('summary', self._overview(days))
+        self._write('daily', days[-SUMMARY_DAYS:])
+        self._write('weekly', self._group(days, self._week_of, 'week')[-SUMMARY_WEEKS:])
+        self._write('monthly', self._group(days, lambda date: date[:7], 'month')[-SUMMARY_MONTHS:])
+    
+    @staticmethod
+    def _day(row):
+        """日ごとの集計（csvLoader.jsの集計と同じ形）"""
+        return {
+            'date': row['date'],
+            'totalHours': round(row['total_seconds'] / 3600, 2),
+            'sessions': row['sessions'],
+            'snoreDetected': bool(row['snore_detected']),
+            'sleepStart': row['sleep_start'][11:],
+            'sleepEnd': row['sleep_end'][11:]
+        }
+    
+    @staticmethod
+    def _add_rolling_averages(days):
+        """各日に直近7日・30日（その日を含む暦日、記録のある日の平均）の移動平均を付ける"""
+        ordinals = [datetime.strptime(day['date'], '%Y-%m-%d').toordinal() for day in days]
+        for window in (7, 30):
+            start = 0
+            total = 0.0
+            for i, day in enumerate(days):
+                total += day['totalHours']
+                while ordinals[start] <= ordinals[i] - window:
+                    total -= days[start]['totalHours']
+                    start += 1
+                day[f'avg{window}'] = round(total / (i - start + 1), 2)
+    
+    @staticmethod
+    def _overview(days):
+        """最新の日と、その日までの直近7日・30日の集計"""
+        if not days:
+            return {'latest': None}
+        latest = days[-1]
+        last = datetime.strptime(latest['date'], '%Y-%m-%d').toordinal()
+        overview = {'latest': latest}
+        for window in (7, 30):
+            recent = [day for day in days
+                      if datetime.strptime(day['date'], '%Y-%m-%d').toordinal() > last - window]
+            overview[f'nights{window}'] = len(recent)
+            overview[f'avg{window}'] = latest[f'avg{window}']
+            overview[f'snoreNights{window}'] = sum(day['snoreDetected'] for day in recent)
+        return overview
+    
+    @staticmethod
+    def _week_of(date):
+        """日付が属する週の月曜日"""
+        moment = datetime.strptime(date, '%Y-%m-%d')
+        return (moment - timedelta(days=moment.weekday())).strftime('%Y-%m-%d')
+    
+    @staticmethod
+    def _group(days, key, label):
+        """日ごとの集計を週・月ごとにまとめる"""
+        groups = {}
+        for day in days:
+            group = groups.setdefault(key(day['date']), {label: key(day['date']), 'totalHours': 0.0,
+                                                          'nights': 0, 'snoreNights': 0})
+            group['totalHours'] += day['totalHours']
+            group['nights'] += 1
+            group['snoreNights'] += day['snoreDetected']
+        result = list(groups.values())
+        for group in result:
+            group['totalHours'] = round(group['totalHours'], 2)
+            group['avgHours'] = round(group['totalHours'] / group['nights'], 2)
+        return result
+    
+    def _write(self, name, data):
+        """内容が変わったときだけJSONとgzip版を置き換える"""
+        payload = json.dumps(data, ensure_ascii=False, separators=(',', ':')).encode('utf-8')
+        path = os.path.join(self.directory, f"{name}.json")
+        try:
+            with open(path, 'rb') as f:
+                if f.read() == payload and os.path.exists(path + '.gz'):
+                    return False
+        except FileNotFoundError:
+            pass
+        
+        # gzip版を先に置き換える（mtime=0で同じ内容なら同じバイト列）
+        for target, content in ((path + '.gz', gzip.compress(payload, mtime=0)), (path, payload)):
+            temp_path = target + '.tmp'
+            with open(temp_path, 'wb') as f:
+                f.write(content)
+            os.replace(temp_path, target)
+        self.files_written += 1
+        return True
+
+
+def _format_time(timestamp):
+    return datetime.fromtimestamp(timestamp).strftime('%Y-%m-%d %H:%M:%S')
+
+
+class SleepTimeline:
+    """
+    睡眠判定の状態を30秒エポックごとにまとめ、同じ状態が続く間を1つの区間（連長圧縮）として記録
+    エポックの状態はエポック内で観測した状態のうち最も優先度の高いもの（寝返り・いびきは一瞬でも残す）
+    エポックの境界は時計に合わせる（再起動しても揃う）。夜が変わったら区間を分け、
+    記録が途切れたら（フレームが届かなかったエポック）新しい区間を始める
+    区間は作った時点で追加し、延びるたびに終了時刻を更新するので、異常終了しても直前のエポックまで残る
+    """
+    
+    def __init__(self, store, epoch=EPOCH_SECONDS):
+        self.store = store
+        self.epoch = epoch
+        self.epoch_start = None  # 集計中のエポックの開始時刻
+        self.epoch_state = 0  # 集計中のエポックで観測した最も優先度の高い状態（TIMELINE_STATESの番号）
+        self.last_time = None
+        self.segment = None  # [id, 状態, 夜, 終了時刻]
+        self.segments_written = 0
+    
+    def record(self, timestamp, state):
+        """1ステップ分の状態を記録（エポックが変わったら前のエポックを区間に反映）"""
+        epoch_start = timestamp - timestamp % self.epoch
+        if epoch_start != self.epoch_start:
+            self._finish_epoch(self.epoch_start + self.epoch if self.epoch_start is not None else None)
+            self.epoch_start = epoch_start
+            self.epoch_state = 0
+        self.epoch_state = max(self.epoch_state, TIMELINE_STATES.index(state))
+        self.last_time = timestamp
+    
+    def _finish_epoch(self, end):
+        if self.epoch_start is None:
+            return
+        state = TIMELINE_STATES[self.epoch_state]
+        night = night_of(self.epoch_start)
+        segment = self.segment
+        if (segment is not None and segment[1] == state and segment[2] == night
+                and segment[3] == self.epoch_start):
+            self.store.extend_segment(segment[0], end)
+            segment[3] = end
+        else:
+            segment_id = self.store.add_segment(night, state, self.epoch_start, end)
+            self.segment = [segment_id, state, night, end]
+            self.segments_written += 1
+    
+    def close(self):
+        """途中のエポックを最後に観測した時刻までとして反映"""
+        if self.last_time is not None:
+            self._finish_epoch(max(self.last_time, self.epoch_start + 1))
+        self.epoch_start = None
+        self.segment = None
+
+
+def csv_row(session):
+    """データベースの睡眠区間を従来のCSVの行に変換"""
+    seconds = session['duration_seconds']
+    return [
+        session['date'],
+        session['sleep_start'][11:],
+        session['sleep_end'][11:],
+        int(seconds // 3600),
+        int((seconds % 3600) // 60),
+        bool(session['snore_detected'])
+    ]
+
+
+class StageTimer:
+    """1つの処理段階の処理時間（直近の窓による統計と累積ヒストグラム）"""
+    
+    def __init__(self, window=METRICS_WINDOW, buckets=METRICS_BUCKETS):
+        self.samples = np.zeros(window)  # 直近の処理時間（リングバッファ）
+        self.index = 0
+        self.filled = 0
+        self.buckets = list(buckets)
+        self.bucket_counts = [0] * (len(buckets) + 1)  # 最後は+Inf
+        self.count = 0
+        self.total = 0.0
+    
+    def observe(self, seconds):
+        """処理時間を1回分記録"""
+        self.samples[self.index] = seconds
+        self.index = (self.index + 1) % len(self.samples)
+        if self.filled < len(self.samples):
+            self.filled += 1
+        self.bucket_counts[bisect.bisect_left(self.buckets, seconds)] += 1
+        self.count += 1
+        self.total += seconds
+    
+    def summary(self):
+        """直近の窓の統計（ミリ秒）"""
+        if self.filled == 0:
+            return {'count': self.count}
+        recent = self.samples[:self.filled] * 1000
+        p50, p90, p99 = np.percentile(recent, [50, 90, 99])
+        return {
+            'count': self.count,
+            'mean_ms': round(float(recent.mean()), 3),
+            'p50_ms': round(float(p50), 3),
+            'p90_ms': round(float(p90), 3),
+            'p99_ms': round(float(p99), 3),
+            'max_ms': round(float(recent.max()), 3)
+        }
+
+
+class PipelineMetrics:
+    """
+    処理段階ごとの処理時間・イベント数・レートの計測（--metrics時のみ作成）
+    計測する側は metrics が None かどうかだけを確認するので、無効時のコストはほぼない
+    """
+    
+    def __init__(self):
+        self.stages = {}
+        self.counters = {}
+        self.gauges = {}
+        self.events = {}  # レート計算用の直近イベント時刻
+        self.started = time.perf_counter()
+    
+    def _stage(self, name):
+        timer = self.stages.get(name)
+        if timer is None:
+            timer = self.stages.setdefault(name, StageTimer())
+        return timer
+    
+    def observe(self, name, seconds):
+        """処理時間を記録"""
+        self._stage(name).observe(seconds)
+    
+    def lap(self, name, start):
+        """startからの経過時間を記録し、現在時刻を返す（次の段階の開始時刻に使う）"""
+        now = time.perf_counter()
+        self._stage(name).observe(now - start)
+        return now
+    
+    def count(self, name, n=1):
+        """イベント数を加算"""
+        self.counters[name] = self.counters.get(name, 0) + n
+    
+    def set_gauge(self, name, value):
+        """現在値を設定"""
+        self.gauges[name] = value
+    
+    def tick(self, name):
+        """レート計算用のイベントを記録"""
+        events = self.events.get(name)
+        if events is None:
+            events = self.events.setdefault(name, deque(maxlen=METRICS_WINDOW))
+        events.append(time.perf_counter())
+    
+    def rate(self, name):
+        """直近のイベントから毎秒のレートを計算"""
+        events = self.events.get(name)
+        if not events or len(events) < 2:
+            return 0.0
+        span = events[-1] - events[0]
+        return (len(events) - 1) / span if span > 0 else 0.0
+    
+    def snapshot(self):
+        """ステータスファイル用の計測値"""
+        return {
+            'uptime_seconds': round(time.perf_counter() - self.started, 1),
+            'rates': {name: round(self.rate(name), 2) for name in list(self.events)},
+            'counters': dict(self.counters),
+            'gauges': dict(self.gauges),
+            'stages': {name: timer.summary() for name, timer in list(self.stages.items())}
+        }
+    
+    def to_prometheus(self):
+        """Prometheusのテキスト形式に変換"""
+        lines = [
+            '# HELP sleep_recorder_stage_seconds 処理段階ごとの処理時間',
+            '# TYPE sleep_recorder_stage_seconds histogram'
+        ]
+        for name, timer in list(self.stages.items()):
+            cumulative = 0
+            for bound, n in zip(timer.buckets + ['+Inf'], timer.bucket_counts):
+                cumulative += n
+                lines.append(f'sleep_recorder_stage_seconds_bucket{{stage="{name}",le="{bound}"}} {cumulative}')
+            lines.append(f'sleep_recorder_stage_seconds_sum{{stage="{name}"}} {timer.total:.6f}')
+            lines.append(f'sleep_recorder_stage_seconds_count{{stage="{name}"}} {timer.count}')
+        
+        lines.append('# HELP sleep_recorder_rate 直近のイベントレート（毎秒）')
+        lines.append('# TYPE sleep_recorder_rate gauge')
+        for name in list(self.events):
+            lines.append(f'sleep_recorder_rate{{name="{name}"}} {self.rate(name):.3f}')
+        
+        lines.append('# HELP sleep_recorder_events_total イベントの累積回数')
+        lines.append('# TYPE sleep_recorder_events_total counter')
+        for name, value in list(self.counters.items()):
+            lines.append(f'sleep_recorder_events_total{{name="{name}"}} {value}')
+        
+        lines.append('# HELP sleep_recorder_gauge 現在値')
+        lines.append('# TYPE sleep_recorder_gauge gauge')
+        for name, value in list(self.gauges.items()):
+            lines.append(f'sleep_recorder_gauge{{name="{name}"}} {value}')
+        return '\n'.join(lines) + '\n'
+    
+    def write_prometheus(self, path):
+        """Prometheus形式のファイルを書き出す（読み取り側が途中の内容を見ないよう置き換え）"""
+        temp_path = path + '.tmp'
+        with open(temp_path, 'w', encoding='utf-8') as f:
+            f.write(self.to_prometheus())
+        os.replace(temp_path, path)
+
+
+# 縮小率ごとのグレースケールデコードフラグ
+JPEG_GRAY_DECODE_FLAGS = {
+    1: cv2.IMREAD_GRAYSCALE,
+    2: cv2.IMREAD_REDUCED_GRAYSCALE_2,
+    4: cv2.IMREAD_REDUCED_GRAYSCALE_4,
+}
+
 
 class CameraMonitor:
     """赤外線カメラ対応の動き検知と顔検出（PC/Raspberry Pi両対応）"""
     
-    def __init__(self):
-        self.prev_frame = None
+    def __init__(self, lazy_decode=LAZY_JPEG_DECODE, decode_scale=JPEG_DECODE_SCALE,
+                 face_backend=FACE_DETECTOR_BACKEND, motion_scale=MOTION_SCALE,
+                 motion_background=MOTION_USE_BACKGROUND, use_process=CAMERA_USE_PROCESS,
+                 adaptive=ADAPTIVE_THRESHOLDS, open_device=True, clock=None):
+        self.clock = clock or time.time  # 時刻取得（リプレイ時は仮想時計）
+        self.session_recorder = None  # セッション記録（--record時）
+        self.metrics = None  # 処理時間の計測（--metrics時）
         self.motion_detected = False
         self.motion_level = 0
         self.motion_threshold = 50000  # キャリブレーションで調整
         
+        # 動き検知閾値のオンライン調整（adaptive=Falseならキャリブレーション時のみ使用）
+        self.adaptive = adaptive
+        self.motion_adapt = AdaptiveThreshold(MOTION_THRESHOLD_SIGMA, MOTION_THRESHOLD_BOUNDS)
+        self.motion_threshold = self.motion_adapt.clamp(self.motion_threshold)
+        self.last_adapt_time = None
+        
         # カメラの初期化（プラットフォーム別）
         self.use_libcamera = False
         self.libcamera_process = None
+        self.camera_process = None  # マルチプロセスモードの子プロセス
+        self.frame_ring = None
         self.cap = None
         self.frame_width = 640
         self.frame_height = 480
         
-        if IS_RASPBERRY_PI:
+        # JPEGデコード設定（遅延デコード時はグレースケールで直接デコード）
+        self.lazy_decode = lazy_decode
+        self.decode_flag = JPEG_GRAY_DECODE_FLAGS.get(decode_scale, cv2.IMREAD_GRAYSCALE)
+        
+        # フレーム番号（取得済みの最新と処理済み）
+        self.frame_id = 0
+        self.current_frame_id = 0
+        
+        # フレーム到着時刻（処理開始までの遅れの計測用）
+        self.frame_published_at = None
+        self.current_frame_published_at = None
+        
+        # フレーム統計（生成・デコード・未使用のまま破棄）
+        self.frames_produced = 0
+        self.frames_decoded = 0
+        self.frames_dropped = 0
+        
+        if not open_device:
+            # デバイスを開かず、feed_mjpegで与えたJPEGを使う（リプレイ・ベンチマーク用）
+            self._init_jpeg_source()
+        
+        if open_device and IS_RASPBERRY_PI and use_process:
+            try:
+                self._start_camera_process(decode_scale)
+            except Exception as e:
+                print(f"カメラプロセスの起動に失敗: {e}")
+                self._stop_camera_process()
+        
+        if open_device and IS_RASPBERRY_PI and self.camera_process is None:
             try:
                 import tempfile
                 
@@ -82,23 +1824,12 @@ class CameraMonitor:
                 
                 # libcamera-vidをMJPEGモードでバックグラウンド起動
                 self.libcamera_process = subprocess.Popen(
-                    [
-                        "libcamera-vid",
-                        "-t", "0",  # 無限に実行
-                        "--width", str(self.frame_width),
-                        "--height", str(self.frame_height),
-                        "--codec", "mjpeg",
-                        "--framerate", "15",
-                        "-n",  # プレビューなし
-                        "-o", "-"  # stdout出力
-                    ],
+                    _libcamera_command(self.frame_width, self.frame_height),
                     stdout=subprocess.PIPE,
                     stderr=subprocess.DEVNULL,
                     bufsize=10**6
                 )
-                self.use_libcamera = True
-                self.latest_frame = None
-                self.frame_lock = threading.Lock()
+                self._init_jpeg_source()
                 self.reader_running = True
                 
                 # 別スレッドでフレームを読み取り
@@ -115,13 +1846,18 @@ class CameraMonitor:
                 print(f"libcameraの起動に失敗: {e}")
                 self.use_libcamera = False
         
-        if not self.use_libcamera:
+        if open_device and not self.use_libcamera and self.camera_process is None:
             self.cap = cv2.VideoCapture(0)
             if not self.cap.isOpened():
                 print("警告: カメラが開けませんでした")
         
-        # 動きの履歴（安定した判定のため）- 拡大
-        self.motion_history = deque(maxlen=MOTION_HISTORY_SIZE)
+        # 縮小デコードするのは子プロセスと遅延デコードのJPEG入力のみ（動き量・顔の最小サイズの換算に使う）
+        reduced = self.camera_process is not None or (self.use_libcamera and lazy_decode)
+        self.decode_scale = decode_scale if reduced and decode_scale in JPEG_GRAY_DECODE_FLAGS else 1
+        
+        # 動き検知エンジン（動きの履歴も保持）
+        self.motion_engine = MotionEngine(scale=motion_scale, use_background=motion_background,
+                                          decode_scale=self.decode_scale)
         
         # 寝返り検出用
         self.rollover_start = None
@@ -129,108 +1865,249 @@ class CameraMonitor:
         
         # グレースケール表示用
         self.gray_frame = None
+        self.current_jpeg = None  # 処理中フレームの元のJPEG（遅延デコード時のみ、プレビューでそのまま送る）
         self.diff_frame = None
         
-        # Haar Cascadeの読み込み（顔・目検出用）
-        # cv2.data がない環境（apt版OpenCV等）への対応
-        try:
-            cascade_path = cv2.data.haarcascades
-        except AttributeError:
-            # ラズパイ等のシステムパス
-            cascade_path = '/usr/share/opencv4/haarcascades/'
-            if not os.path.exists(cascade_path):
-                cascade_path = '/usr/share/opencv/haarcascades/'
-        
-        self.face_cascade = cv2.CascadeClassifier(
-            cascade_path + 'haarcascade_frontalface_default.xml'
-        )
-        self.eye_cascade = cv2.CascadeClassifier(
-            cascade_path + 'haarcascade_eye.xml'
+        # 顔・目検出（顔はHaar/LBPを選択、目はHaar）
+        eye_backend = CascadeFaceBackend(
+            'eye', _find_cascade_dir('haarcascades') + 'haarcascade_eye.xml',
+            scale_factor=1.1, min_neighbors=3, min_size=(0, 0)
         )
+        self.detector = FaceDetectionScheduler(create_face_backend(face_backend, self.decode_scale),
+                                               eye_backend)
         
         # 検出位置を保存
         self.faces = []
         self.eyes = []
     
+    def attach_metrics(self, metrics):
+        """処理時間の計測を有効化（動き検知エンジンにも設定）"""
+        self.metrics = metrics
+        self.motion_engine.metrics = metrics
+    
+    def _start_camera_process(self, decode_scale):
+        """カメラの取得・デコードを行う子プロセスと共有メモリリングを作成"""
+        scale = decode_scale if decode_scale in JPEG_GRAY_DECODE_FLAGS else 1
+        shape = (-(-self.frame_height // scale), -(-self.frame_width // scale))
+        # spawnで起動（親のスレッドやOpenCVの状態を引き継がない）
+        ctx = multiprocessing.get_context('spawn')
+        self.frame_ring = SharedFrameRing.create(shape, CAMERA_RING_SLOTS, lock=ctx.Lock())
+        self.camera_stop_event = ctx.Event()
+        self.frame_ready_event = ctx.Event()  # 新フレームの通知
+        self.camera_process = ctx.Process(
+            target=_camera_process_main,
+            args=(self.frame_ring.name, shape, CAMERA_RING_SLOTS,
+                  self.frame_width, self.frame_height, self.decode_flag,
+                  self.camera_stop_event, self.frame_ready_event, self.frame_ring.lock),
+            daemon=True
+        )
+        self.camera_process.start()
+        
+        print("カメラ起動中... ", end="", flush=True)
+        time.sleep(1)
+        print("OK")
+        print(f"カメラプロセスを起動しました（PID {self.camera_process.pid}、共有メモリ {self.frame_ring.name}）")
+    
+    def _stop_camera_process(self):
+        """子プロセスを停止して共有メモリを解放"""
+        if self.camera_process is not None:
+            self.camera_stop_event.set()
+            self.camera_process.join(timeout=3)
+            if self.camera_process.is_alive():
+                self.camera_process.terminate()
+                self.camera_process.join(timeout=1)
+            self.camera_process = None
+        if self.frame_ring is not None:
+            # 他の処理から参照されないように外してから閉じる
+            ring, self.frame_ring = self.frame_ring, None
+            ring.close()
+    
+    def _init_jpeg_source(self):
+        """JPEG入力（libcamera・リプレイ共通）の受け取り状態を初期化"""
+        self.use_libcamera = True
+        self.demuxer = MjpegDemuxer()
+        self.latest_frame = None
+        self.latest_jpeg = None  # 遅延デコード用の最新JPEG
+        self.frame_lock = threading.Lock()
+        self.frame_cond = threading.Condition(self.frame_lock)  # 新フレームの通知
+    
     def _read_frames(self):
         """別スレッドでlibcameraからフレームを読み取り"""
-        jpeg_buffer = b""
+        stream = self.libcamera_process.stdout
         while self.reader_running:
             try:
-                chunk = self.libcamera_process.stdout.read(32768)
-                if not chunk:
+                if self.demuxer.read_from(stream, MJPEG_READ_SIZE) == 0:
                     continue
-                
-                jpeg_buffer += chunk
-                
-                # JPEGの終端マーカーを探す
-                while b'\xff\xd9' in jpeg_buffer:
-                    end_idx = jpeg_buffer.find(b'\xff\xd9') + 2
-                    start_idx = jpeg_buffer.rfind(b'\xff\xd8', 0, end_idx)
-                    
-                    if start_idx >= 0:
-                        jpeg_data = jpeg_buffer[start_idx:end_idx]
-                        jpeg_buffer = jpeg_buffer[end_idx:]
-                        
-                        # JPEGをデコード
-                        nparr = np.frombuffer(jpeg_data, np.uint8)
-                        frame = cv2.imdecode(nparr, cv2.IMREAD_COLOR)
-                        if frame is not None:
-                            with self.frame_lock:
-                                self.latest_frame = frame
-                    else:
-                        break
+                self._consume_demuxed_frames()
             except Exception as e:
                 if self.reader_running:
                     print(f"フレーム読み取りエラー: {e}")
                 break
     
+    def feed_mjpeg(self, data):
+        """外部から与えたMJPEGバイト列を取り込む（リプレイ・ベンチマーク用）"""
+        self.demuxer.feed(data)
+        self._consume_demuxed_frames()
+    
+    def _consume_demuxed_frames(self):
+        """完成したJPEGフレームを順に取り出して登録"""
+        for jpeg_data in self.demuxer.frames():
+            if self.session_recorder is not None:
+                self.session_recorder.write_jpeg(jpeg_data, self.clock())
+            
+            if self.lazy_decode:
+                # 最新のJPEGだけを保持（デコードは_capture_frameで行う）
+                jpeg_bytes = bytes(jpeg_data)
+                with self.frame_lock:
+                    self._publish_frame(jpeg_bytes, None)
+                continue
+            
+            # JPEGをデコード（バッファを直接参照）
+            m = self.metrics
+            t0 = time.perf_counter() if m else 0.0
+            nparr = np.frombuffer(jpeg_data, np.uint8)
+            frame = cv2.imdecode(nparr, cv2.IMREAD_COLOR)
+            if m:
+                m.lap('decode', t0)
+            if frame is not None:
+                with self.frame_lock:
+                    self.frames_decoded += 1
+                    self._publish_frame(None, frame)
+            else:
+                self.demuxer.corrupt_frames += 1
+    
+    def _publish_frame(self, jpeg_bytes, frame):
+        """新しいフレームを登録して待機中のメインループへ通知（frame_lockを保持して呼ぶ）"""
+        self.frames_produced += 1
+        if self.frame_id > self.current_frame_id:
+            # 前のフレームは一度も使われずに上書きされた
+            self.frames_dropped += 1
+        self.frame_id += 1
+        self.frame_published_at = time.perf_counter()
+        if jpeg_bytes is not None:
+            self.latest_jpeg = jpeg_bytes
+        else:
+            self.latest_frame = frame
+        self.frame_cond.notify_all()
+    
+    def wait_for_frame(self, timeout=None):
+        """未処理の新しいフレームが届くまで待機（届いたらTrue）"""
+        if self.frame_ring is not None:
+            # クリアしてから確認することで通知の取りこぼしを防ぐ
+            self.frame_ready_event.clear()
+            if self.frame_ring.latest_seq() > self.current_frame_id:
+                return True
+            self.frame_ready_event.wait(timeout)
+            return self.frame_ring.latest_seq() > self.current_frame_id
+        if self.use_libcamera:
+            with self.frame_cond:
+                return self.frame_cond.wait_for(
+                    lambda: self.frame_id > self.current_frame_id, timeout
+                )
+        if self.cap is not None and self.cap.isOpened():
+            return True  # VideoCapture.read()が次のフレームまでブロックする
+        time.sleep(timeout or 0)
+        return False
+    
     def _capture_frame(self):
-        """プラットフォームに応じてフレームを取得"""
+        """プラットフォームに応じて未処理の最新フレームを取得（同じフレームは二度返さない）"""
+        if self.frame_ring is not None:
+            # 共有メモリ上の最新フレームをコピーして取得（上書き中のフレームは捨てる）
+            latest = self.frame_ring.read_latest()
+            if latest is None or latest[0] <= self.current_frame_id:
+                return False, None
+            self.current_frame_id = latest[0]
+            self.current_jpeg = None
+            if self.session_recorder is not None:
+                # JPEGは子プロセスにしかないので、処理するフレームをエンコードして記録
+                self._record_frame(latest[1])
+            return True, latest[1]
         if self.use_libcamera:
             with self.frame_lock:
-                if self.latest_frame is not None:
-                    return True, self.latest_frame.copy()
-            return False, None
+                if self.frame_id <= self.current_frame_id:
+                    return False, None
+                self.current_frame_id = self.frame_id
+                self.current_frame_published_at = self.frame_published_at
+                jpeg_bytes = self.latest_jpeg
+                self.latest_jpeg = None
+                frame = self.latest_frame
+            self.current_jpeg = jpeg_bytes
+            
+            if not self.lazy_decode:
+                # 読み取りスレッドは配列を差し替えるだけで書き換えないのでコピー不要
+                return frame is not None, frame
+            
+            # 最新のJPEGをグレースケールでデコード
+            m = self.metrics
+            t0 = time.perf_counter() if m else 0.0
+            frame = cv2.imdecode(np.frombuffer(jpeg_bytes, np.uint8), self.decode_flag)
+            if m:
+                m.lap('decode', t0)
+            if frame is None:
+                self.demuxer.corrupt_frames += 1
+                return False, None
+            self.frames_decoded += 1
+            self.latest_frame = frame
+            return True, frame
         elif self.cap:
-            return self.cap.read()
+            ret, frame = self.cap.read()
+            self.current_jpeg = None
+            if ret:
+                self.frame_id += 1
+                self.current_frame_id = self.frame_id
+                if self.session_recorder is not None:
+                    # JPEGが存在しないのでエンコードして記録
+                    self._record_frame(frame)
+            return ret, frame
         return False, None
     
+    def _record_frame(self, frame):
+        """JPEGのない入力のフレームをエンコードしてセッションに記録"""
+        ok, jpeg = cv2.imencode('.jpg', frame)
+        if ok:
+            self.session_recorder.write_jpeg(jpeg, self.clock())
+    
     def update(self):
-        """フレームを取得して動きを更新"""
+        """フレームを取得して動きを更新し、解析結果を返す（フレームなしならNone）"""
+        m = self.metrics
+        t_start = time.perf_counter() if m else 0.0
         ret, frame = self._capture_frame()
         if not ret or frame is None:
             return None
         
+        if m and self.current_frame_published_at is not None:
+            # フレーム到着から処理開始までの遅れ（メインループの遅延）
+            m.observe('loop_lag', t_start - self.current_frame_published_at)
+        
         # デバッグ: フレームサイズを最初の1回だけ表示
         if not hasattr(self, '_frame_size_printed'):
             print(f"取得フレームサイズ: {frame.shape[1]}x{frame.shape[0]}")
             self._frame_size_printed = True
         
-        # グレースケール変換（赤外線カメラ用）
-        self.gray_frame = cv2.cvtColor(frame, cv2.COLOR_BGR2GRAY)
+        # グレースケール変換（赤外線カメラ用、遅延デコード時は変換済み）
+        if frame.ndim == 2:
+            self.gray_frame = frame
+        else:
+            self.gray_frame = cv2.cvtColor(frame, cv2.COLOR_BGR2GRAY)
+        if m:
+            m.lap('capture', t_start)
         
-        # ノイズ除去
-        blurred = cv2.GaussianBlur(self.gray_frame, (21, 21), 0)
+        # 動き検知（縮小・ノイズ除去・差分・履歴追加）
+        motion_level = self.motion_engine.process(self.gray_frame)
+        self.motion_level = motion_level or 0
+        self.diff_frame = self.motion_engine.diff_frame
         
-        # 動き検知
-        self.motion_level = 0
-        self.diff_frame = None
-        
-        if self.prev_frame is not None:
-            self.diff_frame = cv2.absdiff(self.prev_frame, blurred)
-            _, thresh = cv2.threshold(self.diff_frame, 25, 255, cv2.THRESH_BINARY)
-            self.motion_level = np.sum(thresh) / 255  # ピクセル数として計算
-            
-            # 履歴に追加
-            self.motion_history.append(self.motion_level)
-            
+        if motion_level is not None:
             # 過去のフレームの平均で判定（安定化）
-            avg_motion = np.mean(self.motion_history) if self.motion_history else 0
+            avg_motion = self.motion_engine.mean()
             raw_motion = avg_motion > self.motion_threshold
             
+            # 判定に使った閾値のまま、動きのないフレームだけで閾値を更新
+            if self.adaptive:
+                self._adapt_threshold(motion_level, still=not raw_motion and motion_level <= self.motion_threshold)
+            
             # 寝返り判定（5秒以内の動きは寝返りとして無視）
-            current_time = time.time()
+            current_time = self.clock()
             if raw_motion:
                 if self.rollover_start is None:
                     self.rollover_start = current_time
@@ -249,36 +2126,25 @@ class CameraMonitor:
                 self.is_rollover = False
                 self.motion_detected = False
         
-        self.prev_frame = blurred.copy()
+        # 顔と目の検出（スケジューラがROI探索/全画面探索を切り替え）
+        t0 = time.perf_counter() if m else 0.0
+        self.faces, self.eyes = self.detector.detect(self.gray_frame)
+        if m:
+            m.lap('face_detect', t0)
+            m.lap('camera_update', t_start)
+            m.tick('camera_frames')
         
-        # 顔と目の検出
-        self.faces = self.face_cascade.detectMultiScale(
-            self.gray_frame, scaleFactor=1.3, minNeighbors=5, minSize=(30, 30)
-        )
-        self.eyes = []
-        
-        # グレースケール画像を3チャンネルに変換して返す
-        display_frame = cv2.cvtColor(self.gray_frame, cv2.COLOR_GRAY2BGR)
-        
-        # 顔と目の枠を描画
-        for (x, y, w, h) in self.faces:
-            cv2.rectangle(display_frame, (x, y), (x+w, y+h), (0, 255, 0), 2)
-            cv2.putText(display_frame, "Face", (x, y-10), 
-                        cv2.FONT_HERSHEY_SIMPLEX, 0.6, (0, 255, 0), 2)
-            
-            # 顔の領域内で目を検出
-            roi_gray = self.gray_frame[y:y+h, x:x+w]
-            detected_eyes = self.eye_cascade.detectMultiScale(roi_gray, 1.1, 3)
-            
-            for (ex, ey, ew, eh) in detected_eyes:
-                # 絶対座標に変換
-                abs_ex, abs_ey = x + ex, y + ey
-                self.eyes.append((abs_ex, abs_ey, ew, eh))
-                cv2.rectangle(display_frame, (abs_ex, abs_ey), (abs_ex+ew, abs_ey+eh), (255, 0, 255), 2)
-                cv2.putText(display_frame, "Eye", (abs_ex, abs_ey-5), 
-                            cv2.FONT_HERSHEY_SIMPLEX, 0.4, (255, 0, 255), 1)
-        
-        return display_frame
+        # 解析結果のみを返す（描画はFrameRendererが必要なときだけ行う）
+        return self.get_status()
+    
+    def _adapt_threshold(self, motion_level, still):
+        """動きのないフレームの動き量で閾値を更新（動きのあるフレームは統計に入れない）"""
+        now = self.clock()
+        dt = now - self.last_adapt_time if self.last_adapt_time is not None else 0.0
+        self.last_adapt_time = now  # 動きのある区間の時間は統計の減衰に含めない
+        self.motion_adapt.offer(motion_level, not still, dt)
+        if self.motion_adapt.ready():
+            self.motion_threshold = self.motion_adapt.value()
     
     def calibrate(self, duration=10):
         """キャリブレーション - 静止状態のノイズレベルを測定"""
@@ -288,30 +2154,26 @@ class CameraMonitor:
         start_time = time.time()
         
         while time.time() - start_time < duration:
+            if not self.wait_for_frame(FRAME_WAIT_TIMEOUT):
+                continue
             ret, frame = self._capture_frame()
             if not ret or frame is None:
                 continue
             
-            gray = cv2.cvtColor(frame, cv2.COLOR_BGR2GRAY)
-            blurred = cv2.GaussianBlur(gray, (21, 21), 0)
+            gray = frame if frame.ndim == 2 else cv2.cvtColor(frame, cv2.COLOR_BGR2GRAY)
             
-            if self.prev_frame is not None:
-                diff = cv2.absdiff(self.prev_frame, blurred)
-                _, thresh = cv2.threshold(diff, 25, 255, cv2.THRESH_BINARY)
-                motion = np.sum(thresh) / 255
+            # 判定用の履歴には入れずに動き量だけを測定
+            motion = self.motion_engine.process(gray, record=False)
+            if motion is not None:
                 motion_samples.append(motion)
             
-            self.prev_frame = blurred.copy()
-            
             remaining = int(duration - (time.time() - start_time))
             print(f"\rキャリブレーション中... 残り{remaining}秒  ", end="", flush=True)
             time.sleep(0.1)
         
         if motion_samples:
-            avg_motion = np.mean(motion_samples)
-            std_motion = np.std(motion_samples)
-            # 平均 + 3標準偏差を閾値に設定
-            self.motion_threshold = avg_motion + std_motion * 3
+            # 平均 + 3標準偏差を閾値に設定（以降のオンライン調整の初期統計にもなる）
+            self.motion_threshold = self.motion_adapt.seed(motion_samples)
             print(f"\n動き検知閾値を設定: {self.motion_threshold:.0f}")
         
         return self.motion_threshold
@@ -319,18 +2181,57 @@ class CameraMonitor:
     def get_status(self):
         """現在の状態を取得"""
         eyes_open = len(self.eyes) > 0  # 目が検出されたらOpen
-        return {
+        status = {
             'motion': self.motion_detected,
+            'rollover': self.is_rollover,
             'motion_level': self.motion_level,
             'threshold': self.motion_threshold,
             'face_detected': len(self.faces) > 0,
             'face_count': len(self.faces),
             'eyes_open': eyes_open,
-            'eye_count': len(self.eyes)
+            'eye_count': len(self.eyes),
+            'frame_id': self.current_frame_id,
+            'detection': self.detector.get_stats()
+        }
+        if self.use_libcamera or self.frame_ring is not None:
+            status['demux'] = self.get_demux_stats()
+            status['decode'] = self.get_decode_stats()
+        return status
+    
+    def get_demux_stats(self):
+        """MJPEG解析の統計を取得（マルチプロセス時は共有メモリから）"""
+        if self.frame_ring is not None:
+            header = self.frame_ring.header
+            return {
+                'bytes': int(header[SharedFrameRing.STAT_BYTES]),
+                'frames': int(header[SharedFrameRing.STAT_PRODUCED]),
+                'resyncs': int(header[SharedFrameRing.STAT_RESYNCS]),
+                'corrupt_frames': int(header[SharedFrameRing.STAT_CORRUPT])
+            }
+        return self.demuxer.get_stats()
+    
+    def get_decode_stats(self):
+        """フレームの生成・デコード・破棄数を取得"""
+        if self.frame_ring is not None:
+            header = self.frame_ring.header
+            return {
+                'lazy': True,
+                'process': True,
+                'produced': int(header[SharedFrameRing.STAT_PRODUCED]),
+                'decoded': int(header[SharedFrameRing.STAT_DECODED]),
+                'dropped': int(header[SharedFrameRing.STAT_DROPPED]),
+                'torn': self.frame_ring.torn_reads
+            }
+        return {
+            'lazy': self.lazy_decode,
+            'produced': self.frames_produced,
+            'decoded': self.frames_decoded,
+            'dropped': self.frames_dropped
         }
     
     def release(self):
         """リソースを解放"""
+        self._stop_camera_process()
         if self.use_libcamera:
             # 読み取りスレッドを停止
             self.reader_running = False
@@ -358,15 +2259,239 @@ class CameraMonitor:
             self.cap.release()
 
 
+class AudioRingBuffer:
+    """
+    音声コールバック（書き込み）と解析スレッド（読み出し）の間の単一生産者・単一消費者リングバッファ
+    事前確保したint16配列を使い、書き込み位置は生産者だけ、読み出し位置は消費者だけが更新するのでロック不要
+    位置は単調増加の通算サンプル数で持ち、配列上の位置は容量の剰余で求める
+    複数チャンネルは(サンプル数, チャンネル数)のインターリーブのまま保持する
+    """
+    
+    def __init__(self, capacity, channels=1, data_ready=None):
+        self.capacity = capacity
+        self.channels = channels
+        self.buffer = np.zeros((capacity, channels) if channels > 1 else capacity, dtype=np.int16)
+        self.write_pos = 0  # 生産者のみ更新
+        self.read_pos = 0  # 消費者のみ更新
+        self.data_ready = data_ready or threading.Event()  # 複数デバイスのリングで共有できる
+        
+        # 統計（生産者側）
+        self.overflows = 0  # 満杯で書き込めなかった回数
+        self.dropped_samples = 0
+    
+    def available(self):
+        """読み出し可能なサンプル数"""
+        return self.write_pos - self.read_pos
+    
+    def write(self, samples):
+        """サンプルを書き込む（空きが足りない分は捨てて溢れとして数える）"""
+        free = self.capacity - (self.write_pos - self.read_pos)
+        if len(samples) > free:
+            self.overflows += 1
+            self.dropped_samples += len(samples) - free
+            samples = samples[:free]
+        n = len(samples)
+        if n > 0:
+            start = self.write_pos % self.capacity
+            first = min(n, self.capacity - start)
+            self.buffer[start:start + first] = samples[:first]
+            self.buffer[:n - first] = samples[first:]
+            self.write_pos += n  # データを書いてから位置を進める
+        self.data_ready.set()
+    
+    def skip(self, n):
+        """古い方からnサンプルを捨てる（消費者側）"""
+        self.read_pos += min(n, self.write_pos - self.read_pos)
+    
+    def read(self, n):
+        """nサンプルを読み出す（足りなければNone）"""
+        if self.write_pos - self.read_pos < n:
+            return None
+        start = self.read_pos % self.capacity
+        first = min(n, self.capacity - start)
+        if first == n:
+            samples = self.buffer[start:start + n].copy()
+        else:
+            samples = np.concatenate((self.buffer[start:], self.buffer[:n - first]))
+        self.read_pos += n  # コピーしてから位置を進める
+        return samples
+    
+    def wait(self, timeout, n=1):
+        """nサンプル以上たまるまで書き込みを待つ（クリアしてから待つので通知の取りこぼしはない）"""
+        self.data_ready.clear()
+        if self.write_pos - self.read_pos >= n:
+            return True
+        return self.data_ready.wait(timeout)
+
+
+class BreathingRateEstimator:
+    """
+    音量包絡線の自己相関による呼吸数（回/分）の推定
+    音声をブロックごとのRMSに間引いた包絡線を窓の長さだけリングに保持し、
+    呼吸周期に相当する遅延ごとの積和を1サンプルごとに差分更新する（チャンクあたり一定コスト）
+    信頼度は正規化自己相関のピーク値（0〜1）
+    """
+    
+    def __init__(self, envelope_rate=BREATHING_ENVELOPE_RATE, window_seconds=BREATHING_WINDOW_SECONDS,
+                 min_bpm=BREATHING_MIN_BPM, max_bpm=BREATHING_MAX_BPM):
+        self.envelope_rate = envelope_rate
+        self.window = int(window_seconds * envelope_rate)
+        self.min_samples = int(BREATHING_MIN_SECONDS * envelope_rate)
+        self.baseline_alpha = 1.0 / (BREATHING_BASELINE_SECONDS * envelope_rate)
+        
+        # 調べる遅延（0は正規化用）
+        self.min_lag = max(1, int(envelope_rate * 60 / max_bpm))
+        self.max_lag = min(self.window - 1, int(np.ceil(envelope_rate * 60 / min_bpm)))
+        self.lags = np.arange(self.max_lag + 1)
+        
+        # 包絡線（移動平均を引いた値）のリングと遅延ごとの積和
+        self.ring = np.zeros(self.window)
+        self.count = 0  # 通算の包絡線サンプル数
+        self.sums = np.zeros(self.max_lag + 1)
+        self.baseline = None
+        
+        # RMS計算で次のチャンクに持ち越す端数
+        self.remainder = np.zeros(0)
+        
+        self.bpm = None
+        self.confidence = 0.0
+    
+    def _push(self, value):
+        """包絡線サンプルを1つ追加して積和を差分更新"""
+        n = self.count
+        
+        # 窓から外れるサンプル（最古）を含む項を引く: x[old] * x[old + lag]
+        if n >= self.window:
+            old = n - self.window
+            idx = (old + self.lags) % self.window
+            self.sums -= self.ring[old % self.window] * self.ring[idx]
+        
+        self.ring[n % self.window] = value
+        self.count = n + 1
+        
+        # 新しいサンプルを含む項を足す: x[new] * x[new - lag]（窓内にあるもののみ）
+        available = min(self.count, self.window)
+        lags = self.lags[:available]
+        self.sums[:available] += value * self.ring[(n - lags) % self.window]
+    
+    def _recompute(self):
+        """浮動小数点誤差の蓄積を防ぐため積和を窓から計算し直す"""
+        available = min(self.count, self.window)
+        start = self.count - available
+        x = self.ring[(start + np.arange(available)) % self.window]
+        for lag in range(min(available, self.max_lag + 1)):
+            self.sums[lag] = np.dot(x[lag:], x[:available - lag])
+    
+    def process(self, audio_data, rate):
+        """1チャンク分の音声を取り込み、推定値を更新"""
+        block = max(1, int(rate / self.envelope_rate))
+        samples = np.concatenate((self.remainder, audio_data.astype(np.float64)))
+        blocks = len(samples) // block
+        self.remainder = samples[blocks * block:]
+        if blocks == 0:
+            return
+        
+        rms = np.sqrt(np.mean(samples[:blocks * block].reshape(blocks, block) ** 2, axis=1))
+        for value in rms:
+            # 寝室の明るさのような緩やかな音量変化を除く
+            if self.baseline is None:
+                self.baseline = value
+            self.baseline += self.baseline_alpha * (value - self.baseline)
+            self._push(value - self.baseline)
+            if self.count % self.window == 0:
+                self._recompute()
+        
+        self._estimate()
+    
+    def _estimate(self):
+        """正規化自己相関のピークから呼吸数と信頼度を求める"""
+        available = min(self.count, self.window)
+        if available < self.min_samples or self.sums[0] <= 0:
+            self.bpm = None
+            self.confidence = 0.0
+            return
+        
+        # 遅延ごとに項数が違うので項数で割ってから0遅延で正規化
+        max_lag = min(self.max_lag, available - 1)
+        lags = self.lags[:max_lag + 1]
+        corr = (self.sums[:max_lag + 1] / (available - lags)) / (self.sums[0] / available)
+        
+        search = corr[self.min_lag:max_lag + 1]
+        if len(search) == 0:
+            self.bpm = None
+            self.confidence = 0.0
+            return
+        # 周期の整数倍の遅延にもピークが出るので、最大値に近いピークのうち最短の遅延を選ぶ
+        peak = int(np.argmax(search))
+        inner = search[1:-1]
+        candidates = np.flatnonzero((inner >= 0.9 * search[peak]) &
+                                    (inner >= search[:-2]) & (inner >= search[2:]))
+        if len(candidates) > 0:
+            peak = int(candidates[0]) + 1
+        peak += self.min_lag
+        
+        # 放物線補間で遅延をサンプル以下の精度に
+        lag = float(peak)
+        if self.min_lag < peak < max_lag:
+            a, b, c = corr[peak - 1], corr[peak], corr[peak + 1]
+            denom = a - 2 * b + c
+            if denom < 0:
+                lag += 0.5 * (a - c) / denom
+        
+        self.bpm = 60.0 * self.envelope_rate / lag
+        self.confidence = float(np.clip(corr[peak], 0.0, 1.0))
+
+
+def find_input_device(pa, name):
+    """名前（部分一致・大文字小文字を区別しない）で入力デバイスを探してインデックスを返す（見つからなければNone）"""
+    for i in range(pa.get_device_count()):
+        info = pa.get_device_info_by_index(i)
+        if info.get('maxInputChannels', 0) > 0 and name.lower() in info.get('name', '').lower():
+            return i
+    return None
+
+
 class AudioMonitor:
-    """マイクによる音量検知といびき・呼吸パターン検出"""
+    """
+    マイクによる音量検知といびき・呼吸パターン検出
+    複数チャンネル（マルチチャンネルデバイス・複数デバイス）の音声は(チャンネル数, サンプル数)に並べて
+    全チャンネルの特徴量を一括で計算し、チャンネルごとの判定と統合した判定を出す
+    """
     
-    def __init__(self):
+    def __init__(self, open_device=True, clock=None, frontend=AUDIO_FRONTEND,
+                 capture_mode=AUDIO_CAPTURE_MODE, adaptive=ADAPTIVE_THRESHOLDS,
+                 devices=AUDIO_DEVICES, channels=AUDIO_CHANNELS):
+        self.clock = clock or time.time  # 時刻取得（リプレイ時は仮想時計）
+        self.session_recorder = None  # セッション記録（--record時）
+        self.metrics = None  # 処理時間の計測（--metrics時）
+        self.spectrogram = None  # スペクトログラム表示（--spectrogram時）
+        self.clip_recorder = None  # いびき音声クリップの保存（--snore-clips時）
+        self.frontend = frontend
+        self.capture_mode = capture_mode
+        self.rings = []  # コールバックモードのリングバッファ（デバイスごと）
+        self.input_overflows = 0  # デバイス側で発生した入力オーバーフロー（コールバックのフラグ）
+        self.overruns_counted = 0  # メトリクスのaudio_overrunsに計上済みの溢れ（リング・デバイス）の数
+        self.underruns = 0  # 解析スレッドが待っても音声が届かなかった回数
+        self.drift_corrections = 0  # 複数デバイス間のずれを補正した回数
+        self.drift_samples = 0  # ずれの補正で捨てたサンプル数（デバイスごとの合計）
+        self.resyncs = 0  # 溢れの後に全デバイスを揃え直した回数
+        self.ring_dropped_samples = 0  # 前回確認したときの溢れサンプル数（全リングの合計）
         self.audio = None
         self.audio_available = False
-        self.stream = None
+        self.streams = []  # デバイスごとのストリーム
+        
+        # 入力デバイスとチャンネル（デバイス名の指定がなければ既定のデバイス1つ）
+        self.devices = list(devices)
+        self.device_channels = channels
+        self.device_indices = [None] * max(1, len(self.devices))  # Noneは既定の入力デバイス
+        self.channels = len(self.device_indices) * channels  # 全デバイスの合計チャンネル数
+        self.channel_names = [
+            f"{name}:{c}" if channels > 1 else name
+            for name in (self.devices or ['default']) for c in range(channels)
+        ]
         self.is_silent = True
         self.snore_detected = False
+        self.snore_onset_time = None  # 現在のいびきが始まったチャンクの取得時刻
         self.breathing_detected = False  # 呼吸パターン検出
         self.running = False
         self.thread = None
@@ -382,22 +2507,67 @@ class AudioMonitor:
         self.snore_threshold = 5000
         self.breathing_threshold = 1000  # 呼吸パターン閾値
         
+        # 閾値のオンライン調整（adaptive=Falseならキャリブレーション時のみ使用）
+        self.adaptive = adaptive
+        self.calibrating = False  # 動作中のストリームでキャリブレーション中
+        self.silence_adapt = AdaptiveThreshold(SILENCE_THRESHOLD_SIGMA, SILENCE_THRESHOLD_BOUNDS,
+                                               accept_sigma=SILENCE_ACCEPT_SIGMA,
+                                               level_shift_seconds=ADAPT_LEVEL_SHIFT_SECONDS)
+        self.snore_adapt = AdaptiveThreshold(SNORE_THRESHOLD_SIGMA, SNORE_THRESHOLD_BOUNDS,
+                                             level_shift_seconds=ADAPT_LEVEL_SHIFT_SECONDS)
+        self.silence_threshold = self.silence_adapt.clamp(self.silence_threshold)
+        self.snore_threshold = self.snore_adapt.clamp(self.snore_threshold)
+        
         # 音量の履歴 - 拡大
         self.volume_history = deque(maxlen=AUDIO_HISTORY_SIZE)
         
         # 呼吸パターン履歴
         self.breathing_history = deque(maxlen=30)
         
+        # 呼吸数の推定（音量包絡線の自己相関、チャンネルごと）
+        self.breathing_estimators = [BreathingRateEstimator() for _ in range(self.channels)]
+        
+        
+        # 帯域パワー解析（いびき・呼吸・追加帯域）
+        self.bands = {
+            'snore': (SNORE_FREQ_LOW, SNORE_FREQ_HIGH),
+            'breathing': (BREATHING_FREQ_LOW, BREATHING_FREQ_HIGH),
+            **AUDIO_EXTRA_BANDS
+        }
+        self.band_analyzer = BandPowerAnalyzer(self.rate, self.chunk, self.bands)
+        self.band_powers = {name: 0.0 for name in self.bands}
+        
+        # チャンネルごとの判定（モノラルならスカラー）
+        shape = () if self.channels == 1 else (self.channels,)
+        self.channel_volumes = np.zeros(shape)
+        self.channel_silent = np.ones(shape, dtype=bool)
+        self.channel_snore = np.zeros(shape, dtype=bool)
+        self.channel_breathing = np.zeros(shape, dtype=bool)
+        self.channel_powers = np.zeros(shape + (len(self.bands),))
+        
+        # 間引き+STFTフロントエンド（--audio-frontend stft時）
+        self.stft = StreamingSTFT(self.rate, self.bands) if frontend == 'stft' else None
+        
+        # デバイスを開かない場合はprocess_chunkで与えた音声を使う（リプレイ・ベンチマーク用）
+        if not open_device:
+            return
+        if pyaudio is None:
+            print("警告: PyAudioがインストールされていません（音声機能無効）")
+            return
+        
         # PyAudioの初期化（音声デバイスがない場合でも動作）
         try:
             self.audio = pyaudio.PyAudio()
-            # 入力デバイスがあるか確認
-            device_count = self.audio.get_device_count()
-            for i in range(device_count):
-                info = self.audio.get_device_info_by_index(i)
-                if info.get('maxInputChannels', 0) > 0:
-                    self.audio_available = True
-                    break
+            if self.devices:
+                self.audio_available = self._resolve_devices()
+            else:
+                # 入力デバイスがあるか確認
+                device_count = self.audio.get_device_count()
+                for i in range(device_count):
+                    info = self.audio.get_device_info_by_index(i)
+                    if info.get('maxInputChannels', 0) > 0:
+                        self.audio_available = True
+                        break
             if self.audio_available:
                 print("オーディオデバイスを検出しました")
             else:
@@ -405,6 +2575,21 @@ class AudioMonitor:
         except Exception as e:
             print(f"警告: オーディオ初期化に失敗しました: {e}（音声機能無効）")
     
+    def _resolve_devices(self):
+        """指定された名前の入力デバイスを探す（1つでも見つからなければFalse）"""
+        for i, name in enumerate(self.devices):
+            index = find_input_device(self.audio, name)
+            if index is None:
+                print(f"警告: 入力デバイス '{name}' が見つかりません")
+                return False
+            info = self.audio.get_device_info_by_index(index)
+            if info.get('maxInputChannels', 0) < self.device_channels:
+                print(f"警告: '{info.get('name')}' は{self.device_channels}チャンネル入力に対応していません")
+                return False
+            self.device_indices[i] = index
+            print(f"入力デバイス: {info.get('name')} (index={index})")
+        return True
+    
     def start(self):
         """音声モニタリングを開始"""
         if not self.audio_available or not self.audio:
@@ -412,78 +2597,318 @@ class AudioMonitor:
             return
         
         try:
-            self.stream = self.audio.open(
-                format=pyaudio.paInt16,
-                channels=1,
-                rate=self.rate,
-                input=True,
-                frames_per_buffer=self.chunk
-            )
+            if self.capture_mode == 'callback':
+                # コールバックでリングバッファへ書き込み、解析は別スレッドで行う
+                # 複数デバイスのリングは通知を共有し、全デバイスが揃った分だけ読み出す
+                data_ready = threading.Event()
+                for index in self.device_indices:
+                    ring = AudioRingBuffer(int(self.rate * AUDIO_RING_SECONDS), self.device_channels, data_ready)
+                    self.rings.append(ring)
+                    self.streams.append(self.audio.open(
+                        format=pyaudio.paInt16,
+                        channels=self.device_channels,
+                        rate=self.rate,
+                        input=True,
+                        input_device_index=index,
+                        frames_per_buffer=AUDIO_CALLBACK_FRAMES,
+                        stream_callback=functools.partial(self._stream_callback, ring)
+                    ))
+                target = self._consume_loop
+            else:
+                for index in self.device_indices:
+                    self.streams.append(self.audio.open(
+                        format=pyaudio.paInt16,
+                        channels=self.device_channels,
+                        rate=self.rate,
+                        input=True,
+                        input_device_index=index,
+                        frames_per_buffer=self.chunk
+                    ))
+                target = self._monitor_loop
             self.running = True
-            self.thread = threading.Thread(target=self._monitor_loop)
+            self.thread = threading.Thread(target=target)
             self.thread.daemon = True
             self.thread.start()
         except Exception as e:
             print(f"警告: オーディオストリーム開始に失敗: {e}")
     
+    def _stream_callback(self, ring, in_data, frame_count, time_info, status_flags):
+        """PyAudioのコールバック（音声スレッド）: リングバッファへ書き込むだけで解析はしない"""
+        if status_flags & pyaudio.paInputOverflow:
+            self.input_overflows += 1
+        samples = np.frombuffer(in_data, dtype=np.int16)
+        if ring.channels > 1:
+            samples = samples.reshape(-1, ring.channels)
+        ring.write(samples)
+        return None, pyaudio.paContinue
+    
+    def _read_rings(self):
+        """全デバイスのリングから1チャンクずつ読み出し、(サンプル数, 合計チャンネル数)に並べる（足りなければNone）"""
+        rings = self.rings
+        if len(rings) > 1:
+            self._align_rings()
+        if any(ring.available() < self.chunk for ring in rings):
+            return None
+        if len(rings) == 1:
+            return rings[0].read(self.chunk)
+        blocks = [ring.read(self.chunk).reshape(self.chunk, -1) for ring in rings]
+        return np.concatenate(blocks, axis=1)
+    
+    def _align_rings(self):
+        """
+        複数デバイスのリングの時間のずれを補正（デバイスごとにクロックが異なり、一晩で少しずつずれる）
+        全リングから同じ数ずつ読むので、溜まっているサンプル数の差がそのまま時間のずれになる。
+        最も少ないリングよりAUDIO_DRIFT_TOLERANCEを超えて多く溜まっている（先行している）リングは、
+        差の分だけ古いサンプルを捨てる。どれかのリングが溢れたときは欠けた位置が分からないので、
+        全リングを捨てて現在から揃え直す
+        """
+        rings = self.rings
+        dropped = sum(ring.dropped_samples for ring in rings)
+        if dropped != self.ring_dropped_samples:
+            self.ring_dropped_samples = dropped
+            for ring in rings:
+                ring.skip(ring.available())
+            self.resyncs += 1
+            return
+        
+        base = min(ring.available() for ring in rings)
+        for ring in rings:
+            lead = ring.available() - base
+            if lead > AUDIO_DRIFT_TOLERANCE:
+                ring.skip(lead)
+                self.drift_corrections += 1
+                self.drift_samples += lead
+    
+    def _consume_loop(self):
+        """リングバッファに溜まった音声をチャンク単位で解析（コールバックモード）"""
+        # チャンク2つ分の時間待っても届かなければアンダーランとみなす
+        timeout = 2 * self.chunk / self.rate
+        while self.running:
+            try:
+                # 通知は全リングで共有しているので、最も遅れているリングで待つ
+                slowest = min(self.rings, key=AudioRingBuffer.available)
+                if not slowest.wait(timeout, self.chunk) and self.running:
+                    self.underruns += 1
+                    continue
+                
+                while self.running:
+                    audio_data = self._read_rings()
+                    if audio_data is None:
+                        break
+                    backlog = min(ring.available() for ring in self.rings)
+                    
+                    m = self.metrics
+                    if m:
+                        m.set_gauge('audio_backlog_samples', backlog)
+                        ring_overflows = sum(ring.overflows for ring in self.rings)
+                        m.set_gauge('audio_ring_overflows', ring_overflows)
+                        # リングが満杯で捨てた分とデバイス側の入力オーバーフローを取りこぼしとして数える
+                        # （コールバックのスレッドではメトリクスに触れず、ここで差分を加算する）
+                        overruns = ring_overflows + self.input_overflows
+                        if overruns > self.overruns_counted:
+                            m.count('audio_overruns', overruns - self.overruns_counted)
+                            self.overruns_counted = overruns
+                    
+                    # 取得時刻は未処理の音声の長さだけさかのぼる
+                    captured_at = self.clock() - (backlog + self.chunk) / self.rate
+                    if self.session_recorder is not None:
+                        self.session_recorder.write_audio(audio_data, captured_at)
+                    
+                    self.process_chunk(audio_data, captured_at)
+            
+            except Exception as e:
+                print(f"Audio error: {e}")
+                time.sleep(0.1)
+    
     def _monitor_loop(self):
         """音声モニタリングのメインループ"""
         while self.running:
             try:
-                data = self.stream.read(self.chunk, exception_on_overflow=False)
-                audio_data = np.frombuffer(data, dtype=np.int16)
-                
-                # 音量レベルの計算
-                self.volume = np.abs(audio_data).mean()
-                self.volume_history.append(self.volume)
+                m = self.metrics
+                t0 = time.perf_counter() if m else 0.0
+                blocks = [np.frombuffer(stream.read(self.chunk, exception_on_overflow=False), dtype=np.int16)
+                          for stream in self.streams]
+                if self.channels == 1:
+                    audio_data = blocks[0]
+                else:
+                    audio_data = np.concatenate([b.reshape(self.chunk, -1) for b in blocks], axis=1)
+                if len(self.streams) > 1:
+                    self._align_streams()
                 
-                # 過去の平均で判定（安定化）
-                avg_volume = np.mean(self.volume_history) if self.volume_history else 0
-                self.is_silent = avg_volume < self.silence_threshold
+                if m:
+                    m.lap('audio_read', t0)
+                    # 読み取り直後に次のチャンク分以上たまっていれば処理が追いついていない
+                    backlog = min(stream.get_read_available() for stream in self.streams)
+                    m.set_gauge('audio_backlog_samples', backlog)
+                    if backlog >= self.chunk:
+                        m.count('audio_overruns')
                 
-                # 波形データを保存
-                self.waveform = audio_data.copy()
+                if self.session_recorder is not None:
+                    self.session_recorder.write_audio(audio_data, self.clock())
                 
-                # いびき・呼吸パターン検出（FFT分析）
-                self._detect_snore_and_breathing(audio_data)
+                self.process_chunk(audio_data)
                 
             except Exception as e:
                 print(f"Audio error: {e}")
                 time.sleep(0.1)
     
+    def _align_streams(self):
+        """複数デバイスのずれを補正（従来モード）。ストリームに溜まっている分が多いデバイスの古いサンプルを捨てる"""
+        available = [stream.get_read_available() for stream in self.streams]
+        base = min(available)
+        for stream, count in zip(self.streams, available):
+            lead = count - base
+            if lead > AUDIO_DRIFT_TOLERANCE:
+                stream.read(lead, exception_on_overflow=False)
+                self.drift_corrections += 1
+                self.drift_samples += lead
+    
+    def process_chunk(self, audio_data, captured_at=None):
+        """
+        1チャンク分の音声（int16）を解析して状態を更新
+        モノラルは1次元、複数チャンネルは(サンプル数, チャンネル数)のインターリーブ配列
+        captured_atはチャンクの取得時刻（省略時は現在時刻。リプレイでは記録時の取得時刻になる）
+        """
+        if captured_at is None:
+            captured_at = self.clock()
+        # 以降の解析はチャンネルを先頭の軸にした(チャンネル数, サンプル数)で行う（転置はビューのみ）
+        samples = audio_data.T
+        
+        # 音量レベルの計算（チャンネルごと）
+        self.channel_volumes = np.abs(samples).mean(axis=-1)
+        self.volume = float(np.mean(self.channel_volumes))
+        self.volume_history.append(self.channel_volumes)
+        
+        # 過去の平均で判定（安定化）、全チャンネルが静かなら静寂
+        avg_volume = np.mean(self.volume_history, axis=0) if self.volume_history else 0
+        self.channel_silent = avg_volume < self.silence_threshold
+        self.is_silent = bool(np.all(self.channel_silent))
+        
+        # 波形データを保存（複数チャンネルは平均して表示用に）
+        self.waveform = audio_data.copy() if audio_data.ndim == 1 else audio_data.mean(axis=1)
+        if self.spectrogram is not None:
+            self.spectrogram.push(self.waveform)
+        
+        # いびき・呼吸パターン検出（FFT分析）
+        m = self.metrics
+        t0 = time.perf_counter() if m else 0.0
+        was_snoring = self.snore_detected
+        self._detect_snore_and_breathing(samples)
+        if m:
+            t0 = m.lap('audio_fft', t0)
+        
+        # いびきの立ち上がりの取得時刻（クリップの切り出し位置。クリップの予約は睡眠判定側で行う）
+        if self.snore_detected and not was_snoring:
+            self.snore_onset_time = captured_at
+        if self.clip_recorder is not None:
+            self.clip_recorder.feed(audio_data, captured_at)
+        
+        # 呼吸数の推定
+        if samples.ndim == 1:
+            self.breathing_estimators[0].process(samples, self.rate)
+        else:
+            for estimator, channel in zip(self.breathing_estimators, samples):
+                estimator.process(channel, self.rate)
+        if m:
+            m.lap('breathing_rate', t0)
+            m.tick('audio_chunks')
+        
+        # 閾値の調整（判定の後に行う。キャリブレーション中は全サンプル、通常時は静かなサンプルのみ）
+        if self.calibrating or self.adaptive:
+            self._adapt_thresholds(len(audio_data) / self.rate)
+    
+    def _adapt_thresholds(self, dt):
+        """音量・いびき帯域パワーの統計を更新して閾値に反映（通常時はイベント中のチャンクを統計に入れない）"""
+        snore_power = self.band_powers['snore']
+        if self.calibrating:
+            self.silence_adapt.update(self.volume, dt)
+            self.snore_adapt.update(snore_power, dt)
+            return
+        
+        # いびき中のチャンクはどちらの統計にも入れない（長く続けば背景レベルの変化として入れる）
+        snoring = self.snore_detected or snore_power > self.snore_threshold
+        self.snore_adapt.offer(snore_power, snoring, dt)
+        self.silence_adapt.offer(self.volume, snoring or self.volume > self.silence_adapt.limit(), dt)
+        
+        if self.silence_adapt.ready():
+            self.silence_threshold = self.silence_adapt.value()
+        if self.snore_adapt.ready():
+            self.snore_threshold = self.snore_adapt.value()
+    
+    def begin_calibration(self):
+        """動作中のストリームでキャリブレーションを開始（統計をリセットして全サンプルを使う）"""
+        self.silence_adapt.stats.reset()
+        self.snore_adapt.stats.reset()
+        self.calibrating = True
+    
+    def end_calibration(self):
+        """キャリブレーションを終了して閾値を設定"""
+        self.calibrating = False
+        if self.silence_adapt.stats.count > 0:
+            self.silence_threshold = self.silence_adapt.value()
+            print(f"\n静寂閾値を設定: {self.silence_threshold:.0f}")
+        if self.snore_adapt.stats.count > 0:
+            self.snore_threshold = self.snore_adapt.value()
+            print(f"いびき閾値を設定: {self.snore_threshold:.0f}")
+        return self.silence_threshold, self.snore_threshold
+    
+    def _analyze_bands(self, audio_data):
+        """全帯域のパワーを計算（レート・チャンクサイズが変わったら解析器を作り直す）"""
+        if self.stft is not None:
+            if self.stft.input_rate != self.rate:
+                self.stft = StreamingSTFT(self.rate, self.bands)
+            return self.stft.process(audio_data)
+        
+        analyzer = self.band_analyzer
+        size = audio_data.shape[-1]
+        if analyzer.rate != self.rate or analyzer.size != size:
+            analyzer = self.band_analyzer = BandPowerAnalyzer(self.rate, size, self.bands)
+        return analyzer.analyze(audio_data)
+    
     def _detect_snore_and_breathing(self, audio_data):
-        """FFTを使用していびきと呼吸パターンを検出"""
-        fft_data = np.abs(np.fft.fft(audio_data))
-        freqs = np.fft.fftfreq(len(audio_data), 1/self.rate)
+        """
+        帯域パワー（rfft）からいびきと呼吸パターンを検出
+        audio_dataが(チャンネル数, サンプル数)なら全チャンネルを一括で解析し、いずれかのチャンネルで検出したら検出とする
+        """
+        powers = self._analyze_bands(audio_data)  # (帯域数,) または (チャンネル数, 帯域数)
+        self.channel_powers = powers
+        # 統合値は最も大きいチャンネルの帯域パワー
+        fused = powers if powers.ndim == 1 else powers.max(axis=0)
+        self.band_powers = dict(zip(self.bands, fused.tolist()))
         
         # いびき検出 (100-500Hz)
-        snore_mask = (freqs >= SNORE_FREQ_LOW) & (freqs <= SNORE_FREQ_HIGH)
-        snore_power = np.sum(fft_data[snore_mask])
-        self.snore_detected = snore_power > self.snore_threshold
+        snore_power = powers[..., 0]  # 最初の帯域がいびき帯域
+        self.channel_snore = snore_power > self.snore_threshold
+        self.snore_detected = bool(np.any(self.channel_snore))
         
         # 呼吸パターン検出 (10-50Hz の低周波)
-        breathing_mask = (freqs >= BREATHING_FREQ_LOW) & (freqs <= BREATHING_FREQ_HIGH)
-        breathing_power = np.sum(fft_data[breathing_mask])
+        breathing_power = powers[..., 1]
         
         # 呼吸の規則性を履歴で判定
         self.breathing_history.append(breathing_power)
         
         if len(self.breathing_history) >= 10:
             # 規則的なパターンがあれば呼吸と判定
-            std_breathing = np.std(self.breathing_history)
-            mean_breathing = np.mean(self.breathing_history)
+            std_breathing = np.std(self.breathing_history, axis=0)
+            mean_breathing = np.mean(self.breathing_history, axis=0)
             
             # 変動係数が一定範囲内なら規則的な呼吸
-            if mean_breathing > 0:
-                cv = std_breathing / mean_breathing
-                self.breathing_detected = 0.1 < cv < 0.8 and mean_breathing > self.breathing_threshold
-            else:
-                self.breathing_detected = False
+            cv = std_breathing / np.maximum(mean_breathing, 1e-12)
+            self.channel_breathing = ((mean_breathing > 0) & (0.1 < cv) & (cv < 0.8) &
+                                      (mean_breathing > self.breathing_threshold))
         else:
-            self.breathing_detected = False
+            self.channel_breathing = np.zeros(np.shape(breathing_power), dtype=bool)
+        self.breathing_detected = bool(np.any(self.channel_breathing))
     
     def calibrate(self, duration=10):
         """キャリブレーション - 静寂時のノイズレベルを測定"""
+        if self.running:
+            # モニタリング中なら同じストリームのチャンクで測定（別ストリームを開かない）
+            print(f"\n静かにしてください... ({duration}秒間キャリブレーション)")
+            self.begin_calibration()
+            time.sleep(duration)
+            return self.end_calibration()
+        
         if not self.audio_available or not self.audio:
             print("音声キャリブレーションをスキップ（デバイスなし）")
             return self.silence_threshold, self.snore_threshold
@@ -497,6 +2922,7 @@ class AudioMonitor:
                 channels=1,
                 rate=self.rate,
                 input=True,
+                input_device_index=self.device_indices[0],
                 frames_per_buffer=self.chunk
             )
         except Exception as e:
@@ -516,11 +2942,8 @@ class AudioMonitor:
                 volume_samples.append(volume)
                 
                 # いびき帯域のパワー
-                fft_data = np.abs(np.fft.fft(audio_data))
-                freqs = np.fft.fftfreq(len(audio_data), 1/self.rate)
-                mask = (freqs >= SNORE_FREQ_LOW) & (freqs <= SNORE_FREQ_HIGH)
-                snore_power = np.sum(fft_data[mask])
-                snore_samples.append(snore_power)
+                powers = self._analyze_bands(audio_data)
+                snore_samples.append(powers[0])  # 最初の帯域がいびき帯域
                 
             except:
                 pass
@@ -532,56 +2955,931 @@ class AudioMonitor:
         stream.stop_stream()
         stream.close()
         
+        # 平均 + k標準偏差を閾値に設定（以降のオンライン調整の初期統計にもなる）
         if volume_samples:
-            avg_volume = np.mean(volume_samples)
-            std_volume = np.std(volume_samples)
-            self.silence_threshold = avg_volume + std_volume * 2
+            self.silence_threshold = self.silence_adapt.seed(volume_samples)
             print(f"\n静寂閾値を設定: {self.silence_threshold:.0f}")
         
-        if snore_samples:
-            avg_snore = np.mean(snore_samples)
-            std_snore = np.std(snore_samples)
-            self.snore_threshold = avg_snore + std_snore * 5
-            print(f"いびき閾値を設定: {self.snore_threshold:.0f}")
+        if snore_samples:
+            self.snore_threshold = self.snore_adapt.seed(snore_samples)
+            print(f"いびき閾値を設定: {self.snore_threshold:.0f}")
+        
+        return self.silence_threshold, self.snore_threshold
+    
+    def get_status(self):
+        """現在の状態を取得（複数チャンネルなら統合した判定とチャンネルごとの判定）"""
+        # 呼吸数は最も信頼度の高いチャンネルの推定値
+        estimator = max(self.breathing_estimators, key=lambda e: e.confidence)
+        status = {
+            'silent': self.is_silent,
+            'snore': self.snore_detected,
+            'snore_onset': self.snore_onset_time,
+            'breathing': self.breathing_detected,
+            'breathing_rate': estimator.bpm,
+            'breathing_confidence': estimator.confidence,
+            'volume': self.volume,
+            'threshold': self.silence_threshold,
+            'bands': self.band_powers,
+            'capture': self.get_capture_stats()
+        }
+        if self.channels > 1:
+            status['channels'] = self.get_channel_status()
+        return status
+    
+    def get_channel_status(self):
+        """チャンネルごとの判定"""
+        channels = []
+        for i, name in enumerate(self.channel_names):
+            estimator = self.breathing_estimators[i]
+            channels.append({
+                'name': name,
+                'silent': bool(self.channel_silent[i]),
+                'snore': bool(self.channel_snore[i]),
+                'breathing': bool(self.channel_breathing[i]),
+                'volume': float(self.channel_volumes[i]),
+                'breathing_rate': estimator.bpm,
+                'breathing_confidence': estimator.confidence,
+                'bands': dict(zip(self.bands, self.channel_powers[i].tolist()))
+            })
+        return channels
+    
+    def get_capture_stats(self):
+        """音声取得の統計（溢れ・アンダーラン・未処理サンプル数、複数デバイスは合計）"""
+        rings = self.rings
+        return {
+            'mode': self.capture_mode,
+            'channels': self.channels,
+            'overflows': sum(ring.overflows for ring in rings),
+            'dropped_samples': sum(ring.dropped_samples for ring in rings),
+            'input_overflows': self.input_overflows,
+            'underruns': self.underruns,
+            'drift_corrections': self.drift_corrections,
+            'drift_samples': self.drift_samples,
+            'resyncs': self.resyncs,
+            'buffered_samples': min((ring.available() for ring in rings), default=0)
+        }
+    
+    def get_waveform(self):
+        """描画用の波形データを取得"""
+        return self.waveform.copy()
+    
+    def stop(self):
+        """モニタリングを停止"""
+        self.running = False
+        for ring in self.rings:
+            ring.data_ready.set()  # 待機中の解析スレッドを起こす
+        if self.thread:
+            self.thread.join(timeout=1)
+        for stream in self.streams:
+            stream.stop_stream()
+            stream.close()
+        if self.audio:
+            self.audio.terminate()
+
+
+class BandPowerAnalyzer:
+    """
+    実数FFT（rfft）による帯域パワーの一括計算
+    帯域ごとのビン範囲と窓関数はサイズ・サンプリングレートごとに1回だけ計算し、
+    チャンクごとのfftfreqやマスクの生成を行わない
+    帯域パワーは振幅スペクトルの帯域内合計（従来のfft+マスクと同じ値）
+    """
+    
+    def __init__(self, rate, size, bands, window=AUDIO_FFT_WINDOW, scale=1.0):
+        self.rate = rate
+        self.size = size
+        self.names = list(bands)
+        self.index = {name: i for i, name in enumerate(self.names)}
+        
+        # 各帯域の[開始, 終了)ビン（freqs >= low かつ freqs <= high の範囲）
+        freqs = np.fft.rfftfreq(size, 1 / rate)
+        self.starts = np.array([np.searchsorted(freqs, bands[name][0], 'left') for name in self.names], dtype=np.intp)
+        self.ends = np.array([np.searchsorted(freqs, bands[name][1], 'right') for name in self.names], dtype=np.intp)
+        self.ends = np.maximum(self.ends, self.starts)
+        self.max_bin = int(self.ends.max()) if len(self.names) else 0  # 振幅を計算する上限ビン
+        
+        # 窓関数（矩形窓なら掛け算自体を省略）
+        self.window = getattr(np, window)(size) if window else None
+        self.scale = scale  # 振幅の正規化係数
+        
+        # 累積和用の作業領域（先頭は0）
+        self.cumulative = np.zeros(self.max_bin + 1)
+    
+    def analyze(self, audio_data):
+        """全帯域のパワーを帯域の登録順の配列で返す（2次元ならフレームごとの行）"""
+        samples = audio_data if self.window is None else audio_data * self.window
+        spectrum = np.fft.rfft(samples, axis=-1)
+        magnitude = np.abs(spectrum[..., :self.max_bin])
+        if magnitude.ndim == 1:
+            np.cumsum(magnitude, out=self.cumulative[1:])
+            cumulative = self.cumulative
+        else:
+            cumulative = np.zeros(magnitude.shape[:-1] + (self.max_bin + 1,))
+            np.cumsum(magnitude, axis=-1, out=cumulative[..., 1:])
+        powers = cumulative[..., self.ends] - cumulative[..., self.starts]
+        if self.scale != 1.0:
+            powers *= self.scale
+        return powers
+
+
+class PolyphaseDecimator:
+    """
+    折り返し防止ローパスFIR付きの間引き（ストリーム処理）
+    残す出力サンプルの位置の窓だけを行列に並べ、1回の行列ベクトル積で計算する（ポリフェーズ相当）
+    フィルタはハミング窓の窓関数法で作成し、直流ゲインを1にする
+    入力は(サンプル数,)または(チャンネル数, サンプル数)で、時間は最後の軸
+    """
+    
+    def __init__(self, factor, num_taps=AUDIO_DECIMATION_TAPS):
+        self.factor = factor
+        n = np.arange(num_taps) - (num_taps - 1) / 2
+        cutoff = 0.45 / factor  # 間引き後のナイキスト周波数の90%（入力レート比）
+        taps = 2 * cutoff * np.sinc(2 * cutoff * n) * np.hamming(num_taps)
+        self.taps = taps / taps.sum()
+        
+        self.kernel = self.taps[::-1].copy()  # 時間順の窓との内積で畳み込みになるよう反転
+        
+        # 作業領域（先頭に前回から引き継いだサンプル）と窓を並べる行列
+        self.work = np.zeros(num_taps - 1)
+        self.pending = num_taps - 1  # 作業領域内の有効サンプル数
+        self.windows = np.zeros((0, num_taps))
+    
+    def process(self, samples):
+        """チャンクを間引いて出力サンプルを返す（チャンク長は任意）"""
+        lead = samples.shape[:-1]  # チャンネルの軸（モノラルなら空）
+        total = self.pending + samples.shape[-1]
+        if self.work.shape[:-1] != lead or self.work.shape[-1] < total:
+            work = np.zeros(lead + (total,))
+            work[..., :self.pending] = self.work[..., :self.pending]
+            self.work = work
+        self.work[..., self.pending:total] = samples
+        
+        # factorサンプルおきの窓を連続した行列へ写してから内積（ストライドのまま渡すより速い）
+        num_taps = len(self.kernel)
+        count = (total - num_taps) // self.factor + 1 if total >= num_taps else 0  # 出力サンプル数
+        if count <= 0:
+            self.pending = total
+            return np.zeros(lead + (0,))
+        if self.windows.shape != lead + (count, num_taps):
+            self.windows = np.zeros(lead + (count, num_taps))
+        step = self.work.strides[-1]
+        strided = np.lib.stride_tricks.as_strided(
+            self.work, shape=lead + (count, num_taps),
+            strides=self.work.strides[:-1] + (step * self.factor, step),
+            writeable=False
+        )
+        np.copyto(self.windows, strided)
+        output = self.windows @ self.kernel
+        
+        # 次の出力の窓の先頭以降を前に詰める
+        consumed = count * self.factor
+        self.pending = total - consumed
+        self.work[..., :self.pending] = self.work[..., consumed:total]
+        return output
+
+
+class StreamingSTFT:
+    """
+    間引き後の音声に対するストリーミングSTFT
+    サンプルを作業バッファに溜め、hopごとにsizeサンプルのフレームをまとめて帯域パワーに変換する
+    複数チャンネル(チャンネル数, サンプル数)の入力ではチャンネルごとの帯域パワーを行で返す
+    """
+    
+    def __init__(self, rate, bands, size=AUDIO_STFT_SIZE, hop=AUDIO_STFT_HOP,
+                 factor=AUDIO_DECIMATION_FACTOR, reference_size=4096):
+        self.input_rate = rate
+        self.rate = rate / factor
+        self.size = size
+        self.hop = hop
+        self.decimator = PolyphaseDecimator(factor)
+        
+        # ハン窓で、正弦波の振幅が従来のreference_size点・矩形窓FFTと同じ値になるよう正規化
+        window = np.hanning(size)
+        self.analyzer = BandPowerAnalyzer(self.rate, size, bands, window='hanning',
+                                          scale=reference_size / window.sum())
+        self.names = self.analyzer.names
+        self.index = self.analyzer.index
+        
+        self.buffer = np.zeros(size * 4)
+        self.filled = 0  # バッファ内の未処理サンプル数（先頭から）
+        self.last_powers = np.zeros(len(self.names))
+        self.frames_total = 0
+    
+    def process(self, audio_data):
+        """チャンクを取り込み、その間に完成したフレームの帯域パワーの平均を返す"""
+        samples = self.decimator.process(audio_data)
+        lead = samples.shape[:-1]
+        
+        if self.buffer.shape[:-1] != lead:
+            # チャンネル数に合わせて作り直す（初回のみ）
+            self.buffer = np.zeros(lead + (self.size * 4,))
+            self.filled = 0
+            self.last_powers = np.zeros(lead + (len(self.names),))
+        
+        needed = self.filled + samples.shape[-1]
+        if needed > self.buffer.shape[-1]:
+            buffer = np.zeros(lead + (max(needed, self.buffer.shape[-1] * 2),))
+            buffer[..., :self.filled] = self.buffer[..., :self.filled]
+            self.buffer = buffer
+        self.buffer[..., self.filled:needed] = samples
+        self.filled = needed
+        
+        if self.filled < self.size:
+            return self.last_powers
+        
+        # 完成したフレームを一括でFFT（通常は1チャンクあたり1フレーム）
+        count = (self.filled - self.size) // self.hop + 1
+        if count == 1:
+            self.last_powers = self.analyzer.analyze(self.buffer[..., :self.size])
+        else:
+            frames = np.lib.stride_tricks.sliding_window_view(
+                self.buffer[..., :self.filled], self.size, axis=-1)[..., ::self.hop, :]
+            self.last_powers = self.analyzer.analyze(frames).mean(axis=-2)
+        self.frames_total += count
+        
+        # 次のフレームの先頭以降を前に詰める
+        consumed = count * self.hop
+        remaining = self.filled - consumed
+        self.buffer[..., :remaining] = self.buffer[..., consumed:self.filled]
+        self.filled = remaining
+        return self.last_powers
+
+
+class SpectrogramOverlay:
+    """
+    表示用のスペクトログラム（診断用オーバーレイ）
+    事前確保した循環バッファに新しいチャンクの列だけをdB変換・量子化して書き込み、
+    描画時に時間順に並べ直してカラーマップを掛ける
+    """
+    
+    def __init__(self, rate, chunk, max_freq=SPECTROGRAM_MAX_FREQ, seconds=SPECTROGRAM_SECONDS,
+                 db_range=SPECTROGRAM_DB_RANGE):
+        self.rate = rate
+        self.chunk = chunk
+        freqs = np.fft.rfftfreq(chunk, 1 / rate)
+        self.n_bins = int(np.searchsorted(freqs, max_freq, 'right'))
+        self.max_freq = freqs[self.n_bins - 1]
+        n_columns = max(2, int(seconds * rate / chunk))
+        
+        # 列ごとの色番号（0〜255）。低い周波数が下になるよう行は周波数の降順
+        self.data = np.zeros((self.n_bins, n_columns), dtype=np.uint8)
+        self.view = np.empty_like(self.data)
+        self.position = 0  # 次に書き込む列
+        
+        self.db_low, db_high = db_range
+        self.db_scale = 255.0 / (db_high - self.db_low)
+    
+    def push(self, audio_data):
+        """1チャンク分の音声の列を追加（チャンクサイズが変わったら無視）"""
+        if len(audio_data) != self.chunk:
+            return
+        amplitude = np.abs(np.fft.rfft(audio_data)[:self.n_bins]) / (self.chunk / 2)
+        db = 20 * np.log10(np.maximum(amplitude, 1e-3))
+        column = np.clip((db - self.db_low) * self.db_scale, 0, 255)
+        self.data[:, self.position] = column[::-1]
+        self.position = (self.position + 1) % self.data.shape[1]
+    
+    def image(self):
+        """古い列から順に並べた色番号の配列（表示用の配列を再利用）"""
+        position = self.position
+        tail = self.data.shape[1] - position
+        self.view[:, :tail] = self.data[:, position:]
+        self.view[:, tail:] = self.data[:, :position]
+        return self.view
+    
+    def freq_to_row(self, freq, height):
+        """周波数を高さheightに拡大した画像の行に変換"""
+        return int(round((1 - freq / self.max_freq) * (height - 1)))
+
+
+class FrameRenderer:
+    """
+    解析結果を表示用フレームに描画するレイヤー
+    GUIやプレビューの利用者がいるときだけ使い、ヘッドレス時は一切描画しない
+    """
+    
+    def render(self, camera, camera_status, audio_status, sleep_state, waveform, spectrogram=None):
+        """カメラ画像に検出枠とステータスを描画したBGRフレームを返す"""
+        if camera.gray_frame is None:
+            return None
+        
+        # グレースケール画像を3チャンネルに変換
+        frame = cv2.cvtColor(camera.gray_frame, cv2.COLOR_GRAY2BGR)
+        self.draw_detections(frame, camera.faces, camera.eyes)
+        self.draw_status(frame, camera_status, audio_status, sleep_state, waveform)
+        if spectrogram is not None:
+            self.draw_spectrogram(frame, spectrogram)
+        return frame
+    
+    def draw_detections(self, frame, faces, eyes):
+        """顔と目の枠を描画"""
+        for (x, y, w, h) in faces:
+            cv2.rectangle(frame, (x, y), (x+w, y+h), (0, 255, 0), 2)
+            cv2.putText(frame, "Face", (x, y-10), 
+                        cv2.FONT_HERSHEY_SIMPLEX, 0.6, (0, 255, 0), 2)
+        
+        for (ex, ey, ew, eh) in eyes:
+            cv2.rectangle(frame, (ex, ey), (ex+ew, ey+eh), (255, 0, 255), 2)
+            cv2.putText(frame, "Eye", (ex, ey-5), 
+                        cv2.FONT_HERSHEY_SIMPLEX, 0.4, (255, 0, 255), 1)
+    
+    def draw_status(self, frame, camera_status, audio_status, sleep_state, waveform):
+        """画面にステータスを描画"""
+        h, w = frame.shape[:2]
+        
+        # ========== 動き検知の枠 ==========
+        if camera_status['motion']:
+            cv2.rectangle(frame, (5, 5), (w-5, h-5), (0, 0, 255), 4)
+            cv2.putText(frame, "MOTION!", (w//2 - 50, 30),
+                        cv2.FONT_HERSHEY_SIMPLEX, 0.8, (0, 0, 255), 2)
+        else:
+            cv2.rectangle(frame, (5, 5), (w-5, h-5), (0, 255, 0), 2)
+        
+        # ========== ステータスパネル ==========
+        cv2.rectangle(frame, (10, 50), (280, 200), (0, 0, 0), -1)
+        cv2.rectangle(frame, (10, 50), (280, 200), (255, 255, 255), 1)
+        
+        # 動きレベル
+        motion_pct = min(100, camera_status['motion_level'] / max(camera_status['threshold'], 1) * 100)
+        motion_color = (0, 0, 255) if camera_status['motion'] else (0, 255, 0)
+        cv2.putText(frame, f"Motion: {motion_pct:.0f}%", (20, 75),
+                    cv2.FONT_HERSHEY_SIMPLEX, 0.5, motion_color, 1)
+        
+        # 動きバー
+        bar_width = int(motion_pct * 1.5)
+        cv2.rectangle(frame, (20, 80), (20 + bar_width, 90), motion_color, -1)
+        cv2.rectangle(frame, (20, 80), (170, 90), (100, 100, 100), 1)
+        
+        # 音量レベル
+        vol = int(audio_status.get('volume', 0))
+        vol_pct = min(100, vol / max(audio_status['threshold'], 1) * 100)
+        silent_color = (0, 255, 0) if audio_status['silent'] else (0, 0, 255)
+        cv2.putText(frame, f"Volume: {vol_pct:.0f}%", (20, 115),
+                    cv2.FONT_HERSHEY_SIMPLEX, 0.5, silent_color, 1)
+        
+        # 音量バー
+        vol_bar_width = int(vol_pct * 1.5)
+        cv2.rectangle(frame, (20, 120), (20 + vol_bar_width, 130), silent_color, -1)
+        cv2.rectangle(frame, (20, 120), (170, 130), (100, 100, 100), 1)
+        
+        # 目の状態（Open/Close）
+        eyes_open = camera_status.get('eyes_open', False)
+        eye_count = camera_status.get('eye_count', 0)
+        if eyes_open:
+            eyes_text = f"Eyes: OPEN ({eye_count})"
+            eyes_color = (0, 255, 255)  # シアン
+        else:
+            eyes_text = "Eyes: CLOSED"
+            eyes_color = (255, 100, 100)  # 青
+        cv2.putText(frame, eyes_text, (180, 75),
+                    cv2.FONT_HERSHEY_SIMPLEX, 0.5, eyes_color, 1)
+        
+        # いびき検出
+        snore_text = "Snore: YES" if audio_status['snore'] else "Snore: No"
+        snore_color = (0, 165, 255) if audio_status['snore'] else (128, 128, 128)
+        cv2.putText(frame, snore_text, (20, 155),
+                    cv2.FONT_HERSHEY_SIMPLEX, 0.5, snore_color, 1)
+        
+        # 呼吸パターン検出（呼吸数が推定できていれば表示）
+        breathing = audio_status.get('breathing_confidence', 0.0) >= BREATHING_CONFIDENCE_THRESHOLD
+        rate = audio_status.get('breathing_rate')
+        if breathing and rate is not None:
+            breath_text = f"Breath: {rate:.1f}/min"
+        else:
+            breath_text = "Breath: No"
+        breath_color = (0, 200, 100) if breathing else (128, 128, 128)
+        cv2.putText(frame, breath_text, (180, 115),
+                    cv2.FONT_HERSHEY_SIMPLEX, 0.5, breath_color, 1)
+        
+        # いびきパターンカウンター
+        snore_count = sleep_state['snore_count']
+        if snore_count > 0 and not sleep_state['is_sleeping']:
+            cv2.putText(frame, f"({snore_count}/{SNORE_COUNT_THRESHOLD})", (130, 155),
+                        cv2.FONT_HERSHEY_SIMPLEX, 0.4, (0, 165, 255), 1)
+        
+        # 顔検出状態
+        face_detected = camera_status['face_detected']
+        face_count = camera_status.get('face_count', 0)
+        if face_detected:
+            face_text = f"Face: Detected ({face_count})"
+            face_color = (0, 255, 0)  # 緑
+        else:
+            face_text = "Face: Not Found"
+            face_color = (100, 100, 100)  # グレー
+        cv2.putText(frame, face_text, (180, 155),
+                    cv2.FONT_HERSHEY_SIMPLEX, 0.5, face_color, 1)
+        
+        # 睡眠状態
+        if sleep_state['is_sleeping']:
+            sleep_text = "SLEEPING"
+            sleep_color = (0, 255, 0)
+        elif not face_detected:
+            sleep_text = "No Detection"
+            sleep_color = (100, 100, 100)  # グレー
+        elif sleep_state['sleep_candidate_start']:
+            remaining = SLEEP_THRESHOLD_SECONDS - (time.time() - sleep_state['sleep_candidate_start'])
+            sleep_text = f"Waiting... {int(remaining)}s"
+            sleep_color = (0, 255, 255)
+        else:
+            sleep_text = "Awake"
+            sleep_color = (255, 255, 255)
+        
+        cv2.putText(frame, sleep_text, (20, 185),
+                    cv2.FONT_HERSHEY_SIMPLEX, 0.7, sleep_color, 2)
+        
+        # ========== 音声波形の描画 ==========
+        self.draw_waveform(frame, waveform, w, h)
+    
+    def draw_waveform(self, frame, waveform, w, h):
+        """音声波形を描画"""
+        wave_height = 80
+        wave_y = h - wave_height - 10
+        wave_width = w - 20
+        
+        cv2.rectangle(frame, (10, wave_y), (10 + wave_width, wave_y + wave_height), 
+                      (30, 30, 30), -1)
+        cv2.rectangle(frame, (10, wave_y), (10 + wave_width, wave_y + wave_height), 
+                      (100, 100, 100), 1)
+        
+        cv2.putText(frame, "Audio Waveform", (15, wave_y + 15),
+                    cv2.FONT_HERSHEY_SIMPLEX, 0.4, (200, 200, 200), 1)
+        
+        num_points = min(wave_width - 20, len(waveform))
+        if num_points > 0 and len(waveform) > 0:
+            step = len(waveform) // num_points
+            if step > 0:
+                sampled = waveform[::step][:num_points]
+            else:
+                sampled = waveform[:num_points]
+            
+            max_val = max(np.abs(sampled).max(), 1)
+            normalized = sampled / max_val
+            
+            center_y = wave_y + wave_height // 2 + 5
+            cv2.line(frame, (15, center_y), (10 + wave_width - 5, center_y), 
+                     (80, 80, 80), 1)
+            
+            # 全サンプルを1回のpolylinesで描画
+            xs = 15 + np.arange(len(normalized))
+            ys = center_y - normalized * (wave_height // 2 - 10)
+            points = np.stack([xs, ys], axis=1).astype(np.int32).reshape(-1, 1, 2)
+            cv2.polylines(frame, [points], False, (0, 255, 255), 1)
+    
+    def draw_spectrogram(self, frame, spectrogram):
+        """スペクトログラムを右上に描画（いびき帯域の境界に線を引く）"""
+        h, w = frame.shape[:2]
+        panel_w = min(240, w // 3)
+        panel_h = 100
+        x = w - panel_w - 10
+        y = 50
+        if x < 290 or y + panel_h > h:
+            return  # ステータスパネルと重なる小さな画面では描画しない
+        
+        image = cv2.resize(spectrogram.image(), (panel_w, panel_h), interpolation=cv2.INTER_LINEAR)
+        frame[y:y + panel_h, x:x + panel_w] = cv2.applyColorMap(image, cv2.COLORMAP_JET)
+        cv2.rectangle(frame, (x, y), (x + panel_w, y + panel_h), (255, 255, 255), 1)
+        
+        for freq in (SNORE_FREQ_LOW, SNORE_FREQ_HIGH):
+            if freq < spectrogram.max_freq:
+                row = y + spectrogram.freq_to_row(freq, panel_h)
+                cv2.line(frame, (x, row), (x + panel_w, row), (255, 255, 255), 1)
+        
+        cv2.putText(frame, f"Spectrogram 0-{spectrogram.max_freq:.0f}Hz", (x, y - 5),
+                    cv2.FONT_HERSHEY_SIMPLEX, 0.4, (200, 200, 200), 1)
+
+
+def write_json_atomic(path, data):
+    """JSONを一時ファイルに書いてから置き換える（読み取り側が書きかけの内容を見ない）"""
+    temp_path = path + '.tmp'
+    with open(temp_path, 'w', encoding='utf-8') as f:
+        json.dump(data, f, ensure_ascii=False, separators=(',', ':'))
+    os.replace(temp_path, path)
+
+
+class AsyncHttpServer:
+    """
+    別スレッドのイベントループで動く最小限のHTTPサーバー（制御サーバー・プレビューサーバー共通）
+    派生クラスは_open()でサーバーを開き、_route()で1リクエストを処理する
+    """
+    
+    NAME = 'HTTPサーバー'
+    REASONS = {200: 'OK', 400: 'Bad Request', 404: 'Not Found', 503: 'Service Unavailable'}
+    
+    def __init__(self):
+        self.loop = None
+        self.server = None
+        self.thread = None
+        self.ready = threading.Event()
+    
+    def start(self):
+        """イベントループのスレッドを開始してサーバーを開く"""
+        self.thread = threading.Thread(target=self._run, daemon=True)
+        self.thread.start()
+        self.ready.wait(timeout=5)
+        return self.server is not None
+    
+    def _run(self):
+        self.loop = asyncio.new_event_loop()
+        asyncio.set_event_loop(self.loop)
+        try:
+            self.loop.run_until_complete(self._open())
+        except OSError as e:
+            print(f"警告: {self.NAME}を開始できません: {e}")
+            self.ready.set()
+            return
+        self.ready.set()
+        self.loop.run_forever()
+        self.loop.close()
+    
+    async def _open(self):
+        raise NotImplementedError
+    
+    async def _route(self, method, path, query, writer):
+        raise NotImplementedError
+    
+    async def _handle(self, reader, writer):
+        """1接続分のリクエストを処理"""
+        try:
+            request_line = await asyncio.wait_for(reader.readline(), 5)
+            # ヘッダーは読み飛ばす（本文は使わない）
+            while True:
+                line = await asyncio.wait_for(reader.readline(), 5)
+                if line in (b'\r\n', b'\n', b''):
+                    break
+            parts = request_line.decode('latin-1').split()
+            if len(parts) < 2:
+                return
+            url = urlsplit(parts[1])
+            await self._route(parts[0], url.path, parse_qs(url.query), writer)
+        except (asyncio.TimeoutError, asyncio.CancelledError, ConnectionError, ValueError):
+            pass
+        finally:
+            writer.close()
+    
+    async def _respond(self, writer, code, body, content_type='application/json; charset=utf-8'):
+        if isinstance(body, (bytes, str)):
+            payload = body.encode('utf-8') if isinstance(body, str) else body
+        else:
+            payload = json.dumps(body, ensure_ascii=False).encode('utf-8')
+        writer.write(f"HTTP/1.1 {code} {self.REASONS[code]}\r\n"
+                     f"Content-Type: {content_type}\r\n"
+                     f"Content-Length: {len(payload)}\r\n"
+                     f"Cache-Control: no-cache\r\n"
+                     f"Connection: close\r\n\r\n".encode('latin-1') + payload)
+        await writer.drain()
+    
+    def stop(self):
+        """接続中のリクエストを打ち切ってサーバーを閉じる"""
+        if self.loop is None or self.server is None:
+            return
+        
+        async def shutdown():
+            self.server.close()
+            await asyncio.sleep(0.1)  # 最後の状態変化を購読者へ送る時間
+            tasks = [task for task in asyncio.all_tasks() if task is not asyncio.current_task()]
+            for task in tasks:
+                task.cancel()
+            await asyncio.gather(*tasks, return_exceptions=True)
+            self.loop.stop()
+        
+        self.loop.call_soon_threadsafe(lambda: self.loop.create_task(shutdown()))
+        self.thread.join(timeout=2)
+
+
+class ControlServer(AsyncHttpServer):
+    """
+    ステータスの取得と制御を受け付けるasyncioのHTTPサーバー（Unixドメインソケット）
+    別スレッドのイベントループで動き、ステータスはメモリ上の最新値から返す
+    
+      GET  /status                  … 最新のステータス
+      GET  /status?since=N&wait=S   … 版番号がNより新しくなるまで最大S秒待って返す（ロングポーリング）
+      GET  /events                  … 状態が変わるたびにステータスを送る（Server-Sent Events）
+      POST /control/stop            … 記録を終了する
+    
+    版番号は睡眠状態などの主要な値が変わったときだけ進む（毎秒の更新では購読者を起こさない）
+    """
+    
+    NAME = '制御サーバー'
+    STATE_KEYS = ('running', 'is_sleeping', 'start_time', 'total_sleep_seconds', 'phase')
+    
+    def __init__(self, path, on_stop):
+        super().__init__()
+        self.path = path
+        self.on_stop = on_stop  # 停止要求時に呼ぶ（イベントループのスレッドから）
+        self.status = {'running': False}
+        self.version = 0
+        self.changed = None  # 版番号が進んだときにセットするイベント（毎回作り直す）
+        self.subscribers = set()  # SSE購読者のキュー
+    
+    async def _open(self):
+        if os.path.exists(self.path):
+            os.remove(self.path)  # 前回の異常終了で残ったソケット
+        self.changed = asyncio.Event()
+        self.server = await asyncio.start_unix_server(self._handle, path=self.path)
+        os.chmod(self.path, CONTROL_SOCKET_MODE)
+        try:
+            shutil.chown(self.path, group=CONTROL_SOCKET_GROUP)
+        except (LookupError, PermissionError) as e:
+            print(f"警告: 制御ソケットのグループを{CONTROL_SOCKET_GROUP}にできません（Webから接続できません）: {e}")
+        print(f"制御サーバー: {self.path}")
+    
+    def publish(self, status):
+        """最新のステータスを渡す（メインスレッドから呼ぶ）"""
+        if self.loop is not None and self.server is not None:
+            self.loop.call_soon_threadsafe(self._set_status, status)
+    
+    def _set_status(self, status):
+        changed = any(status.get(key) != self.status.get(key) for key in self.STATE_KEYS)
+        self.status = status
+        if changed:
+            self.version += 1
+            self.changed.set()
+            self.changed = asyncio.Event()
+            for subscriber in self.subscribers:
+                if subscriber.full():
+                    subscriber.get_nowait()  # 遅い購読者には最新の状態だけを送る
+                subscriber.put_nowait(self._snapshot())
+    
+    def _snapshot(self):
+        return dict(self.status, version=self.version)
+    
+    async def _route(self, method, path, query, writer):
+        if path == '/status' and method == 'GET':
+            if 'since' in query:
+                try:
+                    since = int(query['since'][0])
+                    wait = float(query.get('wait', [CONTROL_LONG_POLL_MAX])[0])
+                except ValueError:
+                    wait = None
+                if wait is None or not wait >= 0:  # NaNもここで弾く
+                    await self._respond(writer, 400, {'error': 'since must be an integer and wait a non-negative number'})
+                    return
+                await self._wait_for_change(since, wait)
+            await self._respond(writer, 200, self._snapshot())
+        elif path == '/events' and method == 'GET':
+            await self._stream_events(writer)
+        elif path == '/control/stop' and method == 'POST':
+            self.on_stop()
+            await self._respond(writer, 200, {'success': True, 'message': '停止します'})
+        else:
+            await self._respond(writer, 404, {'error': 'not found'})
+    
+    async def _wait_for_change(self, since, wait):
+        """版番号がsinceから進むか、wait秒たつまで待つ（再起動で版番号が戻った場合もすぐに返す）"""
+        if self.version != since:
+            return
+        try:
+            await asyncio.wait_for(self.changed.wait(), min(wait, CONTROL_LONG_POLL_MAX))
+        except asyncio.TimeoutError:
+            pass
+    
+    async def _stream_events(self, writer):
+        """状態が変わるたびにSSEでステータスを送る"""
+        subscriber = asyncio.Queue(maxsize=1)
+        self.subscribers.add(subscriber)
+        try:
+            writer.write(b"HTTP/1.1 200 OK\r\n"
+                         b"Content-Type: text/event-stream; charset=utf-8\r\n"
+                         b"Cache-Control: no-cache\r\n"
+                         b"Connection: close\r\n\r\n")
+            status = self._snapshot()
+            while True:
+                if status is None:
+                    writer.write(b": keepalive\n\n")
+                else:
+                    data = json.dumps(status, ensure_ascii=False)
+                    writer.write(f"id: {status['version']}\ndata: {data}\n\n".encode('utf-8'))
+                await writer.drain()
+                try:
+                    status = await asyncio.wait_for(subscriber.get(), CONTROL_SSE_KEEPALIVE)
+                except asyncio.TimeoutError:
+                    status = None
+        finally:
+            self.subscribers.discard(subscriber)
+    
+    def stop(self):
+        """最後のステータスを送ってからサーバーを閉じ、ソケットを削除"""
+        super().stop()
+        if self.server is not None and os.path.exists(self.path):
+            os.remove(self.path)
+
+
+class PreviewServer(AsyncHttpServer):
+    """
+    ヘッドレス時にカメラ映像をブラウザで確認するためのMJPEGサーバー（TCP）
+    
+      GET /                    … 映像を表示するだけのページ
+      GET /stream.mjpg?fps=N   … multipart/x-mixed-replaceのMJPEG（クライアントごとにNfpsへ間引き）
+      GET /snapshot.jpg        … 最新の1枚
+    
+    オーバーレイなしならlibcameraが出力したJPEGをそのまま送り、再エンコードしない
+    オーバーレイ付き（またはJPEGがない入力）のフレームは最初に要求されたときに1回だけエンコードし、
+    全クライアントで共有する。視聴者がいない間はメインループから描画もエンコードも行わない
+    """
+    
+    NAME = 'プレビューサーバー'
+    BOUNDARY = b'frame'
+    PAGE = ('<!DOCTYPE html><html><head><meta charset="utf-8"><title>Sleep Recorder</title></head>'
+            '<body style="margin:0;background:#000"><img src="/stream.mjpg" style="width:100%"></body></html>')
+    
+    def __init__(self, host=PREVIEW_HOST, port=PREVIEW_PORT, overlay=False):
+        super().__init__()
+        self.host = host
+        self.port = port
+        self.overlay = overlay  # Trueなら描画レイヤーの結果を送る
+        
+        # メインスレッドが参照する値（イベントループ側で代入するだけ）
+        self.client_count = 0
+        self.min_interval = 0.0  # 最もフレームレートの高いクライアントの送信間隔
+        self.last_offer = 0.0
         
-        return self.silence_threshold, self.snore_threshold
+        # イベントループ側の状態
+        self.clients = {}  # 接続ごとの送信間隔
+        self.frame_seq = 0
+        self.latest_jpeg = None  # 元のJPEG（再エンコード不要）
+        self.latest_frame = None  # エンコード前の画像
+        self.encoded = None  # (フレーム番号, JPEG) エンコード済みの共有フレーム
+        self.encode_lock = None
+        self.new_frame = None  # 新しいフレームでセットするイベント（毎回作り直す）
+        self.frames_encoded = 0
+        self.frames_sent = 0
     
-    def get_status(self):
-        """現在の状態を取得"""
-        return {
-            'silent': self.is_silent,
-            'snore': self.snore_detected,
-            'breathing': self.breathing_detected,
-            'waveform': self.waveform.copy(),
-            'volume': self.volume,
-            'threshold': self.silence_threshold
-        }
+    async def _open(self):
+        self.encode_lock = asyncio.Lock()
+        self.new_frame = asyncio.Event()
+        self.server = await asyncio.start_server(self._handle, self.host, self.port)
+        mode = "オーバーレイ付き" if self.overlay else "カメラのJPEGをそのまま送信"
+        print(f"プレビュー: http://{self.host}:{self.port}/ （{mode}）")
+        if self.host not in ('127.0.0.1', 'localhost', '::1'):
+            print(f"警告: プレビューは認証なしで{self.host}に公開されています")
     
-    def stop(self):
-        """モニタリングを停止"""
-        self.running = False
-        if self.thread:
-            self.thread.join(timeout=1)
-        if self.stream:
-            self.stream.stop_stream()
-            self.stream.close()
-        self.audio.terminate()
+    def wants_frame(self):
+        """視聴者がいて、次のフレームを送る時刻になっていればTrue（メインスレッドから呼ぶ）"""
+        return (self.client_count > 0
+                and time.monotonic() - self.last_offer >= self.min_interval)
+    
+    def publish(self, jpeg=None, frame=None):
+        """
+        新しいフレームを渡す（メインスレッドから呼ぶ）
+        jpegはそのまま送るJPEGのバイト列、frameはエンコードが必要な画像（渡した後は書き換えないこと）
+        """
+        self.last_offer = time.monotonic()
+        self.loop.call_soon_threadsafe(self._set_frame, jpeg, frame)
+    
+    def _set_frame(self, jpeg, frame):
+        self.frame_seq += 1
+        self.latest_jpeg = jpeg
+        self.latest_frame = frame
+        self.new_frame.set()
+        self.new_frame = asyncio.Event()
+    
+    async def _current_jpeg(self):
+        """最新フレームのJPEG（未エンコードならここで1回だけエンコードして共有）"""
+        async with self.encode_lock:
+            if self.encoded is None or self.encoded[0] != self.frame_seq:
+                seq, jpeg, frame = self.frame_seq, self.latest_jpeg, self.latest_frame
+                if jpeg is None:
+                    # エンコードは別スレッドで行い、他のクライアントへの送信を止めない
+                    ok, buffer = await self.loop.run_in_executor(
+                        None, cv2.imencode, '.jpg', frame, [cv2.IMWRITE_JPEG_QUALITY, PREVIEW_JPEG_QUALITY]
+                    )
+                    if not ok:
+                        return self.encoded
+                    jpeg = buffer.tobytes()
+                    self.frames_encoded += 1
+                self.encoded = (seq, jpeg)
+            return self.encoded
+    
+    def _update_clients(self):
+        self.client_count = len(self.clients)
+        self.min_interval = min(self.clients.values(), default=0.0)
+    
+    async def _route(self, method, path, query, writer):
+        if method != 'GET':
+            await self._respond(writer, 404, {'error': 'not found'})
+        elif path == '/':
+            await self._respond(writer, 200, self.PAGE, 'text/html; charset=utf-8')
+        elif path == '/stream.mjpg':
+            fps = min(max(float(query.get('fps', [PREVIEW_FPS])[0]), 0.1), PREVIEW_MAX_FPS)
+            await self._stream(writer, 1.0 / fps)
+        elif path == '/snapshot.jpg':
+            await self._snapshot(writer)
+        else:
+            await self._respond(writer, 404, {'error': 'not found'})
+    
+    async def _stream(self, writer, interval):
+        """クライアントの送信間隔を守って最新フレームを送り続ける（遅いクライアントは古いフレームを飛ばす）"""
+        if len(self.clients) >= PREVIEW_MAX_CLIENTS:
+            await self._respond(writer, 503, {'error': 'too many clients'})
+            return
+        self.clients[writer] = interval
+        self._update_clients()
+        try:
+            writer.write(b"HTTP/1.1 200 OK\r\n"
+                         b"Content-Type: multipart/x-mixed-replace; boundary=" + self.BOUNDARY + b"\r\n"
+                         b"Cache-Control: no-cache\r\n"
+                         b"Connection: close\r\n\r\n")
+            await writer.drain()
+            sent_seq = 0
+            while True:
+                while self.frame_seq == sent_seq:
+                    await self.new_frame.wait()
+                started = self.loop.time()
+                encoded = await self._current_jpeg()
+                if encoded is None:
+                    sent_seq = self.frame_seq  # エンコードに失敗したフレームは飛ばす
+                    continue
+                sent_seq, jpeg = encoded
+                writer.write(b"--" + self.BOUNDARY + b"\r\n"
+                             b"Content-Type: image/jpeg\r\n"
+                             b"Content-Length: " + str(len(jpeg)).encode() + b"\r\n\r\n" + jpeg + b"\r\n")
+                await writer.drain()
+                self.frames_sent += 1
+                await asyncio.sleep(max(0.0, interval - (self.loop.time() - started)))
+        finally:
+            del self.clients[writer]
+            self._update_clients()
+    
+    async def _snapshot(self, writer):
+        """最新の1枚を返す（視聴者として登録し、次のフレームを1枚待つ）"""
+        self.clients[writer] = 0.0
+        self._update_clients()
+        try:
+            seq = self.frame_seq
+            while self.frame_seq == seq:
+                await asyncio.wait_for(self.new_frame.wait(), 5)
+            encoded = await self._current_jpeg()
+        except asyncio.TimeoutError:
+            encoded = None  # カメラが止まっている
+        finally:
+            del self.clients[writer]
+            self._update_clients()
+        if encoded is None:
+            await self._respond(writer, 503, {'error': 'no frame'})
+        else:
+            await self._respond(writer, 200, encoded[1], 'image/jpeg')
 
 
 class SleepRecorder:
     """睡眠の判定と記録"""
     
-    def __init__(self, headless=False):
+    def __init__(self, headless=False, camera_options=None, audio_options=None, camera=None, audio=None,
+                 csv_file=CSV_FILE, db_file=SLEEP_DB_FILE, clock=None, record_dir=None, metrics=METRICS_ENABLED,
+                 skip_calibration=False, spectrogram=False, snore_clip_dir=None, feature_dir=None,
+                 control_socket=None, preview_port=None, preview_overlay=False, preview_host=PREVIEW_HOST,
+                 summary_dir=None):
         self.headless = headless  # ヘッドレスモード（GUI表示なし）
+        self.clock = clock or time.time  # 時刻取得（リプレイ時は仮想時計）
+        self.csv_file = csv_file
+        self.skip_calibration = skip_calibration  # 起動時のキャリブレーションを省略（閾値は動作中に調整）
         self.shutdown_requested = False  # シャットダウンフラグ
+        self.phase = 'starting'  # 'starting' / 'calibrating' / 'monitoring'
+        
+        # 制御・ステータスサーバー（停止要求はシャットダウンフラグを立てるだけ）
+        self.control_server = None
+        if control_socket:
+            self.control_server = ControlServer(control_socket, self._request_shutdown)
+        
+        # ライブプレビュー（視聴者がいるときだけメインループからフレームを渡す）
+        self.preview_server = None
+        if preview_port:
+            self.preview_server = PreviewServer(host=preview_host, port=preview_port, overlay=preview_overlay)
         self.start_time = None  # 記録開始時刻
         
         # シグナルハンドラー設定
         signal.signal(signal.SIGTERM, self._signal_handler)
         signal.signal(signal.SIGINT, self._signal_handler)
         
-        self.camera = CameraMonitor()
-        self.audio = AudioMonitor()
+        # カメラ・マイク（リプレイ時は外部から与える）
+        self.camera = camera or CameraMonitor(**(camera_options or {}))
+        self.audio = audio or AudioMonitor(**(audio_options or {}))
+        
+        # 処理時間の計測（無効時はNoneのままで計測処理を行わない）
+        self.metrics = PipelineMetrics() if metrics else None
+        if self.metrics is not None:
+            self.camera.attach_metrics(self.metrics)
+            self.audio.metrics = self.metrics
+        
+        # セッション記録（リプレイ用にカメラと音声の生データを保存）
+        self.session_recorder = SessionRecorder(record_dir) if record_dir else None
+        
+        # 1秒ごとの特徴量の記録
+        self.feature_store = FeatureStore(feature_dir) if feature_dir else None
+        
+        # いびき音声クリップの保存
+        self.clip_recorder = None
+        if snore_clip_dir:
+            self.clip_recorder = SnoreClipRecorder(snore_clip_dir, self.audio.rate, self.audio.channels)
+            self.audio.clip_recorder = self.clip_recorder
+        
+        # 描画レイヤー（GUI表示時とオーバーレイ付きプレビューのみ）
+        self.renderer = None
+        if not headless or (preview_port and preview_overlay):
+            self.renderer = FrameRenderer()
+        
+        # スペクトログラム表示（描画レイヤーがあるときのみ。音声スレッドで新しい列だけを計算）
+        if spectrogram and self.renderer is not None:
+            self.audio.spectrogram = SpectrogramOverlay(self.audio.rate, self.audio.chunk)
         
         self.is_sleeping = False
         self.sleep_start = None
@@ -591,21 +3889,42 @@ class SleepRecorder:
         self.last_snore_state = False  # 前回のいびき状態
         self.snore_detected_during_sleep = False
         self.total_sleep_seconds = 0  # 合計睡眠時間
+        self.sessions = []  # 今回記録した睡眠区間
         
         # CSVファイルの初期化
-        if not os.path.exists(CSV_FILE):
-            with open(CSV_FILE, 'w', newline='', encoding='utf-8') as f:
+        if not os.path.exists(self.csv_file):
+            with open(self.csv_file, 'w', newline='', encoding='utf-8') as f:
                 writer = csv.writer(f)
-                writer.writerow([
-                    'date', 'sleep_start', 'sleep_end',
-                    'duration_hours', 'duration_minutes', 'snore_detected'
-                ])
+                writer.writerow(CSV_HEADER)
+        
+        # 睡眠記録データベース（初回は既存のCSVを取り込む）
+        self.record_store = None
+        if db_file:
+            self.record_store = SleepRecordStore(db_file)
+            if self.record_store.count() == 0 and os.path.exists(self.csv_file):
+                added = self.record_store.import_csv(self.csv_file)
+                if added:
+                    print(f"CSVから{added}件の睡眠記録をデータベースに取り込みました")
+        
+        # 睡眠状態のタイムライン（データベースに保存）
+        self.timeline = SleepTimeline(self.record_store) if self.record_store is not None else None
+        
+        # 睡眠サマリー（データベースの日ごとの集計から作る）
+        self.summary_writer = None
+        if summary_dir and self.record_store is not None:
+            self.summary_writer = SleepSummaryWriter(summary_dir)
+            self.summary_writer.update(self.record_store)
     
     def _signal_handler(self, signum, frame):
         """シグナルハンドラー（SIGTERM/SIGINT）"""
         print(f"\nシグナル {signum} を受信しました。終了処理を開始...")
         self.shutdown_requested = True
     
+    def _request_shutdown(self):
+        """制御サーバーからの停止要求"""
+        print("\n停止要求を受信しました。シャットダウン中...")
+        self.shutdown_requested = True
+    
     def _write_pid_file(self):
         """PIDファイルを作成"""
         with open(PID_FILE, 'w') as f:
@@ -619,30 +3938,57 @@ class SleepRecorder:
             print("PIDファイル削除")
     
     def _update_status_file(self):
-        """ステータスファイルを更新"""
+        """ステータスを制御サーバーへ渡し、予備のステータスファイル（tmpfs）を置き換える"""
+        status = self._build_status()
+        if self.control_server is not None:
+            self.control_server.publish(status)
+        write_json_atomic(STATUS_FILE, status)
+    
+    def _build_status(self):
+        """現在のステータス"""
         status = {
             'running': True,
+            'phase': self.phase,
             'headless': self.headless,
             'start_time': self.start_time.strftime('%Y-%m-%d %H:%M:%S') if self.start_time else None,
             'is_sleeping': self.is_sleeping,
             'total_sleep_seconds': self.total_sleep_seconds,
-            'last_update': datetime.now().strftime('%Y-%m-%d %H:%M:%S')
+            'last_update': datetime.now().strftime('%Y-%m-%d %H:%M:%S'),
+            'thresholds': self._get_thresholds()
+        }
+        if self.audio.channels > 1:
+            status['audio_channels'] = self.audio.get_channel_status()
+        if self.clip_recorder is not None:
+            status['snore_clips'] = self.clip_recorder.get_stats()
+        if self.metrics is not None:
+            decode_stats = self.camera.get_decode_stats()
+            self.metrics.set_gauge('camera_frames_dropped', decode_stats['dropped'])
+            status['metrics'] = self.metrics.snapshot()
+        return status
+    
+    def _get_thresholds(self):
+        """現在の判定閾値と調整用の統計"""
+        return {
+            'adaptive': self.audio.adaptive or self.camera.adaptive,
+            'silence': self.audio.silence_adapt.snapshot(self.audio.silence_threshold),
+            'snore': self.audio.snore_adapt.snapshot(self.audio.snore_threshold),
+            'motion': self.camera.motion_adapt.snapshot(self.camera.motion_threshold)
         }
-        with open(STATUS_FILE, 'w', encoding='utf-8') as f:
-            json.dump(status, f, ensure_ascii=False, indent=2)
     
     def _clear_status_file(self):
         """ステータスファイルを停止状態に更新"""
         status = {
             'running': False,
+            'phase': 'stopped',
             'headless': self.headless,
             'start_time': None,
             'is_sleeping': False,
             'total_sleep_seconds': self.total_sleep_seconds,
             'last_update': datetime.now().strftime('%Y-%m-%d %H:%M:%S')
         }
-        with open(STATUS_FILE, 'w', encoding='utf-8') as f:
-            json.dump(status, f, ensure_ascii=False, indent=2)
+        if self.control_server is not None:
+            self.control_server.publish(status)
+        write_json_atomic(STATUS_FILE, status)
     
     def calibrate(self):
         """カメラとマイクのキャリブレーション"""
@@ -650,11 +3996,23 @@ class SleepRecorder:
         print("キャリブレーションを開始します")
         print("=" * 50)
         
-        # カメラのキャリブレーション
-        self.camera.calibrate(CALIBRATION_TIME)
-        
-        # マイクのキャリブレーション
-        self.audio.calibrate(CALIBRATION_TIME)
+        if self.audio.running:
+            # 音声はモニタリング中のストリームでカメラと並行して測定
+            print("\n静かにしてください...")
+            started = time.time()
+            self.audio.begin_calibration()
+            self.camera.calibrate(CALIBRATION_TIME)
+            # カメラがない場合も音声は所定の時間測定する
+            remaining = CALIBRATION_TIME - (time.time() - started)
+            if remaining > 0:
+                time.sleep(remaining)
+            self.audio.end_calibration()
+        else:
+            # カメラのキャリブレーション
+            self.camera.calibrate(CALIBRATION_TIME)
+            
+            # マイクのキャリブレーション
+            self.audio.calibrate(CALIBRATION_TIME)
         
         print("\n" + "=" * 50)
         print("キャリブレーション完了！")
@@ -670,8 +4028,9 @@ class SleepRecorder:
         if not camera_status['face_detected']:
             return False
         
-        # いびきまたは規則的な呼吸パターンが検出されたら睡眠判定
-        if audio_status['snore'] or audio_status.get('breathing', False):
+        # いびきまたは規則的な呼吸（呼吸数の推定の信頼度が高い）が検出されたら睡眠判定
+        regular_breathing = audio_status.get('breathing_confidence', 0.0) >= BREATHING_CONFIDENCE_THRESHOLD
+        if audio_status['snore'] or regular_breathing:
             return True
         
         # 顔が検出されている AND 動きなし AND 静寂 → 睡眠の可能性
@@ -688,16 +4047,16 @@ class SleepRecorder:
     def _start_sleep(self):
         """睡眠開始を記録"""
         self.is_sleeping = True
-        self.sleep_start = datetime.now()
+        self.sleep_start = datetime.fromtimestamp(self.clock())
         self.snore_detected_during_sleep = False
         print(f"\n=== 睡眠開始: {self.sleep_start.strftime('%H:%M:%S')} ===")
     
     def _end_sleep(self):
-        """睡眠終了を記録してCSVに保存"""
+        """睡眠終了を記録してデータベースとCSVに保存"""
         if not self.is_sleeping or not self.sleep_start:
             return
         
-        sleep_end = datetime.now()
+        sleep_end = datetime.fromtimestamp(self.clock())
         duration = sleep_end - self.sleep_start
         duration_hours = int(duration.total_seconds() // 3600)
         duration_minutes = int((duration.total_seconds() % 3600) // 60)
@@ -706,8 +4065,21 @@ class SleepRecorder:
         print(f"睡眠時間: {duration_hours}時間{duration_minutes}分")
         print(f"いびき検出: {'あり' if self.snore_detected_during_sleep else 'なし'}")
         
-        # CSVに保存
-        with open(CSV_FILE, 'a', newline='', encoding='utf-8') as f:
+        self.sessions.append({
+            'start': self.sleep_start.strftime('%Y-%m-%d %H:%M:%S'),
+            'end': sleep_end.strftime('%Y-%m-%d %H:%M:%S'),
+            'duration_seconds': duration.total_seconds(),
+            'snore': self.snore_detected_during_sleep
+        })
+        
+        # データベースに保存
+        if self.record_store is not None:
+            added = self.record_store.add(self.sleep_start, sleep_end, self.snore_detected_during_sleep)
+            if added and self.summary_writer is not None:
+                self.summary_writer.update(self.record_store)
+        
+        # 互換用のCSVにも追記
+        with open(self.csv_file, 'a', newline='', encoding='utf-8') as f:
             writer = csv.writer(f)
             writer.writerow([
                 self.sleep_start.strftime('%Y-%m-%d'),
@@ -725,6 +4097,97 @@ class SleepRecorder:
         self.sleep_start = None
         self.wake_candidate_start = None
     
+    def _process_step(self, camera_status, audio_status, current_time):
+        """カメラ・音声の解析結果から睡眠判定を1ステップ進める"""
+        # 睡眠条件をチェック
+        sleep_condition = self._check_sleep_condition(
+            camera_status, audio_status
+        )
+        
+        if sleep_condition:
+            # いびきパターン検出（60秒以内に3回でいびきと判定）
+            if audio_status['snore'] and not self.last_snore_state:
+                # いびきの立ち上がりを検出（新しいいびきイベント）
+                self.snore_events.append(current_time)
+                if self.clip_recorder is not None:
+                    self.clip_recorder.trigger(audio_status.get('snore_onset') or current_time)
+            self.last_snore_state = audio_status['snore']
+            
+            # 古いイベントを削除
+            self.snore_events = [t for t in self.snore_events 
+                                 if current_time - t < SNORE_WINDOW_SECONDS]
+            
+            # いびきパターンが確認されたら睡眠判定
+            snore_pattern = len(self.snore_events) >= SNORE_COUNT_THRESHOLD
+            if snore_pattern and not self.is_sleeping:
+                self._start_sleep()
+                self.snore_detected_during_sleep = True
+            
+            # 通常の睡眠判定（5分静止）
+            if self.sleep_candidate_start is None:
+                self.sleep_candidate_start = current_time
+            
+            elapsed = current_time - (self.sleep_candidate_start or current_time)
+            
+            if not self.is_sleeping and elapsed >= SLEEP_THRESHOLD_SECONDS:
+                self._start_sleep()
+            
+            if self.is_sleeping and audio_status['snore']:
+                self.snore_detected_during_sleep = True
+            
+            # 睡眠条件を満たしている間は起床カウンターをリセット
+            self.wake_candidate_start = None
+        else:
+            # 睡眠条件を満たしていない
+            self.sleep_candidate_start = None
+            
+            if self.is_sleeping:
+                # 起床判定の猶予時間を設ける
+                if self.wake_candidate_start is None:
+                    self.wake_candidate_start = current_time
+                
+                wake_elapsed = current_time - self.wake_candidate_start
+                
+                # 猶予時間を超えたら起床と判定
+                if wake_elapsed >= WAKE_GRACE_PERIOD:
+                    self._end_sleep()
+        
+        if self.timeline is not None:
+            self.timeline.record(current_time, self._timeline_state(camera_status, audio_status, sleep_condition))
+        
+        if self.feature_store is not None:
+            self.feature_store.record(current_time, self._feature_values(camera_status, audio_status))
+    
+    def _timeline_state(self, camera_status, audio_status, sleep_condition):
+        """タイムラインに記録する現在の状態"""
+        if audio_status['snore'] and (self.is_sleeping or sleep_condition):
+            return 'snore'
+        if camera_status.get('rollover'):
+            return 'rollover'
+        if self.is_sleeping:
+            return 'sleeping'
+        if self.sleep_candidate_start is not None:
+            return 'candidate'
+        return 'awake'
+    
+    def _feature_values(self, camera_status, audio_status):
+        """特徴量の記録に使う値"""
+        bands = audio_status.get('bands', {})
+        return {
+            'motion_level': camera_status['motion_level'],
+            'volume': audio_status['volume'],
+            'snore_power': bands.get('snore', 0.0),
+            'breathing_power': bands.get('breathing', 0.0),
+            'breathing_rate': audio_status.get('breathing_rate'),
+            'breathing_confidence': audio_status.get('breathing_confidence', 0.0),
+            'motion': camera_status['motion'],
+            'face': camera_status['face_detected'],
+            'eyes_open': camera_status['eyes_open'],
+            'silent': audio_status['silent'],
+            'snore': audio_status['snore'],
+            'sleeping': self.is_sleeping
+        }
+
     def run(self):
         """メインループ"""
         print("睡眠記録システム（赤外線カメラ対応版）")
@@ -736,8 +4199,39 @@ class SleepRecorder:
         self._write_pid_file()
         self.start_time = datetime.now()
         
-        # キャリブレーション実行
-        self.calibrate()
+        # 制御サーバーを先に開始（キャリブレーション中も状態を返せるように）
+        if self.control_server is not None:
+            self.control_server.start()
+        if self.preview_server is not None:
+            self.preview_server.start()
+        
+        # 音声の取得を先に開始（キャリブレーションも同じストリームで行う）
+        self.audio.start()
+        
+        # キャリブレーション実行（省略時は初期値から動作中に調整）
+        if self.skip_calibration:
+            print("キャリブレーションを省略します（閾値は動作中に調整）")
+        else:
+            self.phase = 'calibrating'
+            self._update_status_file()
+            self.calibrate()
+        self.phase = 'monitoring'
+        
+        # セッション記録の開始（キャリブレーション後の閾値も保存）
+        if self.session_recorder is not None:
+            self.session_recorder.update_metadata(
+                audio_rate=self.audio.rate,
+                audio_chunk=self.audio.chunk,
+                audio_frontend=self.audio.frontend,
+                audio_channels=self.audio.channels,
+                audio_channel_names=self.audio.channel_names,
+                motion_threshold=float(self.camera.motion_threshold),
+                silence_threshold=float(self.audio.silence_threshold),
+                snore_threshold=float(self.audio.snore_threshold),
+                adaptive_thresholds=self.audio.adaptive
+            )
+            self.camera.session_recorder = self.session_recorder
+            self.audio.session_recorder = self.session_recorder
         
         print("モニタリングを開始します...")
         if not self.headless:
@@ -751,94 +4245,66 @@ class SleepRecorder:
             cv2.namedWindow('Sleep Recorder (IR)', cv2.WINDOW_NORMAL)
             cv2.resizeWindow('Sleep Recorder (IR)', 800, 600)
         
-        self.audio.start()
-        
-        # ステータス更新カウンター
-        status_update_counter = 0
+        # ステータスの前回更新時刻と睡眠状態（睡眠状態が変わったらすぐに通知）
+        last_status_update = 0
+        last_sleeping = None
+        m = self.metrics
         
         try:
             while not self.shutdown_requested:
-                # カメラフレームを取得
-                frame = self.camera.update()
-                if frame is None:
-                    time.sleep(0.033)  # 約30fps
+                # ステータス更新（実時間で一定間隔ごと、カメラが止まっていても更新）
+                if (time.time() - last_status_update >= STATUS_UPDATE_INTERVAL
+                        or self.is_sleeping != last_sleeping):
+                    t0 = time.perf_counter() if m else 0.0
+                    self._update_status_file()
+                    if m:
+                        m.lap('status_write', t0)
+                        m.write_prometheus(METRICS_FILE)
+                    last_status_update = time.time()
+                    last_sleeping = self.is_sleeping
+                
+                # 新しいフレームが届くまで待機（届いたフレームごとに1回だけ処理）
+                t0 = time.perf_counter() if m else 0.0
+                if not self.camera.wait_for_frame(FRAME_WAIT_TIMEOUT):
+                    continue
+                if m:
+                    t0 = m.lap('frame_wait', t0)
+                
+                # カメラフレームを取得して解析
+                camera_status = self.camera.update()
+                if camera_status is None:
                     continue
                 
                 # 状態を取得
-                camera_status = self.camera.get_status()
                 audio_status = self.audio.get_status()
                 
-                # 睡眠条件をチェック
-                sleep_condition = self._check_sleep_condition(
-                    camera_status, audio_status
-                )
-                
-                current_time = time.time()
-                
-                if sleep_condition:
-                    # いびきパターン検出（60秒以内に3回でいびきと判定）
-                    if audio_status['snore'] and not self.last_snore_state:
-                        # いびきの立ち上がりを検出（新しいいびきイベント）
-                        self.snore_events.append(current_time)
-                    self.last_snore_state = audio_status['snore']
-                    
-                    # 古いイベントを削除
-                    self.snore_events = [t for t in self.snore_events 
-                                         if current_time - t < SNORE_WINDOW_SECONDS]
-                    
-                    # いびきパターンが確認されたら睡眠判定
-                    snore_pattern = len(self.snore_events) >= SNORE_COUNT_THRESHOLD
-                    if snore_pattern and not self.is_sleeping:
-                        self._start_sleep()
-                        self.snore_detected_during_sleep = True
-                    
-                    # 通常の睡眠判定（5分静止）
-                    if self.sleep_candidate_start is None:
-                        self.sleep_candidate_start = current_time
-                    
-                    elapsed = current_time - (self.sleep_candidate_start or current_time)
-                    
-                    if not self.is_sleeping and elapsed >= SLEEP_THRESHOLD_SECONDS:
-                        self._start_sleep()
-                    
-                    if self.is_sleeping and audio_status['snore']:
-                        self.snore_detected_during_sleep = True
-                    
-                    # 睡眠条件を満たしている間は起床カウンターをリセット
-                    self.wake_candidate_start = None
-                else:
-                    # 睡眠条件を満たしていない
-                    self.sleep_candidate_start = None
-                    
-                    if self.is_sleeping:
-                        # 起床判定の猶予時間を設ける
-                        if self.wake_candidate_start is None:
-                            self.wake_candidate_start = current_time
-                        
-                        wake_elapsed = current_time - self.wake_candidate_start
-                        
-                        # 猶予時間を超えたら起床と判定
-                        if wake_elapsed >= WAKE_GRACE_PERIOD:
-                            self._end_sleep()
-                
-                # ステータスファイル更新（10回に1回）
-                status_update_counter += 1
-                if status_update_counter >= 30:  # 約1秒ごと
-                    self._update_status_file()
-                    status_update_counter = 0
+                # 睡眠判定を1ステップ進める
+                t1 = time.perf_counter() if m else 0.0
+                self._process_step(camera_status, audio_status, self.clock())
+                if m:
+                    t1 = m.lap('decision', t1)
                 
                 # GUI表示（ヘッドレスモードでない場合のみ）
+                frame = None
                 if not self.headless:
                     # 画面に情報を表示
-                    self._draw_status(frame, camera_status, audio_status)
+                    frame = self._render_frame(camera_status, audio_status)
                     cv2.imshow('Sleep Recorder (IR)', frame)
                     
                     # 'q'キーで終了
                     if cv2.waitKey(1) & 0xFF == ord('q'):
                         break
-                else:
-                    # ヘッドレスモードでは少し待機
-                    time.sleep(0.033)
+                    if m:
+                        t1 = m.lap('render', t1)
+                
+                # プレビュー（視聴者がいて送信時刻になったときだけ）
+                if self.preview_server is not None and self.preview_server.wants_frame():
+                    self._publish_preview(camera_status, audio_status, frame)
+                    if m:
+                        m.lap('preview', t1)
+                
+                if m:
+                    m.lap('loop', t0)
         
         finally:
             if self.is_sleeping:
@@ -847,47 +4313,95 @@ class SleepRecorder:
             self.camera.release()
             self.audio.stop()
             
+            if self.session_recorder is not None:
+                self.session_recorder.close()
+            
+            if self.clip_recorder is not None:
+                self.clip_recorder.close()
+            
+            if self.feature_store is not None:
+                self.feature_store.close()
+            
             if not self.headless:
                 cv2.destroyAllWindows()
             
-            # PIDファイル削除、ステータスをクリア
+            # PIDファイル削除、ステータスをクリア（購読者に停止を通知してからサーバーを閉じる）
             self._remove_pid_file()
             self._clear_status_file()
+            if self.control_server is not None:
+                self.control_server.stop()
+            if self.preview_server is not None:
+                self.preview_server.stop()
+            if m and os.path.exists(METRICS_FILE):
+                os.remove(METRICS_FILE)
             
-            self._print_csv_log()
+            self._print_record_log()
+            if self.timeline is not None:
+                self.timeline.close()
+            if self.record_store is not None:
+                self.record_store.close()
+    
+    def _get_sleep_state(self):
+        """描画用の睡眠判定状態"""
+        return {
+            'is_sleeping': self.is_sleeping,
+            'snore_count': len(self.snore_events),
+            'sleep_candidate_start': self.sleep_candidate_start
+        }
     
-    def _print_csv_log(self):
-        """CSVファイルの内容をログに出力"""
+    def _render_frame(self, camera_status, audio_status):
+        """描画レイヤーで表示用フレームを作成"""
+        return self.renderer.render(
+            self.camera, camera_status, audio_status,
+            self._get_sleep_state(), self.audio.get_waveform(), self.audio.spectrogram
+        )
+    
+    def _publish_preview(self, camera_status, audio_status, frame):
+        """プレビューへフレームを渡す（オーバーレイなしならカメラのJPEGをそのまま渡す）"""
+        preview = self.preview_server
+        if preview.overlay:
+            if frame is None:
+                frame = self._render_frame(camera_status, audio_status)
+            if frame is not None:
+                preview.publish(frame=frame)
+        elif self.camera.current_jpeg is not None:
+            preview.publish(jpeg=self.camera.current_jpeg)
+        elif self.camera.gray_frame is not None:
+            # JPEGのない入力（共有メモリ・VideoCapture）もフレームごとに新しい配列なのでそのまま渡す
+            preview.publish(frame=self.camera.gray_frame)
+    
+    def _print_record_log(self):
+        """直近の睡眠記録をログに出力（データベースがあれば全件を読まずに直近分だけ取得）"""
         print("\n" + "=" * 50)
-        print("睡眠記録 - CSV内容")
+        print("睡眠記録")
         print("=" * 50)
         
-        if os.path.exists(CSV_FILE):
-            with open(CSV_FILE, 'r', encoding='utf-8') as f:
-                reader = csv.reader(f)
-                rows = list(reader)
-                
-                if len(rows) > 0:
-                    print(f"\n{'日付':<12} {'開始':<10} {'終了':<10} {'時間':>8} {'いびき':<6}")
-                    print("-" * 50)
-                    
-                    for row in rows[1:]:
-                        if len(row) >= 6:
-                            date = row[0]
-                            start = row[1]
-                            end = row[2]
-                            hours = row[3]
-                            mins = row[4]
-                            snore = "あり" if row[5] == "True" else "なし"
-                            duration = f"{hours}h {mins}m"
-                            print(f"{date:<12} {start:<10} {end:<10} {duration:>8} {snore:<6}")
-                    
-                    print("-" * 50)
-                    print(f"合計記録数: {len(rows) - 1}件")
-                else:
-                    print("記録がありません")
+        if self.record_store is not None:
+            rows = [csv_row(session) for session in self.record_store.sessions(limit=SLEEP_LOG_ROWS)]
+            total = self.record_store.count()
+        elif os.path.exists(self.csv_file):
+            with open(self.csv_file, 'r', encoding='utf-8') as f:
+                rows = [row[:6] for row in list(csv.reader(f))[1:] if len(row) >= 6]
+            total = len(rows)
+        else:
+            rows, total = [], 0
+        
+        if total > 0:
+            print(f"\n{'日付':<12} {'開始':<10} {'終了':<10} {'時間':>8} {'いびき':<6}")
+            print("-" * 50)
+            
+            for date, start, end, hours, mins, snore in rows:
+                snore = "あり" if str(snore) == "True" else "なし"
+                duration = f"{hours}h {mins}m"
+                print(f"{date:<12} {start:<10} {end:<10} {duration:>8} {snore:<6}")
+            
+            print("-" * 50)
+            if len(rows) < total:
+                print(f"合計記録数: {total}件（直近{len(rows)}件を表示）")
+            else:
+                print(f"合計記録数: {total}件")
         else:
-            print("CSVファイルがまだ存在しません")
+            print("記録がありません")
         
         # 今回のセッションの合計睡眠時間を表示
         total_hours = int(self.total_sleep_seconds // 3600)
@@ -898,156 +4412,92 @@ class SleepRecorder:
         print(f"【今回のセッション合計睡眠時間】")
         print(f"  {total_hours}時間 {total_mins}分 {total_secs}秒")
         print("=" * 50 + "\n")
-    
-    def _draw_status(self, frame, camera_status, audio_status):
-        """画面にステータスを描画"""
-        h, w = frame.shape[:2]
-        
-        # ========== 動き検知の枠 ==========
-        if camera_status['motion']:
-            cv2.rectangle(frame, (5, 5), (w-5, h-5), (0, 0, 255), 4)
-            cv2.putText(frame, "MOTION!", (w//2 - 50, 30),
-                        cv2.FONT_HERSHEY_SIMPLEX, 0.8, (0, 0, 255), 2)
-        else:
-            cv2.rectangle(frame, (5, 5), (w-5, h-5), (0, 255, 0), 2)
-        
-        # ========== ステータスパネル ==========
-        cv2.rectangle(frame, (10, 50), (280, 200), (0, 0, 0), -1)
-        cv2.rectangle(frame, (10, 50), (280, 200), (255, 255, 255), 1)
-        
-        # 動きレベル
-        motion_pct = min(100, camera_status['motion_level'] / max(camera_status['threshold'], 1) * 100)
-        motion_color = (0, 0, 255) if camera_status['motion'] else (0, 255, 0)
-        cv2.putText(frame, f"Motion: {motion_pct:.0f}%", (20, 75),
-                    cv2.FONT_HERSHEY_SIMPLEX, 0.5, motion_color, 1)
-        
-        # 動きバー
-        bar_width = int(motion_pct * 1.5)
-        cv2.rectangle(frame, (20, 80), (20 + bar_width, 90), motion_color, -1)
-        cv2.rectangle(frame, (20, 80), (170, 90), (100, 100, 100), 1)
-        
-        # 音量レベル
-        vol = int(audio_status.get('volume', 0))
-        vol_pct = min(100, vol / max(audio_status['threshold'], 1) * 100)
-        silent_color = (0, 255, 0) if audio_status['silent'] else (0, 0, 255)
-        cv2.putText(frame, f"Volume: {vol_pct:.0f}%", (20, 115),
-                    cv2.FONT_HERSHEY_SIMPLEX, 0.5, silent_color, 1)
-        
-        # 音量バー
-        vol_bar_width = int(vol_pct * 1.5)
-        cv2.rectangle(frame, (20, 120), (20 + vol_bar_width, 130), silent_color, -1)
-        cv2.rectangle(frame, (20, 120), (170, 130), (100, 100, 100), 1)
-        
-        # 目の状態（Open/Close）
-        eyes_open = camera_status.get('eyes_open', False)
-        eye_count = camera_status.get('eye_count', 0)
-        if eyes_open:
-            eyes_text = f"Eyes: OPEN ({eye_count})"
-            eyes_color = (0, 255, 255)  # シアン
-        else:
-            eyes_text = "Eyes: CLOSED"
-            eyes_color = (255, 100, 100)  # 青
-        cv2.putText(frame, eyes_text, (180, 75),
-                    cv2.FONT_HERSHEY_SIMPLEX, 0.5, eyes_color, 1)
-        
-        # いびき検出
-        snore_text = "Snore: YES" if audio_status['snore'] else "Snore: No"
-        snore_color = (0, 165, 255) if audio_status['snore'] else (128, 128, 128)
-        cv2.putText(frame, snore_text, (20, 155),
-                    cv2.FONT_HERSHEY_SIMPLEX, 0.5, snore_color, 1)
-        
-        # 呼吸パターン検出
-        breathing = audio_status.get('breathing', False)
-        breath_text = "Breath: YES" if breathing else "Breath: No"
-        breath_color = (0, 200, 100) if breathing else (128, 128, 128)
-        cv2.putText(frame, breath_text, (180, 115),
-                    cv2.FONT_HERSHEY_SIMPLEX, 0.5, breath_color, 1)
-        
-        # いびきパターンカウンター
-        snore_count = len(self.snore_events)
-        if snore_count > 0 and not self.is_sleeping:
-            cv2.putText(frame, f"({snore_count}/{SNORE_COUNT_THRESHOLD})", (130, 155),
-                        cv2.FONT_HERSHEY_SIMPLEX, 0.4, (0, 165, 255), 1)
-        
-        # 顔検出状態
-        face_detected = camera_status['face_detected']
-        face_count = camera_status.get('face_count', 0)
-        if face_detected:
-            face_text = f"Face: Detected ({face_count})"
-            face_color = (0, 255, 0)  # 緑
-        else:
-            face_text = "Face: Not Found"
-            face_color = (100, 100, 100)  # グレー
-        cv2.putText(frame, face_text, (180, 155),
-                    cv2.FONT_HERSHEY_SIMPLEX, 0.5, face_color, 1)
-        
-        # 睡眠状態
-        if self.is_sleeping:
-            sleep_text = "SLEEPING"
-            sleep_color = (0, 255, 0)
-        elif not face_detected:
-            sleep_text = "No Detection"
-            sleep_color = (100, 100, 100)  # グレー
-        elif self.sleep_candidate_start:
-            remaining = SLEEP_THRESHOLD_SECONDS - (time.time() - self.sleep_candidate_start)
-            sleep_text = f"Waiting... {int(remaining)}s"
-            sleep_color = (0, 255, 255)
-        else:
-            sleep_text = "Awake"
-            sleep_color = (255, 255, 255)
-        
-        cv2.putText(frame, sleep_text, (20, 185),
-                    cv2.FONT_HERSHEY_SIMPLEX, 0.7, sleep_color, 2)
-        
-        # ========== 音声波形の描画 ==========
-        waveform = audio_status.get('waveform', np.zeros(100))
-        self._draw_waveform(frame, waveform, w, h)
-    
-    def _draw_waveform(self, frame, waveform, w, h):
-        """音声波形を描画"""
-        wave_height = 80
-        wave_y = h - wave_height - 10
-        wave_width = w - 20
-        
-        cv2.rectangle(frame, (10, wave_y), (10 + wave_width, wave_y + wave_height), 
-                      (30, 30, 30), -1)
-        cv2.rectangle(frame, (10, wave_y), (10 + wave_width, wave_y + wave_height), 
-                      (100, 100, 100), 1)
-        
-        cv2.putText(frame, "Audio Waveform", (15, wave_y + 15),
-                    cv2.FONT_HERSHEY_SIMPLEX, 0.4, (200, 200, 200), 1)
-        
-        num_points = min(wave_width - 20, len(waveform))
-        if num_points > 0 and len(waveform) > 0:
-            step = len(waveform) // num_points
-            if step > 0:
-                sampled = waveform[::step][:num_points]
-            else:
-                sampled = waveform[:num_points]
-            
-            max_val = max(np.abs(sampled).max(), 1)
-            normalized = sampled / max_val
-            
-            center_y = wave_y + wave_height // 2 + 5
-            cv2.line(frame, (15, center_y), (10 + wave_width - 5, center_y), 
-                     (80, 80, 80), 1)
-            
-            points = []
-            for i, val in enumerate(normalized):
-                x = 15 + i
-                y = int(center_y - val * (wave_height // 2 - 10))
-                points.append((x, y))
-            
-            for i in range(1, len(points)):
-                color = (0, 255, 255)
-                cv2.line(frame, points[i-1], points[i], color, 1)
 
 
 if __name__ == "__main__":
     parser = argparse.ArgumentParser(description='睡眠記録システム')
     parser.add_argument('--headless', action='store_true', 
                         help='ヘッドレスモード（GUI表示なし）')
+    parser.add_argument('--eager-decode', action='store_true',
+                        help='全フレームを読み取りスレッドでデコード（遅延デコードを無効化）')
+    parser.add_argument('--decode-scale', type=int, choices=[1, 2, 4], default=JPEG_DECODE_SCALE,
+                        help='JPEGデコード時の縮小率（遅延デコード時のみ有効）')
+    parser.add_argument('--face-backend', choices=['haar', 'lbp'], default=FACE_DETECTOR_BACKEND,
+                        help='顔検出バックエンド（lbpは高速だが精度がやや低い）')
+    parser.add_argument('--motion-scale', type=float, default=MOTION_SCALE,
+                        help='動き検知に使うフレームの縮小率（1.0で等倍）')
+    parser.add_argument('--motion-background', action='store_true',
+                        help='前フレームではなく背景モデルとの差分で動きを検知')
+    parser.add_argument('--camera-process', action='store_true',
+                        help='カメラの取得・デコードを別プロセスで実行（共有メモリで受け渡し）')
+    parser.add_argument('--audio-frontend', choices=['fft', 'stft'], default=AUDIO_FRONTEND,
+                        help='音声解析方式（stft: 間引き後のSTFTで低周波の分解能を上げ、FFT量を削減）')
+    parser.add_argument('--audio-capture', choices=['callback', 'blocking'], default=AUDIO_CAPTURE_MODE,
+                        help='音声取得方式（callback: コールバックでリングバッファへ取り込み、解析の遅れで音声を失わない）')
+    parser.add_argument('--audio-device', action='append', metavar='NAME',
+                        help='使う入力デバイス名（部分一致、複数指定で複数デバイスを同時に取得）')
+    parser.add_argument('--audio-channels', type=int, default=AUDIO_CHANNELS,
+                        help='デバイスごとのチャンネル数（マルチチャンネルマイク用）')
+    parser.add_argument('--record', metavar='DIR',
+                        help='カメラと音声の生データをDIRに記録（replay.pyで再生可能）')
+    parser.add_argument('--metrics', action='store_true',
+                        help='処理段階ごとの処理時間を計測してステータスファイルとMETRICS_FILEに出力')
+    parser.add_argument('--snore-clips', nargs='?', const=SNORE_CLIP_DIR, metavar='DIR',
+                        help='いびき開始前後の音声をgzip圧縮WAVで保存（DIR省略時はSNORE_CLIP_DIR）')
+    parser.add_argument('--features', default=FEATURE_STORE_DIR if FEATURE_STORE_ENABLED else None, metavar='DIR',
+                        help='1秒ごとの特徴量を夜ごとのメモリマップ列ファイルとして保存するディレクトリ')
+    parser.add_argument('--no-features', action='store_true',
+                        help='特徴量の時系列を保存しない')
+    parser.add_argument('--db', default=SLEEP_DB_FILE if SLEEP_DB_ENABLED else None, metavar='FILE',
+                        help='睡眠記録を保存するSQLiteデータベース')
+    parser.add_argument('--no-db', action='store_true',
+                        help='睡眠記録をデータベースに保存しない（CSVのみ）')
+    parser.add_argument('--summary', default=SUMMARY_DIR if SUMMARY_ENABLED else None, metavar='DIR',
+                        help='日・週・月ごとの睡眠サマリーJSONを書き出すディレクトリ')
+    parser.add_argument('--no-summary', action='store_true',
+                        help='睡眠サマリーを書き出さない')
+    parser.add_argument('--no-control-server', action='store_true',
+                        help='制御・ステータスサーバー（Unixドメインソケット）を起動しない')
+    parser.add_argument('--preview', type=int, nargs='?', const=PREVIEW_PORT, metavar='PORT',
+                        help=f'ブラウザ用のMJPEGプレビューを開始（既定ポート: {PREVIEW_PORT}）')
+    parser.add_argument('--preview-overlay', action='store_true',
+                        help='プレビューに検出枠とステータスを描画（フレームごとに1回エンコード）')
+    parser.add_argument('--preview-host', default=PREVIEW_HOST, metavar='HOST',
+                        help=f'プレビューを待ち受けるアドレス（既定: {PREVIEW_HOST}。認証がないので公開する場合のみ指定）')
+    parser.add_argument('--spectrogram', action='store_true',
+                        help='音声のスペクトログラムを画面に重ねて表示（診断用、GUI表示時とオーバーレイ付きプレビューのみ）')
+    parser.add_argument('--skip-calibration', action='store_true',
+                        help='起動時のキャリブレーションを省略（閾値は静かな区間の統計から動作中に調整）')
+    parser.add_argument('--fixed-thresholds', action='store_true',
+                        help='閾値のオンライン調整を無効化（キャリブレーション結果のまま固定）')
     args = parser.parse_args()
     
-    recorder = SleepRecorder(headless=args.headless)
+    camera_options = {
+        'lazy_decode': not args.eager_decode,
+        'decode_scale': args.decode_scale,
+        'face_backend': args.face_backend,
+        'motion_scale': args.motion_scale,
+        'motion_background': args.motion_background,
+        'use_process': args.camera_process,
+        'adaptive': not args.fixed_thresholds,
+    }
+    audio_options = {
+        'frontend': args.audio_frontend,
+        'capture_mode': args.audio_capture,
+        'adaptive': not args.fixed_thresholds,
+        'devices': args.audio_device or AUDIO_DEVICES,
+        'channels': args.audio_channels,
+    }
+    recorder = SleepRecorder(headless=args.headless, camera_options=camera_options,
+                             audio_options=audio_options,
+                             record_dir=args.record, metrics=args.metrics or METRICS_ENABLED,
+                             skip_calibration=args.skip_calibration, spectrogram=args.spectrogram,
+                             snore_clip_dir=args.snore_clips,
+                             feature_dir=None if args.no_features else args.features,
+                             db_file=None if args.no_db else args.db,
+                             summary_dir=None if args.no_summary else args.summary,
+                             control_socket=None if args.no_control_server or not CONTROL_SERVER_ENABLED
+                             else CONTROL_SOCKET,
+                             preview_port=args.preview, preview_overlay=args.preview_overlay,
+                             preview_host=args.preview_host)
     recorder.run()
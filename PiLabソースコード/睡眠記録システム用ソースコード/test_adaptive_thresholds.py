@@ -0,0 +1,145 @@
+"""
+睡眠記録システム - 閾値のオンライン調整のテスト
+動き・いびきが続いても閾値が押し上げられず、検出が続くことを確認する（ハードウェア不要）
+
+使用方法:
+  python -m pytest test_adaptive_thresholds.py
+"""
+
+import cv2
+import numpy as np
+
+from sleep_recorder import AudioMonitor, CameraMonitor
+from replay import VirtualClock
+
+FRAME_INTERVAL = 1 / 15  # libcamera-vidのフレームレート
+FRAME_SIZE = (320, 240)
+
+
+def _jpeg(frame):
+    ok, jpeg = cv2.imencode('.jpg', frame)
+    assert ok
+    return jpeg.tobytes()
+
+
+def _feed_frames(camera, clock, frames):
+    """フレームを順に処理して、動きを検出したフレーム数を返す"""
+    detected = 0
+    for frame in frames:
+        clock.now += FRAME_INTERVAL
+        camera.feed_mjpeg(_jpeg(frame))
+        camera.update()
+        detected += camera.motion_detected
+    return detected
+
+
+def test_motion_threshold_ignores_sustained_movement():
+    """落ち着きなく動き続けても動き検知閾値が上がらない"""
+    rng = np.random.default_rng(0)
+    width, height = FRAME_SIZE
+    background = np.full((height, width), 40, np.uint8)
+
+    def quiet():
+        # 暗い背景に、センサーノイズのような小さな明るい点がランダムに現れる
+        frame = background.copy()
+        for _ in range(rng.poisson(4)):
+            x, y = rng.integers(0, width - 10), rng.integers(0, height - 10)
+            frame[y:y + 10, x:x + 10] = 150
+        return frame
+
+    def moving(i):
+        frame = quiet()
+        x = 20 + (i * 17) % (width - 60)
+        cv2.rectangle(frame, (x, 60), (x + 40, 150), 200, -1)
+        return frame
+
+    clock = VirtualClock(0.0)
+    camera = CameraMonitor(open_device=False, clock=clock, adaptive=True)
+    try:
+        # 静止状態で統計を作る
+        _feed_frames(camera, clock, [quiet() for _ in range(300)])
+        assert camera.motion_adapt.ready()
+        threshold = camera.motion_threshold
+
+        # 1分間、6割のフレームで大きく動く
+        frames = [moving(i) if rng.random() < 0.6 else quiet() for i in range(int(60 / FRAME_INTERVAL))]
+        detected = _feed_frames(camera, clock, frames)
+
+        assert camera.motion_threshold <= threshold * 1.1
+        assert camera.motion_adapt.skipped > 0
+        assert detected > 0.5 * len(frames)
+        assert camera.motion_detected
+    finally:
+        camera.release()
+
+
+def test_snore_threshold_ignores_intermittent_snoring():
+    """いびきが断続的に続いても、いびき閾値が上がらず検出が続く"""
+    rng = np.random.default_rng(1)
+    clock = VirtualClock(0.0)
+    audio = AudioMonitor(open_device=False, clock=clock, adaptive=True)
+    t = np.arange(audio.chunk) / audio.rate
+
+    def chunk(snore):
+        samples = rng.normal(0, 30, audio.chunk)
+        if snore:
+            samples += 3000 * np.sin(2 * np.pi * 150 * t)
+        return samples.astype(np.int16)
+
+    # キャリブレーション後、静かな区間で統計を作る
+    audio.begin_calibration()
+    for _ in range(100):
+        audio.process_chunk(chunk(False))
+    audio.end_calibration()
+    for _ in range(200):
+        audio.process_chunk(chunk(False))
+    assert audio.snore_adapt.ready()
+    snore_threshold = audio.snore_threshold
+    silence_threshold = audio.silence_threshold
+
+    # 10分間、3チャンクに1回いびき
+    chunks_per_minute = int(60 * audio.rate / audio.chunk)
+    snores = detected = 0
+    for i in range(10 * chunks_per_minute):
+        snore = i % 3 == 0
+        audio.process_chunk(chunk(snore))
+        if snore:
+            snores += 1
+            detected += audio.snore_detected
+
+    assert audio.snore_threshold <= snore_threshold * 1.1
+    assert audio.silence_threshold <= silence_threshold * 1.1
+    assert detected == snores
+
+
+def test_silence_threshold_follows_rising_noise_floor():
+    """空調が入るなどして背景雑音が上がっても、静寂閾値が追従して静寂判定に戻る"""
+    rng = np.random.default_rng(2)
+    clock = VirtualClock(0.0)
+    audio = AudioMonitor(open_device=False, clock=clock, adaptive=True)
+
+    def chunk(level):
+        return rng.normal(0, level, audio.chunk).astype(np.int16)
+
+    audio.begin_calibration()
+    for _ in range(100):
+        audio.process_chunk(chunk(200))
+    audio.end_calibration()
+    for _ in range(200):
+        audio.process_chunk(chunk(200))
+    silence_threshold = audio.silence_threshold
+    assert audio.is_silent
+
+    # 背景雑音が2倍になると、直後は静寂と判定されない
+    chunks_per_minute = int(60 * audio.rate / audio.chunk)
+    for _ in range(chunks_per_minute):
+        audio.process_chunk(chunk(400))
+    assert not audio.is_silent
+
+    # そのまま20分続くと背景レベルとして学習する
+    for _ in range(20 * chunks_per_minute):
+        audio.process_chunk(chunk(400))
+
+    assert audio.silence_threshold > 1.5 * silence_threshold
+    assert audio.is_silent
+    assert not audio.snore_detected
@@ -0,0 +1,185 @@
+"""
+睡眠記録システム - WAV一括解析
+一晩分のWAVファイルからAudioMonitorと同じ特徴量（音量・いびき帯域パワー・呼吸帯域パワー・
+いびき判定）をチャンクごとに計算し、特徴量テーブルとして保存する
+チャンクは2次元配列に並べてrfftを一括で計算し、長いファイルは一定サイズのブロックごとに読み込む
+複数チャンネルのWAVはAudioMonitorと同じくチャンネルごとに解析して統合する
+（音量はチャンネルの平均、帯域パワーは最大のチャンネル、静寂は全チャンネルが静かなとき）
+
+使用方法:
+  python wav_analyzer.py night.wav                              # 集計を表示
+  python wav_analyzer.py night.wav --output night.npy           # 特徴量テーブルを保存（.npy / .csv）
+  python wav_analyzer.py night.wav --snore-threshold 80000      # 閾値を変えて再判定
+"""
+
+import argparse
+import time
+import wave
+
+import numpy as np
+
+from sleep_recorder import (
+    AUDIO_EXTRA_BANDS,
+    AUDIO_HISTORY_SIZE,
+    BREATHING_FREQ_HIGH,
+    BREATHING_FREQ_LOW,
+    SNORE_FREQ_HIGH,
+    SNORE_FREQ_LOW,
+    BandPowerAnalyzer,
+)
+
+# 解析設定
+DEFAULT_CHUNK = 4096  # AudioMonitorと同じチャンクサイズ
+DEFAULT_SILENCE_THRESHOLD = 300  # AudioMonitorの初期値（キャリブレーション前）
+DEFAULT_SNORE_THRESHOLD = 5000
+BLOCK_CHUNKS = 512  # 一度に読み込むチャンク数（4096サンプルなら約16MBの作業領域）
+
+# 特徴量テーブルの形式（1行 = 1チャンク）
+FEATURE_DTYPE = np.dtype([
+    ('t', '<f8'),  # チャンク先頭の時刻（ファイル先頭からの秒）
+    ('volume', '<f4'),  # 平均絶対振幅
+    ('snore_power', '<f4'),
+    ('breathing_power', '<f4'),
+    ('silent', '?'),  # 直近の音量平均が静寂閾値未満
+    ('snore', '?'),  # いびき帯域パワーが閾値超え
+    ('snore_onset', '?'),  # いびきの立ち上がり（いびきイベント）
+])
+
+
+def _read_block(wav, chunk, block_chunks):
+    """
+    WAVから最大block_chunks個のチャンクを読み込む（端数は捨てる）
+    モノラルは(チャンク数, chunk)、複数チャンネルは(チャンク数, チャンネル数, chunk)の配列で返す
+    """
+    channels = wav.getnchannels()
+    data = wav.readframes(chunk * block_chunks)
+    samples = np.frombuffer(data, dtype='<i2')
+    count = len(samples) // (chunk * channels)
+    # 重なりのないチャンクなのでreshapeだけで並べられる（コピーなし、複数チャンネルは転置したビュー）
+    if channels == 1:
+        return samples[:count * chunk].reshape(count, chunk)
+    return samples[:count * chunk * channels].reshape(count, chunk, channels).transpose(0, 2, 1)
+
+
+def iter_feature_blocks(path, chunk=DEFAULT_CHUNK, silence_threshold=DEFAULT_SILENCE_THRESHOLD,
+                        snore_threshold=DEFAULT_SNORE_THRESHOLD, block_chunks=BLOCK_CHUNKS):
+    """WAVをブロックごとに解析し、特徴量テーブルの断片を順に返す"""
+    with wave.open(path, 'rb') as wav:
+        if wav.getsampwidth() != 2:
+            raise ValueError("16bit PCMのWAVのみ対応しています")
+        rate = wav.getframerate()
+        
+        bands = {
+            'snore': (SNORE_FREQ_LOW, SNORE_FREQ_HIGH),
+            'breathing': (BREATHING_FREQ_LOW, BREATHING_FREQ_HIGH),
+            **AUDIO_EXTRA_BANDS
+        }
+        analyzer = BandPowerAnalyzer(rate, chunk, bands)
+        
+        # ブロックをまたいで引き継ぐ状態（直近の音量と前チャンクのいびき判定）
+        previous_volumes = np.zeros(0)
+        previous_snore = False
+        index = 0
+        
+        while True:
+            frames = _read_block(wav, chunk, block_chunks)
+            count = len(frames)
+            if count == 0:
+                break
+            
+            table = np.zeros(count, dtype=FEATURE_DTYPE)
+            table['t'] = (index + np.arange(count)) * chunk / rate
+            
+            # 音量（平均絶対振幅、チャンネルごと）
+            volume = np.abs(frames.astype(np.int32)).mean(axis=-1)
+            table['volume'] = volume if volume.ndim == 1 else volume.mean(axis=1)
+            
+            # 帯域パワーをまとめて計算（チャンクごとの行、複数チャンネルは最も大きいチャンネル）
+            powers = analyzer.analyze(frames)
+            if powers.ndim == 3:
+                powers = powers.max(axis=1)
+            table['snore_power'] = powers[:, analyzer.index['snore']]
+            table['breathing_power'] = powers[:, analyzer.index['breathing']]
+            
+            # 静寂判定: 直近AUDIO_HISTORY_SIZEチャンクの音量平均（前ブロックの末尾も含めて累積和で計算）
+            # 複数チャンネルはチャンネルごとに判定し、全チャンネルが静かなら静寂
+            if len(previous_volumes) == 0:
+                previous_volumes = volume[:0]
+            history = np.concatenate((previous_volumes, volume))
+            cumulative = np.concatenate((np.zeros((1,) + history.shape[1:]), np.cumsum(history, axis=0)))
+            ends = np.arange(len(previous_volumes), len(history)) + 1
+            starts = np.maximum(0, ends - AUDIO_HISTORY_SIZE)
+            counts = (ends - starts).reshape((-1,) + (1,) * (history.ndim - 1))
+            silent = (cumulative[ends] - cumulative[starts]) / counts < silence_threshold
+            table['silent'] = silent if silent.ndim == 1 else silent.all(axis=1)
+            previous_volumes = history[-(AUDIO_HISTORY_SIZE - 1):]
+            
+            # いびき判定と立ち上がり
+            snore = table['snore_power'] > snore_threshold
+            table['snore'] = snore
+            table['snore_onset'] = snore & ~np.concatenate(([previous_snore], snore[:-1]))
+            previous_snore = bool(snore[-1])
+            
+            index += count
+            yield table
+
+
+def analyze_wav(path, **options):
+    """WAV全体を解析して特徴量テーブルを返す"""
+    blocks = list(iter_feature_blocks(path, **options))
+    if not blocks:
+        return np.zeros(0, dtype=FEATURE_DTYPE)
+    return np.concatenate(blocks)
+
+
+def save_features(table, path):
+    """特徴量テーブルを保存（拡張子が.csvならCSV、それ以外は.npy）"""
+    if path.endswith('.csv'):
+        header = ','.join(FEATURE_DTYPE.names)
+        fmt = ['%.3f', '%.1f', '%.1f', '%.1f', '%d', '%d', '%d']
+        np.savetxt(path, table, delimiter=',', header=header, comments='', fmt=fmt)
+    else:
+        np.save(path, table)
+
+
+def print_summary(table, elapsed):
+    """解析結果の集計を表示"""
+    if len(table) == 0:
+        print("解析できるチャンクがありません")
+        return
+    chunk_seconds = table['t'][1] - table['t'][0] if len(table) > 1 else 0.0
+    duration = table['t'][-1] + chunk_seconds
+    
+    print("\n" + "=" * 50)
+    print(f"チャンク数: {len(table)}  音声の長さ: {duration / 3600:.2f}時間")
+    print(f"処理時間: {elapsed:.1f}秒（{duration / elapsed if elapsed > 0 else 0:.0f}倍速）")
+    print("-" * 50)
+    print(f"静寂の割合: {table['silent'].mean() * 100:.1f}%")
+    print(f"いびきチャンク: {int(table['snore'].sum())}  いびきイベント: {int(table['snore_onset'].sum())}")
+    print(f"平均音量: {table['volume'].mean():.1f}  いびき帯域パワー(p99): "
+          f"{np.percentile(table['snore_power'], 99):.0f}")
+    print("=" * 50)
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description='一晩分のWAVをチャンクごとに一括解析')
+    parser.add_argument('wav', help='16bit PCMのWAVファイル')
+    parser.add_argument('--output', help='特徴量テーブルの保存先（.npy / .csv）')
+    parser.add_argument('--chunk', type=int, default=DEFAULT_CHUNK, help='チャンクサイズ（サンプル数）')
+    parser.add_argument('--silence-threshold', type=float, default=DEFAULT_SILENCE_THRESHOLD,
+                        help='静寂閾値（平均絶対振幅）')
+    parser.add_argument('--snore-threshold', type=float, default=DEFAULT_SNORE_THRESHOLD,
+                        help='いびき閾値（いびき帯域パワー）')
+    parser.add_argument('--block-chunks', type=int, default=BLOCK_CHUNKS,
+                        help='一度に読み込むチャンク数（メモリ使用量の上限）')
+    args = parser.parse_args()
+    
+    start = time.perf_counter()
+    table = analyze_wav(args.wav, chunk=args.chunk, silence_threshold=args.silence_threshold,
+                        snore_threshold=args.snore_threshold, block_chunks=args.block_chunks)
+    elapsed = time.perf_counter() - start
+    
+    print_summary(table, elapsed)
+    if args.output:
+        save_features(table, args.output)
+        print(f"特徴量テーブルを保存しました: {args.output}")
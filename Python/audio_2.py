@@ -9,14 +9,21 @@ FORMAT = pyaudio.paInt16
 CHANNELS = 1
 RATE = 16000
 
+# 実数FFTのビン範囲（100Hz < f < 300Hz）はチャンクサイズが同じなら毎回同じなので事前に計算
+_freqs = np.fft.rfftfreq(CHUNK, 1/RATE)
+_low_start = np.searchsorted(_freqs, 100, 'right')
+_low_end = np.searchsorted(_freqs, 300, 'left')
+
 def is_snore(audio_data, rms_threshold=1000, ratio_threshold=0.01):
     try:
         rms = np.sqrt(np.mean(audio_data**2))
-        fft = np.fft.fft(audio_data)
-        freqs = np.fft.fftfreq(len(audio_data), 1/RATE)
-        fft_magnitude = np.abs(fft)
-        low_freq_power = np.sum(fft_magnitude[(freqs > 100) & (freqs < 300)])
-        ratio = low_freq_power / np.sum(fft_magnitude)
+        fft_magnitude = np.abs(np.fft.rfft(audio_data))
+        low_freq_power = np.sum(fft_magnitude[_low_start:_low_end])
+        # 全体のパワーは負の周波数側も含めた値（直流とナイキスト以外は2倍）
+        total_power = 2 * np.sum(fft_magnitude) - fft_magnitude[0]
+        if len(audio_data) % 2 == 0:
+            total_power -= fft_magnitude[-1]
+        ratio = low_freq_power / total_power
         print(f"RMS: {rms:.1f}, low_freq_ratio: {ratio:.2f}")
         return rms > rms_threshold and ratio > ratio_threshold
     except Exception as e:
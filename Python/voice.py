@@ -1,3 +1,5 @@
+import sys
+import time
 import numpy as np
 import queue
 import threading
@@ -8,6 +10,13 @@ from scipy import fftpack
 # キュー
 data_queue = queue.Queue()
 
+# 表示設定
+MAX_CHART_TIME = 10  # 最大保持時間（秒）
+MAX_FREQ = 6500  # 表示する最大周波数（Hz）
+REDRAW_INTERVAL = 0.1  # 再描画の間隔（秒）。チャンクの到着間隔とは独立
+MAX_BATCH = 64  # 1回にキューから取り出す最大チャンク数
+DB_FLOOR = -20.0  # 振幅0のときのdB値（log10(0)を避ける）
+
 def record_thread(index, samplerate, frames_per_buffer):
     """リアルタイムに音声を録音するスレッド"""
 
@@ -27,18 +36,23 @@ def record_thread(index, samplerate, frames_per_buffer):
         pa.terminate()
         
         
-def get_mic_index():
-    ''' マイクチャンネルのindexをリストで取得する '''
+def get_mic_index(name=None):
+    ''' マイクチャンネルのindexを取得する（nameを指定するとデバイス名の部分一致で選ぶ） '''
  
     # 最大入力チャンネル数が0でない項目をマイクチャンネルとしてリストに追加
     pa = pyaudio.PyAudio()
     mic_list = []
     for i in range(pa.get_device_count()):
-        num_of_input_ch = pa.get_device_info_by_index(i)['maxInputChannels']
+        info = pa.get_device_info_by_index(i)
+        num_of_input_ch = info['maxInputChannels']
  
         if num_of_input_ch != 0:
-            mic_list.append(pa.get_device_info_by_index(i)['index'])
+            if name is None or name.lower() in info['name'].lower():
+                mic_list.append(info['index'])
+    pa.terminate()
  
+    if not mic_list:
+        raise ValueError(f"入力デバイスが見つかりません: {name}")
     return mic_list[0]
 
 
@@ -54,11 +68,71 @@ def calc_fft(data, samplerate):
 
     return spectrum, amp, phase, freq
 
+
+def calc_amplitude_db(frames, n_bins):
+    """複数チャンク（チャンク数, サンプル数）の振幅スペクトルをまとめてdBに変換（下からn_bins個のビン）"""
+
+    # 実数FFTで正の周波数だけを計算し、振幅の正規化はcalc_fftと同じ
+    amp = np.abs(np.fft.rfft(frames, axis=-1)[:, :n_bins]) / (frames.shape[-1] / 2)
+    return 20 * np.log10(np.maximum(amp / 2e-5, 10 ** (DB_FLOOR / 20)))
+
+
+class SpectrogramBuffer:
+    """
+    スペクトログラム用の循環2次元バッファ
+    列（時間）を事前確保した配列に書き込み位置を進めながら上書きし、表示時だけ時間順に並べ直す
+    """
+
+    def __init__(self, n_bins, n_columns):
+        self.data = np.full((n_bins, n_columns), DB_FLOOR, dtype=np.float32)
+        self.view = np.empty_like(self.data)  # 時間順に並べ直した表示用
+        self.position = 0  # 次に書き込む列
+        self.dirty = False  # 前回の表示以降に書き込みがあったか
+
+    def push(self, columns_db):
+        """新しい列（チャンク数, ビン数）を書き込む"""
+        n_columns = self.data.shape[1]
+        columns = columns_db[-n_columns:]  # バッファより多ければ古い列は捨てる
+        while len(columns) > 0:
+            # 配列の末尾で折り返すので、最大2回に分けて書き込む
+            block = columns[:n_columns - self.position]
+            self.data[:, self.position:self.position + len(block)] = block.T
+            self.position = (self.position + len(block)) % n_columns
+            columns = columns[len(block):]
+        self.dirty = True
+
+    def ordered(self):
+        """古い列から順に並べた配列を返す（表示用の配列を再利用）"""
+        tail = self.data.shape[1] - self.position
+        self.view[:, :tail] = self.data[:, self.position:]
+        self.view[:, tail:] = self.data[:, :self.position]
+        self.dirty = False
+        return self.view
+
+
+def drain_queue(timeout):
+    """キューにたまったチャンクをまとめて取り出す（空ならtimeoutまで待つ）"""
+
+    try:
+        batch = [data_queue.get(timeout=timeout)]
+    except queue.Empty:
+        return None
+    while len(batch) < MAX_BATCH:
+        try:
+            batch.append(data_queue.get_nowait())
+        except queue.Empty:
+            break
+    return np.stack(batch)
+
+
 def plot_waveform(samplerate, frames_per_buffer):
-    """波形をプロットする関数"""
+    """スペクトログラムをプロットする関数（ブリッティングで画像だけを再描画）"""
     
-    # 最大保持時間
-    max_chart_time = 10
+    # 表示するビン数と列数
+    n_bins = min(frames_per_buffer // 2, int(MAX_FREQ * frames_per_buffer / samplerate) + 1)
+    n_columns = int(samplerate * MAX_CHART_TIME / frames_per_buffer)
+    spectrogram = SpectrogramBuffer(n_bins, n_columns)
+    max_freq = n_bins * samplerate / frames_per_buffer
 
     # プロットの設定
     plt.rcParams['font.size'] = 14
@@ -69,46 +143,54 @@ def plot_waveform(samplerate, frames_per_buffer):
     ax.set_xlabel('Time [s]')
     ax.set_ylabel('Frequency [Hz]')
     
-    # スペクトログラムの初期データ
-    initial_data = np.zeros((frames_per_buffer // 2, int(samplerate * max_chart_time / frames_per_buffer)))
-    im = ax.imshow(20 * np.log10(initial_data), aspect='auto', extent=[0, max_chart_time, 0, samplerate // 2], cmap='jet', vmin=0, vmax=60)
+    # スペクトログラムの初期データ（レイアウトは最初に1回だけ決める）
+    im = ax.imshow(spectrogram.ordered(), aspect='auto', origin='lower', extent=[0, MAX_CHART_TIME, 0, max_freq],
+                   cmap='jet', vmin=0, vmax=60, animated=True)
     cbar = fig.colorbar(im)
     cbar.set_label('Noise level[dB]')
+    ax.set_xlim(0, MAX_CHART_TIME)
+    ax.set_ylim(0, max_freq)
+    fig.tight_layout()
 
-    # スペクトログラムチャートデータ（初期値は2次元の0配列）
-    history_amp = initial_data
+    # 背景（軸・目盛り・カラーバー）を保存し、以降は画像だけを描き直す
+    # ウィンドウのサイズ変更などで全体が再描画されたら背景を取り直す
+    background = None
+
+    def on_draw(event):
+        nonlocal background
+        background = fig.canvas.copy_from_bbox(fig.bbox)
+        ax.draw_artist(im)
+
+    fig.canvas.mpl_connect('draw_event', on_draw)
+    plt.show(block=False)
+    plt.pause(0.1)
 
     # プロットループ
+    last_redraw = 0.0
     while plt.fignum_exists(fig.number):
-        if not data_queue.empty():
-            # デキュー
-            data = data_queue.get()
-            
-            # FFTを実行して振幅を計算
-            spectrum, amp, phase, freq = calc_fft(data, samplerate)
-            new_amp = amp[:frames_per_buffer // 2][::-1]
-
-            # データの時間長が最大保持時間を超えた場合、古いデータから削除
-            if history_amp.shape[1] > int(samplerate * max_chart_time / frames_per_buffer):
-                history_amp = history_amp[:, -int(samplerate * max_chart_time / frames_per_buffer):]
-
-            history_amp = np.hstack((history_amp, new_amp.reshape(-1, 1)))
-
-            # 振幅データをdBに変換してプロット
-            im.set_array(20 * np.log10(history_amp / 2e-5))
-            ax.set_xlim(0, max_chart_time)
-            ax.set_ylim(0, 6500)
-            fig.tight_layout()
-            plt.pause(0.01)
+        # たまったチャンクをまとめて取り出し、新しい列だけFFTとdB変換
+        batch = drain_queue(REDRAW_INTERVAL / 2)
+        if batch is not None:
+            spectrogram.push(calc_amplitude_db(batch, n_bins))
+
+        # 再描画はチャンクの到着とは独立に一定間隔で
+        now = time.perf_counter()
+        if spectrogram.dirty and background is not None and now - last_redraw >= REDRAW_INTERVAL:
+            im.set_data(spectrogram.ordered())
+            fig.canvas.restore_region(background)
+            ax.draw_artist(im)
+            fig.canvas.blit(ax.bbox)
+            last_redraw = now
+        fig.canvas.flush_events()
             
 
 if __name__ == '__main__':
     """メイン文"""
     
-    # サンプリングレートとフレームサイズ、マイクチャンネルを設定
+    # サンプリングレートとフレームサイズ、マイクチャンネルを設定（引数でマイク名を指定可能）
     samplerate = 12800
     frames_per_buffer = 2048
-    index = get_mic_index()
+    index = get_mic_index(sys.argv[1] if len(sys.argv) > 1 else None)
 
     # 録音関数を並列化実行
     threading.Thread(target=record_thread, args=(index, samplerate, frames_per_buffer), daemon=True).start()